@@ -2,9 +2,12 @@ import streamlit as st
 import pandas as pd
 from pathlib import Path
 import base64
+import sys
 from typing import Union
 from nav import show_nav_menu
 
+sys.path.append("./src/")
+import warmup
 
 # --- 0. NO MÁS MÓDULO DE AUTENTICACIÓN ---
 
@@ -28,6 +31,10 @@ else:
 if "current_page_for_nav" not in st.session_state:
     st.session_state.current_page_for_nav = "Página Principal"
 
+# Mientras se muestra la portada, los grafos y las fuentes del planificador se
+# descargan (si faltan) y se cargan en segundo plano
+warmup.preload("planner", warmup.load_planner_resources)
+
 
 # --- 1. Page Configuration (FOR THE MAIN APP) ---
 st.set_page_config(
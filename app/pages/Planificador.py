@@ -2,34 +2,48 @@ import streamlit as st
 from streamlit_folium import st_folium
 import folium
 from branca.element import Template, MacroElement
-from shapely.geometry import shape
 import pandas as pd
 from datetime import datetime as dt
 from zoneinfo import ZoneInfo
-import gdown
 
 from pathlib import Path
 import os
 import sys
 
 sys.path.append("./src/")
-from utils import get_valencian_open_data, get_gdf, read_graph
-from fountains import get_nearest_water_fountains_on_route, print_fountains
+from fountains import (
+    fountain_features,
+    get_nearest_water_fountains_on_route,
+)
 from routes import (
     get_route,
     print_route,
+    print_points,
     get_valenbisi_route,
     get_cycling_route,
-    print_stations,
+    station_features,
 )
 from temperature import get_temperature_data
+from valenbisi import AvailabilityPoller
+from trips import MODE_LABELS, get_band, print_trip
+from client import RoutingClient, RoutingServiceError
+import assets
+from routecache import route_cache, route_store
+import tracing
+import warmup
 
 from nav import show_nav_menu
 
 APP_DIR = Path(__file__).resolve().parent.parent
 
-FILE_ID = "1aPsZF__V9mNxLMmcixAF0A8joReIn_FC"
-FILENAME = "data/valencia_walking_sombra.graphml"
+# Zoom inicial del mapa; las rutas se simplifican a un píxel a este zoom
+MAP_ZOOM = 15
+DEFAULT_CENTER = (39.4699, -0.3763)
+MAP_KEY = "mapa"
+
+# Si se define, las rutas se piden al servicio de src/service.py en lugar de
+# calcularse en este proceso
+ROUTING_SERVICE = os.environ.get("VALENFRESC_SERVICE")
 
 try:
     st.set_page_config(
@@ -92,101 +106,164 @@ load_main_app_css("styles.css")
 # ----------------------
 # Functions for loading data and caching
 # ----------------------
-@st.cache_data
-def get_data_from_drive(file_id: str, filename: str):
-    """Descarga el fichero de Google Drive si no existe localmente."""
-    if not os.path.exists(filename):
-        url = f"https://drive.google.com/uc?id={file_id}"
-        gdown.download(url, filename, quiet=False)
-    return filename
+@st.fragment(run_every=1)
+def show_loading(resources):
+    """Muestra el progreso de la descarga y carga de datos hasta que acaba."""
+    if resources.done():
+        if resources.exception() is None:
+            st.rerun()
+        st.error(
+            f"No se han podido descargar los datos: {resources.exception()}. "
+            "Recarga la página para reintentarlo; la descarga continuará donde se quedó."
+        )
+        return
+    descarga = assets.progress(warmup.WALKING_GRAPH)
+    if descarga is None:
+        st.info("Cargando los grafos y las fuentes públicas...")
+    elif descarga[1]:
+        done, total = descarga
+        st.progress(
+            done / total,
+            text=f"Descargando datos: {done / 1e6:.0f} de {total / 1e6:.0f} MB",
+        )
+    else:
+        st.info(f"Descargando datos: {descarga[0] / 1e6:.0f} MB")
 
 
 # 1. Cache-loading of heavy static resources
 @st.cache_resource
-def load_graphs():
-    cycling_graph = read_graph("data/valencia_cycling_sombra.graphml")
-    walking_graph = read_graph(FILENAME)
-    return cycling_graph, walking_graph
+def load_planner_resources():
+    # La portada ya ha empezado a cargarlos en segundo plano; aquí se espera
+    return warmup.get("planner", warmup.load_planner_resources)
 
 
-@st.cache_data
-def load_public_fountains():
-    df = pd.read_csv("data/fonts_publiques.csv")
-    df["geometry"] = df["geo_shape"].apply(lambda x: shape(eval(x)))
-    return get_gdf(df)
-
+@st.cache_resource
+def load_valenbisi_poller():
+    # Un único hilo por proceso descarga la disponibilidad para todas las sesiones
+    return AvailabilityPoller().start()
+
+
+LEGEND_HTML = """
+{% macro html(this, kwargs) %}
+<div style="
+    position: fixed;
+    bottom: 50px;
+    left: 50px;
+    width: 140px;
+    height: 70px;
+    background-color: white;
+    border:2px solid grey;
+    z-index:9999;
+    font-size:14px;
+    ">
+    &nbsp;<b>Leyenda</b><br>
+    &nbsp;<i style="background:green;
+                display:inline-block;
+                width:12px;
+                height:12px;
+                margin-right:6px;"></i> Caminando<br>
+    &nbsp;<i style="background:blue;
+                display:inline-block;
+                width:12px;
+                height:12px;
+                margin-right:6px;"></i> Bicicleta
+</div>
+{% endmacro %}
+"""
+
+
+def build_base_map():
+    # Sin nada que dependa de la ruta ni de la barra lateral, para que el HTML
+    # no cambie entre ejecuciones
+    m = folium.Map(location=DEFAULT_CENTER, zoom_start=MAP_ZOOM)
+    legend = MacroElement()
+    legend._template = Template(LEGEND_HTML)
+    m.get_root().add_child(legend)
+    m.add_child(folium.ClickForMarker(popup="Punto seleccionado"))
+    return m
 
-def fetch_valenbisi_stations(url, params):
-    df = get_valencian_open_data(url, params)
-    df["geometry"] = df["geo_shape"].apply(shape)
-    gdf = get_gdf(df)
-    return gdf[gdf["open"] == "T"]
 
+# Las rutas se guardan en la caché compartida de src/routecache.py por nodos
+# ajustados, así que dos clics cercanos reutilizan la misma ruta
+def compute_route(s, e, graph, range_temp="length"):
+    return get_route(s, e, graph, range_temp, return_cumulative=True)
 
-# Cache the route computation by inputs
-@st.cache_data
-def compute_route(s, e, _graph, range_temp="length"):
-    return get_route(s, e, _graph, range_temp)
 
-
-@st.cache_data
+# La elección de estaciones se guarda por versión de la disponibilidad
 def compute_valenbisi_trip(
-    start, end, _cycling_graph, _walking_graph, _stations, range_temp="length"
+    start, end, cycling_graph, walking_graph, stations, range_temp="length"
 ):
     return get_valenbisi_route(
         start,
         end,
-        _cycling_graph,
-        _walking_graph,
-        _stations,
+        cycling_graph,
+        walking_graph,
+        stations,
         range_temp,
     )
 
 
 # Cache fountains lookup, mark graph param as unhashable
 @st.cache_data
-def compute_fountains(_g, d, r, mode, temp_val, _fountains_gdf):
+def compute_fountains(_g, d, r, mode, temp_val, _fountain_index, _cumulative=None):
     return get_nearest_water_fountains_on_route(
-        _g, d, r, mode, temp_val, _fountains_gdf
+        _g,
+        d,
+        r,
+        mode,
+        temp_val,
+        _fountain_index,
+        network=True,
+        cumulative=_cumulative,
     )
 
 
-@st.cache_data
 def compute_cycling_route(
-    start, end, _cycling_graph, _walking_graph, range_temp="length"
+    start, end, cycling_graph, walking_graph, range_temp="length"
 ):
-    return get_cycling_route(start, end, _cycling_graph, _walking_graph, range_temp)
+    return get_cycling_route(start, end, cycling_graph, walking_graph, range_temp)
 
 
-@st.cache_data
+# The forecast is already kept in memory by the temperature module
 def fetch_temperature(now):
     return get_temperature_data(now)
 
 
+@st.cache_resource
+def load_routing_client(base_url):
+    return RoutingClient(base_url)
+
+
 @st.cache_data
-def get_range(temp):
-    for i in range(0, 41, 5):
-        if temp - 5 < i:
-            return f"peso_{i}_{i + 5}"
+def compute_remote_trip(base_url, start, end, mode, minute):
+    # minute forma parte de la clave para que la disponibilidad no quede fija
+    return load_routing_client(base_url).route(start, end, mode)
 
 
 # ----------------------
 # Global variables and initial setup
 # ----------------------
-get_data_from_drive(FILE_ID, FILENAME)
-
-# Load cached data
-graph_cycling, graph_walking = load_graphs()
-public_fountains_gdf = load_public_fountains()
 now = dt.now(tz=ZoneInfo("UTC"))
 
-if "now" not in st.session_state:
-    st.session_state.now = now
-    st.session_state.first_run = True
+if ROUTING_SERVICE:
+    # El servicio ya tiene los grafos, las fuentes y las estaciones cargados
+    temp = None
+else:
+    # Los datos se descargan y cargan en un hilo; mientras, se muestra el progreso
+    resources = warmup.preload("planner", warmup.load_planner_resources)
+    if not resources.done() or resources.exception() is not None:
+        show_loading(resources)
+        st.stop()
+
+    # Load cached data
+    graph_cycling, graph_walking, public_fountains_gdf, fountain_index = (
+        load_planner_resources()
+    )
+    valenbisi_poller = load_valenbisi_poller()
 
-temp = fetch_temperature(now)
+    temp = fetch_temperature(now)
 
-range_temp = get_range(temp)
+    range_temp = get_band(temp)
 
 # ----------------------
 # Streamlit app layout and logic
@@ -219,6 +296,8 @@ with st.sidebar:
     punto_opciones = ["Inicio", "Fin"]
     punto = st.radio("¿Qué punto quieres fijar?", punto_opciones)
 
+    show_timings = st.checkbox("Mostrar tiempos de cálculo")
+
     st.markdown("---")
     st.markdown("#### Autores")
     st.markdown(
@@ -239,9 +318,29 @@ if "start" not in st.session_state:
     st.session_state.start = None
 if "end" not in st.session_state:
     st.session_state.end = None
+if "last_click" not in st.session_state:
+    st.session_state.last_click = None
+
+
+def apply_click(click):
+    """Guarda un clic nuevo en el mapa como inicio o fin de la ruta."""
+    if not click or click == st.session_state.last_click:
+        return None
+    st.session_state.last_click = click
+    point = {"lat": click["lat"], "lng": click["lng"]}
+    if punto == "Inicio":
+        st.session_state.start = point
+        return "inicio"
+    st.session_state.end = point
+    return "fin"
+
+
+# El clic que ha provocado esta ejecución ya está en el estado del mapa, así que
+# se aplica antes de dibujar y no hace falta volver a ejecutar la página
+clicked = apply_click((st.session_state.get(MAP_KEY) or {}).get("last_clicked"))
 
 # Center map on last known point
-centro = [39.4699, -0.3763]
+centro = list(DEFAULT_CENTER)
 if st.session_state.start and st.session_state.end:
     centro = [
         (st.session_state.start["lat"] + st.session_state.end["lat"]) / 2,
@@ -252,7 +351,10 @@ elif st.session_state.start:
 elif st.session_state.end:
     centro = [st.session_state.end["lat"], st.session_state.end["lng"]]
 
-m = folium.Map(location=centro, zoom_start=15)
+# El mapa base es siempre el mismo, así que st_folium no lo vuelve a dibujar;
+# solo se envían las capas de la ruta cuando cambian
+m = build_base_map()
+capa = folium.FeatureGroup(name="Ruta")
 
 # Add existing markers
 if st.session_state.start:
@@ -260,183 +362,222 @@ if st.session_state.start:
         [st.session_state.start["lat"], st.session_state.start["lng"]],
         popup="Inicio",
         icon=folium.Icon(color="green"),
-    ).add_to(m)
+    ).add_to(capa)
 if st.session_state.end:
     folium.Marker(
         [st.session_state.end["lat"], st.session_state.end["lng"]],
         popup="Fin",
         icon=folium.Icon(color="red"),
-    ).add_to(m)
-
-dist_total = 0
-okey = True
-paradas_total = 0
-fuentes_total = 0
-if st.session_state.start and st.session_state.end:
-    start_coord = (st.session_state.start["lat"], st.session_state.start["lng"])
-    end_coord = (st.session_state.end["lat"], st.session_state.end["lng"])
-
-    if type_route == "Caminando":
-        route, dist = compute_route(start_coord, end_coord, graph_walking, range_temp)
-        print_route(route, graph_walking, m, color="green")
+    ).add_to(capa)
 
-        fountains_on_route, paradas = compute_fountains(
-            graph_walking, dist, route, type_route, temp, public_fountains_gdf
-        )
-        print_fountains(fountains_on_route, public_fountains_gdf, m)
-
-        paradas_total += paradas
-        fuentes_total += len(fountains_on_route)
-        dist_total = dist
-
-    elif type_route == "Bicicleta":
-        ini_walk, dist_ini, cycle, dist_cycle, end_walk, dist_end = (
-            compute_cycling_route(
-                start_coord, end_coord, graph_cycling, graph_walking, range_temp
-            )
-        )
+# Tiempos por etapa de esta ejecución (también con VALENFRESC_TRACE=log)
+page_trace = (
+    tracing.begin("planificador") if show_timings or tracing.enabled() else None
+)
 
-        if ini_walk and cycle and end_walk:
-            print_route(ini_walk, graph_walking, m, color="green")
-            print_route(cycle, graph_cycling, m, color="blue")
-            print_route(end_walk, graph_walking, m, color="green")
-        else:
-            okey = False
-            st.error(
-                "No se ha podido calcular la ruta en bicicleta entre los puntos seleccionados."
-            )
-            st.stop()
-
-        for seg_graph, seg_dist, seg_route, seg_mode in [
-            (graph_walking, dist_ini, ini_walk, "Caminando"),
-            (graph_cycling, dist_cycle, cycle, "En Bicicleta"),
-            (graph_walking, dist_end, end_walk, "Caminando"),
-        ]:
-            fountains_on_segment, paradas = compute_fountains(
-                seg_graph,
-                seg_dist,
-                seg_route,
-                seg_mode,
-                temp,
-                public_fountains_gdf,
-            )
-            print_fountains(fountains_on_segment, public_fountains_gdf, m)
-            paradas_total += paradas
-            fuentes_total += len(fountains_on_segment)
-
-        dist_total = dist_ini + dist_cycle + dist_end
-
-    elif type_route == "Valenbisi":
-        # Fetch station data once
-
-        if st.session_state.first_run or now - st.session_state.now > pd.Timedelta(
-            minutes=10
-        ):
-            st.session_state.now = now
-            st.session_state.first_run = False
-            params = {"rows": 100}
-            url = (
-                "https://valencia.opendatasoft.com/api/explore/v2.1/catalog/"
-                "datasets/valenbisi-disponibilitat-valenbisi-dsiponibilidad/records"
+# st.stop() corta la ejecución con una excepción, así que la traza se cierra
+# en el finally para que no quede abierta
+try:
+    dist_total = 0
+    okey = True
+    paradas_total = 0
+    fuentes_total = 0
+    # Fuentes y estaciones se dibujan juntas en una sola capa
+    puntos = []
+    if st.session_state.start and st.session_state.end:
+        start_coord = (st.session_state.start["lat"], st.session_state.start["lng"])
+        end_coord = (st.session_state.end["lat"], st.session_state.end["lng"])
+
+        if ROUTING_SERVICE:
+            mode = {label: mode for mode, label in MODE_LABELS.items()}[type_route]
+            try:
+                trip = compute_remote_trip(
+                    ROUTING_SERVICE,
+                    start_coord,
+                    end_coord,
+                    mode,
+                    now.strftime("%Y-%m-%d %H:%M"),
+                )
+            except RoutingServiceError as e:
+                okey = False
+                st.error(
+                    f"No se ha podido calcular la ruta entre los puntos seleccionados: {e}"
+                )
+                st.stop()
+
+            print_trip(trip, capa, zoom=MAP_ZOOM)
+            temp = trip["properties"]["temperature"]
+            paradas_total = trip["properties"]["paradas"]
+            fuentes_total = trip["properties"]["fuentes"]
+            dist_total = trip["properties"]["distance"]
+
+        elif type_route == "Caminando":
+            route, dist, cumulative = compute_route(
+                start_coord, end_coord, graph_walking, range_temp
             )
-            st.session_state.valenbisi_stations = fetch_valenbisi_stations(url, params)
+            print_route(route, graph_walking, capa, color="green", zoom=MAP_ZOOM)
 
-        try:
-            (
-                ini_walk,
-                dist_ini,
-                cycle,
-                dist_cycle,
-                end_walk,
-                dist_end,
-                ini_station,
-                end_station,
-            ) = compute_valenbisi_trip(
-                start_coord,
-                end_coord,
-                graph_cycling,
-                graph_walking,
-                st.session_state.valenbisi_stations,
-                range_temp,
+            fountains_on_route, paradas = compute_fountains(
+                graph_walking, dist, route, type_route, temp, fountain_index, cumulative
             )
+            puntos += fountain_features(fountains_on_route, public_fountains_gdf)
 
-            print_stations(ini_station, end_station, m)
-            print_route(ini_walk, graph_walking, m, color="green")
-            print_route(cycle, graph_cycling, m, color="blue")
-            print_route(end_walk, graph_walking, m, color="green")
-
-        except IndexError:
-            okey = False
-            st.error(
-                "No se ha podido calcular la ruta en ValenBisi entre los puntos seleccionados."
-            )
-            st.stop()
-
-        for seg_graph, seg_dist, seg_route, seg_mode in [
-            (graph_walking, dist_ini, ini_walk, "Caminando"),
-            (graph_cycling, dist_cycle, cycle, "En Bicicleta"),
-            (graph_walking, dist_end, end_walk, "Caminando"),
-        ]:
-            fts, paradas = compute_fountains(
-                seg_graph, seg_dist, seg_route, seg_mode, temp, public_fountains_gdf
-            )
-            print_fountains(fts, public_fountains_gdf, m)
             paradas_total += paradas
-            fuentes_total += len(fts)
-
-        dist_total = dist_ini + dist_cycle + dist_end
-
-    legend_html = """
-    {% macro html(this, kwargs) %}
-    <div style="
-        position: fixed;
-        bottom: 50px;
-        left: 50px;
-        width: 140px;
-        height: 70px;
-        background-color: white;
-        border:2px solid grey;
-        z-index:9999;
-        font-size:14px;
-        ">
-        &nbsp;<b>Leyenda</b><br>
-        &nbsp;<i style="background:green;
-                    display:inline-block;
-                    width:12px;
-                    height:12px;
-                    margin-right:6px;"></i> Caminando<br>
-        &nbsp;<i style="background:blue;
-                    display:inline-block;
-                    width:12px;
-                    height:12px;
-                    margin-right:6px;"></i> Bicicleta
-    </div>
-    {% endmacro %}
-    """
-    legend = MacroElement()
-    legend._template = Template(legend_html)
-    m.get_root().add_child(legend)
-
-if okey and dist_total > 0:
-    st.markdown(
-        f"La distancia total de la ruta es de **{dist_total:.2f} metros**.\nHace una temperatura de **{temp:.2f}°C** en Valencia, por lo que se recomienda hacer un total de **{paradas_total} paradas**, pero se han encontrado un total de **{fuentes_total} fuentes** cercanas a la ruta."
-    )
+            fuentes_total += len(fountains_on_route)
+            dist_total = dist
+
+        elif type_route == "Bicicleta":
+            ini_walk, dist_ini, cycle, dist_cycle, end_walk, dist_end = (
+                compute_cycling_route(
+                    start_coord, end_coord, graph_cycling, graph_walking, range_temp
+                )
+            )
 
+            if ini_walk and cycle and end_walk:
+                print_route(ini_walk, graph_walking, capa, color="green", zoom=MAP_ZOOM)
+                print_route(cycle, graph_cycling, capa, color="blue", zoom=MAP_ZOOM)
+                print_route(end_walk, graph_walking, capa, color="green", zoom=MAP_ZOOM)
+            else:
+                okey = False
+                st.error(
+                    "No se ha podido calcular la ruta en bicicleta entre los puntos seleccionados."
+                )
+                st.stop()
+
+            for seg_graph, seg_dist, seg_route, seg_mode in [
+                (graph_walking, dist_ini, ini_walk, "Caminando"),
+                (graph_cycling, dist_cycle, cycle, "En Bicicleta"),
+                (graph_walking, dist_end, end_walk, "Caminando"),
+            ]:
+                fountains_on_segment, paradas = compute_fountains(
+                    seg_graph,
+                    seg_dist,
+                    seg_route,
+                    seg_mode,
+                    temp,
+                    fountain_index,
+                )
+                puntos += fountain_features(fountains_on_segment, public_fountains_gdf)
+                paradas_total += paradas
+                fuentes_total += len(fountains_on_segment)
+
+            dist_total = dist_ini + dist_cycle + dist_end
+
+        elif type_route == "Valenbisi":
+            # Disponibilidad publicada por el hilo compartido, sin esperar descargas
+            valenbisi_stations, _ = valenbisi_poller.get(timeout=30)
+            if valenbisi_stations is None:
+                st.error("No se ha podido obtener la disponibilidad de ValenBisi.")
+                st.stop()
+
+            try:
+                (
+                    ini_walk,
+                    dist_ini,
+                    cycle,
+                    dist_cycle,
+                    end_walk,
+                    dist_end,
+                    ini_station,
+                    end_station,
+                ) = compute_valenbisi_trip(
+                    start_coord,
+                    end_coord,
+                    graph_cycling,
+                    graph_walking,
+                    valenbisi_stations,
+                    range_temp,
+                )
+
+                puntos += station_features(ini_station, end_station)
+                print_route(ini_walk, graph_walking, capa, color="green", zoom=MAP_ZOOM)
+                print_route(cycle, graph_cycling, capa, color="blue", zoom=MAP_ZOOM)
+                print_route(end_walk, graph_walking, capa, color="green", zoom=MAP_ZOOM)
+
+            except IndexError:
+                okey = False
+                st.error(
+                    "No se ha podido calcular la ruta en ValenBisi entre los puntos seleccionados."
+                )
+                st.stop()
+
+            for seg_graph, seg_dist, seg_route, seg_mode in [
+                (graph_walking, dist_ini, ini_walk, "Caminando"),
+                (graph_cycling, dist_cycle, cycle, "En Bicicleta"),
+                (graph_walking, dist_end, end_walk, "Caminando"),
+            ]:
+                fts, paradas = compute_fountains(
+                    seg_graph, seg_dist, seg_route, seg_mode, temp, fountain_index
+                )
+                puntos += fountain_features(fts, public_fountains_gdf)
+                paradas_total += paradas
+                fuentes_total += len(fts)
+
+            dist_total = dist_ini + dist_cycle + dist_end
+
+        print_points(puntos, capa)
+
+    if okey and dist_total > 0:
+        st.markdown(
+            f"La distancia total de la ruta es de **{dist_total:.2f} metros**.\nHace una temperatura de **{temp:.2f}°C** en Valencia, por lo que se recomienda hacer un total de **{paradas_total} paradas**, pero se han encontrado un total de **{fuentes_total} fuentes** cercanas a la ruta."
+        )
 
-# 3. Add click handler
-m.add_child(folium.ClickForMarker(popup=f"Selecciona el {punto.lower()} de la ruta"))
-map_data = st_folium(m, width=1500, height=700)
+    # 3. Render the base map with the route layer. Only clicks rerun the page,
+    # not panning or zooming
+    st.caption(f"Haz clic en el mapa para fijar el {punto.lower()} de la ruta.")
+    with tracing.span("st_folium"):
+        map_data = st_folium(
+            m,
+            key=MAP_KEY,
+            center=centro,
+            feature_group_to_add=capa,
+            returned_objects=["last_clicked"],
+            width=1500,
+            height=700,
+        )
+finally:
+    if page_trace is not None:
+        tracing.finish(page_trace)
+
+if page_trace is not None and show_timings:
+    with st.expander("Tiempos de cálculo", expanded=True):
+        st.caption(
+            "Las etapas guardadas en caché por Streamlit no se vuelven a "
+            "calcular y no aparecen."
+        )
+        st.dataframe(
+            pd.DataFrame(
+                [
+                    {
+                        "Etapa": "\u00a0\u00a0" * depth + span.name,
+                        "ms": round(1000 * span.duration, 2),
+                        "Contadores": ", ".join(
+                            f"{k}={v}" for k, v in span.counters.items()
+                        ),
+                    }
+                    for depth, span in page_trace.spans()
+                ]
+            ),
+            hide_index=True,
+            use_container_width=True,
+        )
+        cache = route_cache.stats()
+        disco = route_store.stats()
+        st.caption(
+            f"Caché de rutas: {cache['entries']} rutas "
+            f"({cache['bytes'] / 2**20:.1f} de {cache['max_bytes'] / 2**20:.0f} MB), "
+            f"{cache['hits']} aciertos y {cache['misses']} fallos. "
+            f"En disco: {disco['routes']} rutas "
+            f"({disco['bytes'] / 2**20:.1f} de {disco['max_bytes'] / 2**20:.0f} MB), "
+            f"{disco['hits']} aciertos y {disco['misses']} fallos."
+        )
 
 # 4. Handle new click
-if map_data and map_data.get("last_clicked"):
-    lat = map_data["last_clicked"]["lat"]
-    lng = map_data["last_clicked"]["lng"]
-    if punto == "Inicio":
-        st.session_state.start = {"lat": lat, "lng": lng}
-        st.success(f"Punto de **inicio** guardado en {lat:.6f}, {lng:.6f}")
-    else:
-        st.session_state.end = {"lat": lat, "lng": lng}
-        st.success(f"Punto de **fin** guardado en {lat:.6f}, {lng:.6f}")
-
-    # Trigger a rerun so cached functions will be used for recompute
+if clicked:
+    point = st.session_state.start if clicked == "inicio" else st.session_state.end
+    st.success(
+        f"Punto de **{clicked}** guardado en {point['lat']:.6f}, {point['lng']:.6f}"
+    )
+elif map_data and apply_click(map_data.get("last_clicked")):
+    # El clic no estaba aún en el estado del mapa al empezar la ejecución
     st.rerun()
@@ -0,0 +1,424 @@
+"""
+Benchmark of the routing pipeline over the Valencia shade graphs.
+
+Every stage of a route is timed on its own, over seeded random
+origin-destination pairs inside the bounds of the cycling graph:
+
+    graph load, snapping, shortest path per weight band (and again from the
+    route cache), distance summation, fountain lookup, Valenbisi station
+    selection, batch routing and folium rendering.
+
+The batch stage also routes pairs that leave a dead end of the cycling graph,
+and the run fails unless they come back without a route.
+
+The import time of every ``src`` module is measured with ``-X importtime`` in
+a fresh interpreter, and the run fails if any of them goes over
+``--import-budget-ms``, so a heavy import at module level is caught early.
+
+Results are written to a JSON file. Passing a previous result with
+``--compare`` prints the change of every stage and exits with status 1 if any
+stage got slower than ``--threshold``.
+
+Uso (desde la raíz del repositorio):
+    python benchmarks/bench_routing.py --out benchmarks/results/base.json
+    python benchmarks/bench_routing.py --compare benchmarks/results/base.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from itertools import pairwise
+
+sys.path.append("./src/")
+
+import folium
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import Point
+
+from batch import route_batch
+from fountains import (
+    FountainIndex,
+    get_fountain_table,
+    get_nearest_water_fountains_on_route,
+)
+from routecache import route_cache
+from routes import (
+    choose_stations,
+    get_cumulative_distances,
+    print_route,
+    shortest_path,
+)
+from snapshot import WEIGHT_BANDS
+from utils import StationIndex, load_public_fountains, read_graph, snap_points
+
+DEFAULT_OUT = "benchmarks/results/latest.json"
+
+# Módulos que importan las páginas de Streamlit
+IMPORTED_MODULES = [
+    "tracing",
+    "utils",
+    "routes",
+    "fountains",
+    "temperature",
+    "trips",
+    "valenbisi",
+    "client",
+    "warmup",
+]
+
+
+class Timer:
+    """Collect the duration of every run of every stage."""
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.stages = {}
+
+    def run(self, name, func, items=1):
+        """
+        Time ``func`` ``repeat`` times and keep the result of the last run.
+
+        Parameters:
+            name (str): Stage name in the results.
+            func (callable): Work of the stage, without arguments.
+            items (int): Items processed by each run, to report time per item.
+        """
+        runs = []
+        result = None
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            result = func()
+            runs.append(time.perf_counter() - start)
+        self.record(name, runs, items)
+        return result
+
+    def record(self, name, runs, items=1):
+        """Keep durations measured elsewhere, in seconds, as a stage."""
+        self.stages[name] = {
+            "min": min(runs),
+            "median": statistics.median(runs),
+            "items": items,
+            "per_item_ms": 1000 * min(runs) / max(items, 1),
+            "runs": runs,
+        }
+        print(f"{name:<28} {min(runs) * 1000:10.1f} ms  ({items} items)")
+
+
+def random_pairs(graph, n, seed):
+    """Seeded (lat, lon) origin-destination pairs inside the graph bounds."""
+    rng = random.Random(seed)
+    ys = [d["y"] for _, d in graph.nodes(data=True)]
+    xs = [d["x"] for _, d in graph.nodes(data=True)]
+    lat0, lat1, lon0, lon1 = min(ys), max(ys), min(xs), max(xs)
+
+    def point():
+        return (rng.uniform(lat0, lat1), rng.uniform(lon0, lon1))
+
+    return [(point(), point()) for _ in range(n)], (lat0, lat1, lon0, lon1)
+
+
+def random_stations(bounds, n, seed):
+    """Seeded stand-in for the Valenbisi stations, so runs are comparable."""
+    rng = random.Random(seed)
+    lat0, lat1, lon0, lon1 = bounds
+    rows = []
+    for i in range(n):
+        lat, lon = rng.uniform(lat0, lat1), rng.uniform(lon0, lon1)
+        rows.append(
+            {
+                "number": i,
+                "available": rng.randint(0, 10),
+                "free": rng.randint(0, 10),
+                "geo_point_2d": {"lat": lat, "lon": lon},
+                "geometry": Point(lon, lat),
+            }
+        )
+    return StationIndex(gpd.GeoDataFrame(rows, geometry="geometry", crs=4326))
+
+
+def unreachable_pairs(graph, n):
+    """
+    (lat, lon) pairs joining nodes without outgoing edges, so no route exists.
+
+    Returns:
+        list: Up to ``n`` pairs, empty if the graph has fewer than two such nodes.
+    """
+    snapshot = graph.graph["snapshot"]
+    sinks = np.flatnonzero(np.diff(snapshot.indptr) == 0)[: n + 1]
+    points = [(float(snapshot.lat[i]), float(snapshot.lon[i])) for i in sinks]
+    return list(pairwise(points))
+
+
+def import_time(module):
+    """
+    Cumulative import time of a ``src`` module in a fresh interpreter.
+
+    Returns:
+        float: Seconds, as reported by ``python -X importtime``.
+    """
+    code = f"import sys; sys.path.insert(0, 'src'); import {module}"
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    for line in reversed(stderr.splitlines()):
+        # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1]) / 1e6
+    raise RuntimeError(f"No import time reported for {module}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args):
+    timer = Timer(args.repeat)
+
+    for module in IMPORTED_MODULES:
+        timer.record(
+            f"import[{module}]", [import_time(module) for _ in range(args.repeat)]
+        )
+
+    # Carga: GraphML completo y snapshot binario
+    timer.run("load_graphml", lambda: read_graph(args.cycling, use_snapshot=False))
+    cycling = timer.run("load_snapshot", lambda: read_graph(args.cycling, view=True))
+    walking = read_graph(args.walking, view=True)
+
+    pairs, bounds = random_pairs(cycling, args.pairs, args.seed)
+    points = [p for pair in pairs for p in pair]
+
+    snapped = timer.run("snap", lambda: snap_points(walking, points), items=len(points))
+    od = list(zip(snapped[0::2], snapped[1::2]))
+
+    routes = {}
+    bands = ["length", *WEIGHT_BANDS] if args.all_bands else ["length", args.band]
+    for band in bands:
+        if band != "length" and band not in walking.graph["snapshot"].weights:
+            continue
+        routes[band] = timer.run(
+            f"shortest_path[{band}]",
+            lambda band=band: [
+                shortest_path(walking, s, t, band, use_cache=False) for s, t in od
+            ],
+            items=len(od),
+        )
+    band = args.band if args.band in routes else "length"
+    found = [r for r in routes[band] if r]
+
+    # Las mismas consultas otra vez, servidas por la caché de rutas
+    route_cache.clear()
+    [shortest_path(walking, s, t, band) for s, t in od]
+    timer.run(
+        "shortest_path_cached",
+        lambda: [shortest_path(walking, s, t, band) for s, t in od],
+        items=len(od),
+    )
+
+    cumulative = timer.run(
+        "distance",
+        lambda: [get_cumulative_distances(r, walking) for r in found],
+        items=len(found),
+    )
+
+    fountains = load_public_fountains(args.fountains)
+    fountain_index = FountainIndex(fountains)
+    get_fountain_table(walking, fountain_index)
+    timer.run(
+        "fountains",
+        lambda: [
+            get_nearest_water_fountains_on_route(
+                walking,
+                float(c[-1]),
+                r,
+                "Caminando",
+                30,
+                fountain_index,
+                network=True,
+                cumulative=c,
+            )
+            for r, c in zip(found, cumulative)
+        ],
+        items=len(found),
+    )
+
+    stations = random_stations(bounds, args.stations, args.seed)
+    stations.graph_nodes(walking)
+    stations.graph_nodes(cycling)
+    timer.run(
+        "stations",
+        lambda: [
+            choose_stations(
+                s, t, cycling, walking, stations, args.band, use_cache=False
+            )
+            for s, t in od
+        ],
+        items=len(od),
+    )
+
+    # Lote en bici, con pares sin camino que deben volver como NaN
+    dead_ends = unreachable_pairs(cycling, 5)
+    batch_pairs = pairs + dead_ends
+    batch = timer.run(
+        "batch[bike]",
+        lambda: route_batch(
+            [o for o, _ in batch_pairs],
+            [d for _, d in batch_pairs],
+            "bike",
+            "length",
+            cycling_graph=cycling,
+            workers=1,
+        ),
+        items=len(batch_pairs),
+    )
+    if not np.isnan(batch.distance[len(pairs) :]).all():
+        raise RuntimeError("Batch routing found a route between unreachable pairs")
+
+    def render():
+        m = folium.Map(location=[39.4699, -0.3763], zoom_start=15)
+        for r in found[: args.render]:
+            print_route(r, walking, m, color="green")
+        return m.get_root().render()
+
+    timer.run("folium", render, items=min(args.render, len(found)))
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "pairs": args.pairs,
+            "band": args.band,
+            "repeat": args.repeat,
+            "cycling": args.cycling,
+            "walking": args.walking,
+            "routes_found": len(found),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "stages": timer.stages,
+    }
+
+
+def compare(result, baseline, threshold, min_delta=0.001):
+    """
+    Print the change of every stage against a previous result.
+
+    Parameters:
+        result (dict): Result of this run.
+        baseline (dict): Result to compare against.
+        threshold (float): Slowdown allowed, as a fraction.
+        min_delta (float): Seconds a stage must lose before it counts, so the
+            noise of very short stages is not reported.
+
+    Returns:
+        list: Names of the stages slower than ``threshold``.
+    """
+    for key in ["seed", "pairs", "band", "walking", "cycling"]:
+        if result["meta"].get(key) != baseline["meta"].get(key):
+            print(f"warning: {key} differs from the baseline, times are not comparable")
+    regressions = []
+    print(f"\n{'stage':<28} {'base ms':>10} {'now ms':>10} {'change':>8}")
+    for name, stage in result["stages"].items():
+        base = baseline["stages"].get(name)
+        if base is None:
+            print(f"{name:<28} {'-':>10} {stage['min'] * 1000:10.1f}")
+            continue
+        change = stage["min"] / base["min"] - 1 if base["min"] > 0 else 0.0
+        flag = ""
+        if change > threshold and stage["min"] - base["min"] > min_delta:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name:<28} {base['min'] * 1000:10.1f} {stage['min'] * 1000:10.1f}"
+            f" {change:+8.1%}{flag}"
+        )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--cycling", default="data/valencia_cycling_sombra.graphml")
+    parser.add_argument("--walking", default="data/valencia_walking_sombra.graphml")
+    parser.add_argument("--fountains", default="data/fonts_publiques.csv")
+    parser.add_argument("--pairs", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--band", default="peso_25_30")
+    parser.add_argument(
+        "--all-bands", action="store_true", help="time every weight band"
+    )
+    parser.add_argument("--stations", type=int, default=270)
+    parser.add_argument("--render", type=int, default=20, help="routes drawn")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--out", default=DEFAULT_OUT)
+    parser.add_argument("--compare", help="previous result to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="slowdown allowed per stage before failing (0.2 = 20%%)",
+    )
+    parser.add_argument(
+        "--import-budget-ms",
+        type=float,
+        default=300.0,
+        help="maximum import time of every src module",
+    )
+    parser.add_argument(
+        "--min-delta-ms",
+        type=float,
+        default=1.0,
+        help="slowdown in ms a stage must exceed to count as a regression",
+    )
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(args)
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(f"\n{args.out}")
+
+    over_budget = [
+        name
+        for name, stage in result["stages"].items()
+        if name.startswith("import[") and stage["min"] * 1000 > args.import_budget_ms
+    ]
+    if over_budget:
+        print(
+            f"\nImports over {args.import_budget_ms:.0f} ms: {', '.join(over_budget)}"
+        )
+        return 1
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(
+            result, baseline, args.threshold, args.min_delta_ms / 1000
+        )
+        if regressions:
+            print(f"\nRegressions over {args.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,351 @@
+import bz2
+import contextlib
+import gzip
+import hashlib
+import json
+import logging
+import lzma
+import os
+import sys
+import threading
+from urllib.parse import unquote, urlsplit
+
+MANIFEST = "data/assets.json"
+DOWNLOAD_DIR = "data/.downloads"
+# Directorio local, file:// o URL base con copias comprimidas de los ficheros
+MIRROR_ENV = "VALENFRESC_ASSET_MIRROR"
+CHUNK_SIZE = 1 << 20
+
+COMPRESSIONS = {"gzip": gzip, "bz2": bz2, "xz": lzma}
+SUFFIXES = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz"}
+
+logger = logging.getLogger(__name__)
+
+_locks = {}
+_locks_lock = threading.Lock()
+_progress = {}
+
+
+class AssetError(Exception):
+    """A data file could not be downloaded or did not pass verification."""
+
+
+def load_manifest(file_path: str = MANIFEST):
+    """
+    Read the manifest of the data files that can be downloaded.
+
+    Every entry is keyed by the path of the file in the repository and has:
+
+        url: Remote source of the file.
+        compression: Compression of ``url`` (``gzip``, ``bz2``, ``xz`` or null).
+        archive: Name of the compressed copy of the file in a mirror.
+        sha256, size: Checksum and size of the uncompressed file, as written
+            by ``pack``. Files without checksum are not installed, unless
+            the entry also has ``unverified``.
+        unverified: Install the file without checksum until one is
+            recorded, logging the SHA-256 that was downloaded. ``pack
+            --update`` removes it.
+
+    Returns:
+        dict: Entries by file path, empty if there is no manifest.
+    """
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def progress(path: str):
+    """
+    Bytes downloaded of a file being fetched.
+
+    Returns:
+        tuple: ``(done, total)``, with ``total`` None when unknown, or None if
+        the file is not being downloaded.
+    """
+    return _progress.get(path)
+
+
+def _lock_for(path):
+    with _locks_lock:
+        return _locks.setdefault(path, threading.Lock())
+
+
+def _source(path, entry, mirror):
+    """Source URL or file of an entry and its compression module."""
+    if mirror:
+        name = entry.get("archive") or os.path.basename(path)
+        source = f"{mirror.rstrip('/')}/{name}"
+        return source, COMPRESSIONS.get(SUFFIXES.get(os.path.splitext(name)[1]))
+    compression = entry.get("compression")
+    return entry["url"], COMPRESSIONS[compression] if compression else None
+
+
+def _local_path(source):
+    if source.startswith("file://"):
+        return unquote(urlsplit(source).path)
+    if "://" not in source:
+        return source
+    return None
+
+
+def _download(source, part_path, path):
+    """
+    Append ``source`` to ``part_path`` from where a previous attempt stopped.
+
+    Local files and ``file://`` URLs are read from the same offset, and HTTP
+    sources are asked for the missing range.
+    """
+    done = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    local = _local_path(source)
+    if local is not None:
+        total = os.path.getsize(local)
+        _progress[path] = (done, total)
+        with open(local, "rb") as src, open(part_path, "ab") as out:
+            src.seek(done)
+            while chunk := src.read(CHUNK_SIZE):
+                out.write(chunk)
+                done += len(chunk)
+                _progress[path] = (done, total)
+        return
+
+    import requests
+
+    headers = {"Range": f"bytes={done}-"} if done else {}
+    with requests.get(source, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 416:
+            # El fichero parcial ya estaba completo
+            return
+        response.raise_for_status()
+        if response.headers.get("Content-Type", "").startswith("text/html"):
+            raise AssetError(f"{source} returned an HTML page instead of the file")
+        if response.status_code != 206:
+            # El servidor no admite rangos: se empieza de nuevo
+            done = 0
+        length = response.headers.get("Content-Length")
+        total = done + int(length) if length else None
+        _progress[path] = (done, total)
+        with open(part_path, "ab" if done else "wb") as out:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                out.write(chunk)
+                done += len(chunk)
+                _progress[path] = (done, total)
+
+
+def _install(part_path, path, compression, entry):
+    """
+    Decompress ``part_path`` into ``path`` while hashing it, then rename.
+
+    The file only appears under ``path`` once its checksum and size match the
+    manifest, so an interrupted download never leaves a broken file behind.
+    """
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    digest = hashlib.sha256()
+    size = 0
+    opener = compression.open if compression is not None else open
+    try:
+        with opener(part_path, "rb") as src, open(tmp_path, "wb") as out:
+            while chunk := src.read(CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+                out.write(chunk)
+    except (OSError, EOFError, lzma.LZMAError) as e:
+        # Si falla al abrir, el temporal ni siquiera llega a existir
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(part_path)
+        raise AssetError(f"Could not decompress {part_path}: {e}") from e
+
+    expected = entry.get("sha256")
+    if expected and digest.hexdigest() != expected:
+        os.remove(tmp_path)
+        os.remove(part_path)
+        raise AssetError(
+            f"Checksum of {path} is {digest.hexdigest()}, expected {expected}"
+        )
+    if entry.get("size") is not None and size != entry["size"]:
+        os.remove(tmp_path)
+        os.remove(part_path)
+        raise AssetError(f"{path} has {size} bytes, expected {entry['size']}")
+    if not expected:
+        logger.warning(
+            "%s installed without checksum (sha256 %s); run `python src/assets.py"
+            " pack %s --update` to record it",
+            path,
+            digest.hexdigest(),
+            path,
+        )
+    os.replace(tmp_path, path)
+    os.remove(part_path)
+
+
+def fetch(path: str, entry: dict | None = None, mirror: str | None = None):
+    """
+    Download a data file of the manifest, verify it and move it into place.
+
+    A partial download is kept in ``DOWNLOAD_DIR`` and resumed by the next
+    call. Compressed sources are decompressed while they are copied, and the
+    file is renamed into ``path`` only after its checksum matches. Entries
+    without checksum are refused before downloading anything, unless they
+    are marked ``unverified`` (see ``load_manifest``).
+
+    Parameters:
+        path (str): Path of the file, as in the manifest.
+        entry (dict): Manifest entry. Defaults to the one in ``MANIFEST``.
+        mirror (str): Directory, ``file://`` or base URL with the compressed
+            copies of the files. Defaults to ``VALENFRESC_ASSET_MIRROR``.
+
+    Returns:
+        str: ``path``.
+    """
+    if entry is None:
+        entry = load_manifest().get(path)
+        if entry is None:
+            raise AssetError(f"{path} is not in {MANIFEST}")
+    if not entry.get("sha256") and not entry.get("unverified"):
+        raise AssetError(
+            f"{path} has no sha256 in {MANIFEST}: run `python src/assets.py pack"
+            f" {path} --update` on a trusted copy of the file"
+        )
+    if mirror is None:
+        mirror = os.environ.get(MIRROR_ENV)
+
+    with _lock_for(path):
+        if os.path.exists(path):
+            return path
+        source, compression = _source(path, entry, mirror)
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Un fichero parcial por origen, para no mezclar dos descargas distintas
+        key = hashlib.sha1(source.encode("utf-8")).hexdigest()[:12]
+        part_path = os.path.join(DOWNLOAD_DIR, f"{key}.part")
+        logger.info("Downloading %s from %s", path, source)
+        try:
+            _download(source, part_path, path)
+            _install(part_path, path, compression, entry)
+        finally:
+            _progress.pop(path, None)
+    return path
+
+
+def ensure(paths, mirror: str | None = None):
+    """
+    Download the files of ``paths`` that are missing and in the manifest.
+
+    Files that are missing and not in the manifest are left alone, so the code
+    reading them reports the error as before.
+
+    Returns:
+        list: Paths that were downloaded.
+    """
+    manifest = load_manifest()
+    fetched = []
+    for path in paths:
+        if not os.path.exists(path) and path in manifest:
+            fetch(path, manifest[path], mirror)
+            fetched.append(path)
+    return fetched
+
+
+def file_sha256(file_path: str):
+    """SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify(path: str, entry: dict | None = None):
+    """
+    Check a file already on disk against its manifest entry.
+
+    Returns:
+        bool: Whether the checksum matches. Files without checksum fail.
+    """
+    if entry is None:
+        entry = load_manifest().get(path, {})
+    expected = entry.get("sha256")
+    return expected is not None and file_sha256(path) == expected
+
+
+def update_manifest(path: str, fields: dict, file_path: str = MANIFEST):
+    """Merge ``fields`` into the manifest entry of ``path`` and save it."""
+    manifest = load_manifest(file_path)
+    manifest.setdefault(path, {}).update(fields)
+    # Con checksum ya no hace falta la descarga sin verificar
+    manifest[path].pop("unverified", None)
+    tmp_path = f"{file_path}.tmp{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+    os.replace(tmp_path, file_path)
+
+
+def pack(path: str, out_dir: str):
+    """
+    Write a gzip copy of a file for a mirror and describe it for the manifest.
+
+    Returns:
+        dict: ``archive``, ``sha256`` and ``size`` of the entry.
+    """
+    archive = f"{os.path.basename(path)}.gz"
+    os.makedirs(out_dir, exist_ok=True)
+    out_path = os.path.join(out_dir, archive)
+    tmp_path = f"{out_path}.tmp{os.getpid()}"
+    with open(path, "rb") as src, gzip.open(tmp_path, "wb") as out:
+        while chunk := src.read(CHUNK_SIZE):
+            out.write(chunk)
+    os.replace(tmp_path, out_path)
+    return {
+        "archive": archive,
+        "sha256": file_sha256(path),
+        "size": os.path.getsize(path),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Descarga, verifica o empaqueta los ficheros de datos."
+    )
+    parser.add_argument("command", choices=["fetch", "verify", "pack"])
+    parser.add_argument("paths", nargs="*", help="por defecto, todo el manifiesto")
+    parser.add_argument("--mirror", help=f"por defecto {MIRROR_ENV}")
+    parser.add_argument("--out", default="mirror", help="directorio de pack")
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help=f"con pack, guarda el checksum y el tamaño en {MANIFEST}",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    manifest = load_manifest()
+    paths = args.paths or list(manifest)
+    status = 0
+    for path in paths:
+        if args.command == "fetch":
+            try:
+                ok = path in ensure([path], args.mirror) or os.path.exists(path)
+            except AssetError as e:
+                print(f"{path}: FAILED ({e})")
+                status = 1
+                continue
+            print(f"{path}: {'ok' if ok else 'not in the manifest'}")
+        elif args.command == "verify":
+            entry = manifest.get(path, {})
+            ok = os.path.exists(path) and verify(path, entry)
+            status = status or int(not ok)
+            if not entry.get("sha256"):
+                print(f"{path}: FAILED (no sha256 in {MANIFEST})")
+            else:
+                print(f"{path}: {'ok' if ok else 'FAILED'}")
+        else:
+            fields = pack(path, args.out)
+            if args.update:
+                update_manifest(path, fields)
+            print(json.dumps({path: fields}, indent=2))
+    sys.exit(status)
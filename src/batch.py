@@ -0,0 +1,500 @@
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+sys.path.append("./src/")
+from engine import RoutingEngine, get_engine
+from routes import STATION_WALK_THRESHOLD, pick_station_pair
+from snapshot import load_snapshot
+from utils import read_graph, snap_points
+
+MODES = ["walk", "bike", "valenbisi"]
+
+# Motores de cada proceso del pool, creados una vez por proceso
+_engines = {}
+_stations = None
+
+
+class BatchResult:
+    """
+    Columnar result of ``route_batch``.
+
+    Row ``i`` belongs to the ``i``-th origin-destination pair. Pairs without a
+    route have NaN distance and cost and an empty node sequence.
+
+    Attributes:
+        distance (ndarray): Length of every route in metres.
+        cost (ndarray): Sum of the weight band along every route.
+        trees (ndarray): Trees near the edges of every route (``num_arboles``).
+        offsets (ndarray): Route ``i`` is ``nodes[offsets[i]:offsets[i + 1]]``.
+        nodes (ndarray): OSM ids of the nodes of all routes, concatenated.
+        ini_station, end_station (ndarray): For Valenbisi, position of the
+            pick-up and drop-off stations in ``StationIndex.stations``, or -1.
+    """
+
+    def __init__(self, distance, cost, trees, offsets, nodes, stations=None):
+        self.distance = distance
+        self.cost = cost
+        self.trees = trees
+        self.offsets = offsets
+        self.nodes = nodes
+        if stations is not None:
+            self.ini_station, self.end_station = stations
+        else:
+            self.ini_station = self.end_station = None
+
+    def __len__(self):
+        return len(self.distance)
+
+    def route(self, i):
+        """Node ids of the route of pair ``i``."""
+        return self.nodes[self.offsets[i] : self.offsets[i + 1]]
+
+    def to_frame(self):
+        """
+        Get the per-pair columns as a DataFrame.
+
+        Returns:
+            DataFrame: ``distance``, ``cost``, ``trees``, ``n_nodes`` and, for
+            Valenbisi, ``ini_station`` and ``end_station``.
+        """
+        columns = {
+            "distance": self.distance,
+            "cost": self.cost,
+            "trees": self.trees,
+            "n_nodes": np.diff(self.offsets),
+        }
+        if self.ini_station is not None:
+            columns["ini_station"] = self.ini_station
+            columns["end_station"] = self.end_station
+        return pd.DataFrame(columns)
+
+    def save(self, file_path: str):
+        """Store all the columns in a ``.npz`` file."""
+        arrays = {
+            "distance": self.distance,
+            "cost": self.cost,
+            "trees": self.trees,
+            "offsets": self.offsets,
+            "nodes": self.nodes,
+        }
+        if self.ini_station is not None:
+            arrays["ini_station"] = self.ini_station
+            arrays["end_station"] = self.end_station
+        np.savez(file_path, **arrays)
+
+
+def _init_worker(snapshot_paths, stations):
+    global _stations
+    # Los arrays se mapean desde disco, así que los procesos comparten memoria
+    for name, path in snapshot_paths.items():
+        _engines[name] = RoutingEngine(load_snapshot(path))
+    _stations = stations
+
+
+def _route_groups(name, groups, weight):
+    """
+    Route several groups of pairs that share their origin.
+
+    Parameters:
+        name (str): Engine to use, ``"walk"`` or ``"bike"``.
+        groups (list): ``(source, targets, pair_ids)`` with node positions.
+        weight (str): Weight band.
+
+    Returns:
+        tuple: Pair ids and their cost, distance, trees, offsets and nodes.
+    """
+    engine = _engines[name]
+    snapshot = engine.snapshot
+    pair_ids = []
+    cost = []
+    paths = []
+    for source, targets, ids in groups:
+        for pair, result in zip(ids, engine.one_to_many(source, targets, weight)):
+            pair_ids.append(pair)
+            if result is None:
+                cost.append(np.nan)
+                paths.append([])
+            else:
+                cost.append(result[0])
+                paths.append(result[1])
+
+    sizes = np.array([len(p) for p in paths], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    flat = np.fromiter(
+        (v for p in paths for v in p), dtype=np.int64, count=int(offsets[-1])
+    )
+
+    # Todas las aristas del lote se buscan en una sola llamada. Las rutas
+    # vacías (pares sin camino) no tienen último nodo que marcar
+    is_edge = np.ones(len(flat), dtype=bool)
+    is_edge[offsets[1:][sizes > 0] - 1] = False
+    starts = np.flatnonzero(is_edge)
+    # De las aristas paralelas, la de menor peso: la que ha usado el motor
+    edges = snapshot.edge_index(flat[starts], flat[starts + 1], weight)
+    length = np.asarray(snapshot.weights["length"], dtype=np.float64)[edges]
+    arboles = np.asarray(snapshot.num_arboles, dtype=np.int64)[edges]
+    edge_offsets = np.concatenate(([0], np.cumsum(np.maximum(sizes - 1, 0))))
+    cum_length = np.concatenate(([0.0], np.cumsum(length)))
+    cum_arboles = np.concatenate(([0], np.cumsum(arboles)))
+    distance = cum_length[edge_offsets[1:]] - cum_length[edge_offsets[:-1]]
+    trees = cum_arboles[edge_offsets[1:]] - cum_arboles[edge_offsets[:-1]]
+    distance[sizes == 0] = np.nan
+
+    nodes = np.asarray(snapshot.node_ids)[flat]
+    return (
+        np.array(pair_ids, dtype=np.int64),
+        np.array(cost, dtype=np.float64),
+        distance,
+        trees,
+        offsets,
+        nodes,
+    )
+
+
+def _pick_stations(walk_starts, walk_ends, weight):
+    walk_nodes, bike_nodes, masks = _stations
+    pairs = []
+    for walk_start, walk_end in zip(walk_starts, walk_ends):
+        pair = pick_station_pair(
+            _engines["walk"],
+            _engines["bike"],
+            walk_nodes,
+            bike_nodes,
+            masks,
+            walk_start,
+            walk_end,
+            weight,
+        )
+        pairs.append(pair if pair is not None else (-1, -1))
+    return np.array(pairs, dtype=np.int64).reshape(-1, 2)
+
+
+def _split(items, n_chunks):
+    size = max(1, -(-len(items) // n_chunks))
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def _run_legs(name, sources, targets, weight, pool, n_chunks):
+    """Route ``sources[i] -> targets[i]`` grouping the pairs by origin."""
+    n = len(sources)
+    order = np.argsort(sources, kind="stable")
+    bounds = np.flatnonzero(np.diff(sources[order])) + 1
+    groups = [
+        (int(sources[ids[0]]), targets[ids].tolist(), ids.tolist())
+        for ids in np.split(order, bounds)
+        if len(ids)
+    ]
+
+    chunks = _split(groups, n_chunks)
+    if pool is None:
+        parts = [_route_groups(name, chunk, weight) for chunk in chunks]
+    else:
+        parts = list(
+            pool.map(
+                _route_groups,
+                [name] * len(chunks),
+                chunks,
+                [weight] * len(chunks),
+            )
+        )
+
+    cost = np.full(n, np.nan)
+    distance = np.full(n, np.nan)
+    trees = np.zeros(n, dtype=np.int64)
+    sizes = np.zeros(n, dtype=np.int64)
+    pieces = [None] * n
+    for pair_ids, c, d, t, offsets, nodes in parts:
+        cost[pair_ids] = c
+        distance[pair_ids] = d
+        trees[pair_ids] = t
+        sizes[pair_ids] = np.diff(offsets)
+        for k, pair in enumerate(pair_ids.tolist()):
+            pieces[pair] = nodes[offsets[k] : offsets[k + 1]]
+    return cost, distance, trees, sizes, pieces
+
+
+def _station_connectors(stations, walking_graph, cycling_graph):
+    """
+    Walks between every station and its cycling graph node, as in
+    ``get_valenbisi_route``.
+
+    Returns:
+        tuple: Walking graph node next to the cycling node of every station,
+        and whether the station is far enough from it to walk between them.
+    """
+    bike_snapshot = get_engine(cycling_graph).snapshot
+    pos = bike_snapshot.node_positions(stations.graph_nodes(cycling_graph))
+    lat = np.asarray(bike_snapshot.lat)[pos]
+    lon = np.asarray(bike_snapshot.lon)[pos]
+    points = stations.stations["geo_point_2d"]
+    station_lat = np.array([p["lat"] for p in points], dtype=np.float64)
+    station_lon = np.array([p["lon"] for p in points], dtype=np.float64)
+    needed = np.hypot(station_lat - lat, station_lon - lon) > STATION_WALK_THRESHOLD
+    nodes = np.array(snap_points(walking_graph, list(zip(lat.tolist(), lon.tolist()))))
+    return nodes, needed
+
+
+def _node_positions(graph, points):
+    snapshot = get_engine(graph).snapshot
+    return snapshot.node_positions(snap_points(graph, points))
+
+
+def route_batch(
+    origins,
+    destinations,
+    mode="walk",
+    band="length",
+    walking_graph=None,
+    cycling_graph=None,
+    stations=None,
+    workers=None,
+):
+    """
+    Route many origin-destination pairs at once.
+
+    All points are snapped in one pass per graph. Pairs that share their
+    origin node are solved with a single one-to-many Dijkstra, and the groups
+    are spread over a process pool. Workers map the graph snapshots from disk,
+    so the arrays are shared through the page cache instead of being copied.
+
+    Parameters:
+        origins (array-like): (lat, lon) of every origin.
+        destinations (array-like): (lat, lon) of every destination.
+        mode (str): ``"walk"``, ``"bike"`` or ``"valenbisi"``. Bike routes use
+            the cycling graph only. Valenbisi routes walk to the pick-up
+            station chosen by ``choose_stations``, cycle, and walk from the
+            drop-off station. Like ``get_valenbisi_route``, they include the
+            walks between a station and its cycling graph node.
+        band (str): ``"length"`` or one of the ``peso_*`` bands.
+        walking_graph: Walking graph returned by ``read_graph``.
+        cycling_graph: Cycling graph returned by ``read_graph``.
+        stations (StationIndex): Valenbisi stations, for ``"valenbisi"``.
+        workers (int): Worker processes. ``1`` runs everything in this process.
+
+    Returns:
+        BatchResult: Columnar result, one row per pair.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode: {mode}")
+    origins = [tuple(p) for p in np.asarray(origins, dtype=np.float64)]
+    destinations = [tuple(p) for p in np.asarray(destinations, dtype=np.float64)]
+    if len(origins) != len(destinations):
+        raise ValueError("origins and destinations must have the same length")
+
+    graphs = {}
+    if mode in ("walk", "valenbisi"):
+        graphs["walk"] = walking_graph
+    if mode in ("bike", "valenbisi"):
+        graphs["bike"] = cycling_graph
+    for name, graph in graphs.items():
+        if graph is None or get_engine(graph) is None:
+            raise ValueError(f"The {name} graph must be loaded from a snapshot")
+
+    station_data = connectors = None
+    if mode == "valenbisi":
+        if stations is None:
+            raise ValueError("Valenbisi routes need the stations")
+        station_data = (
+            stations.graph_nodes(walking_graph),
+            stations.graph_nodes(cycling_graph),
+            stations.masks,
+        )
+        connectors = _station_connectors(stations, walking_graph, cycling_graph)
+
+    workers = workers or os.cpu_count() or 1
+    paths = {name: get_engine(g).snapshot.path for name, g in graphs.items()}
+    pool = None
+    if workers > 1 and len(origins) > 1 and all(paths.values()):
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        pool = ProcessPoolExecutor(
+            workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(paths, station_data),
+        )
+    else:
+        global _stations
+        for name, graph in graphs.items():
+            _engines[name] = get_engine(graph)
+        _stations = station_data
+    n_chunks = 4 * workers
+
+    try:
+        if mode != "valenbisi":
+            graph = graphs[mode]
+            points = _node_positions(graph, origins + destinations)
+            n = len(origins)
+            cost, distance, trees, sizes, pieces = _run_legs(
+                mode, points[:n], points[n:], band, pool, n_chunks
+            )
+            nodes = np.concatenate([np.zeros(0, dtype=np.int64), *pieces])
+            offsets = np.concatenate(([0], np.cumsum(sizes)))
+            return BatchResult(distance, cost, trees, offsets, nodes)
+        return _valenbisi_batch(
+            origins,
+            destinations,
+            band,
+            graphs,
+            station_data,
+            connectors,
+            pool,
+            n_chunks,
+        )
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def _valenbisi_batch(
+    origins, destinations, band, graphs, station_data, connectors, pool, n
+):
+    walk_graph = graphs["walk"]
+    walk_snapshot = get_engine(walk_graph).snapshot
+    bike_snapshot = get_engine(graphs["bike"]).snapshot
+    walk_nodes, bike_nodes, _ = station_data
+    bike_walk_nodes, walk_needed = connectors
+
+    ends = snap_points(walk_graph, origins + destinations)
+    walk_starts, walk_ends = ends[: len(origins)], ends[len(origins) :]
+    chunks = list(zip(_split(walk_starts, n), _split(walk_ends, n)))
+    if pool is None:
+        parts = [_pick_stations(s, e, band) for s, e in chunks]
+    else:
+        parts = list(
+            pool.map(
+                _pick_stations,
+                [s for s, _ in chunks],
+                [e for _, e in chunks],
+                [band] * len(chunks),
+            )
+        )
+    chosen = np.concatenate(parts) if parts else np.zeros((0, 2), dtype=np.int64)
+    ok = np.flatnonzero((chosen >= 0).all(axis=1))
+    ini, end = chosen[ok, 0], chosen[ok, 1]
+    rows = np.arange(len(ok))
+    ini_walk = rows[walk_needed[ini]]
+    end_walk = rows[walk_needed[end]]
+
+    # (modo, filas de ok, origen, destino, es un tramo entre estación y red ciclista)
+    legs = [
+        (
+            "walk",
+            rows,
+            walk_snapshot.node_positions(np.asarray(walk_starts)[ok]),
+            walk_snapshot.node_positions(walk_nodes[ini]),
+            False,
+        ),
+        (
+            "walk",
+            ini_walk,
+            walk_snapshot.node_positions(walk_nodes[ini[ini_walk]]),
+            walk_snapshot.node_positions(bike_walk_nodes[ini[ini_walk]]),
+            True,
+        ),
+        (
+            "bike",
+            rows,
+            bike_snapshot.node_positions(bike_nodes[ini]),
+            bike_snapshot.node_positions(bike_nodes[end]),
+            False,
+        ),
+        (
+            "walk",
+            end_walk,
+            walk_snapshot.node_positions(bike_walk_nodes[end[end_walk]]),
+            walk_snapshot.node_positions(walk_nodes[end[end_walk]]),
+            True,
+        ),
+        (
+            "walk",
+            rows,
+            walk_snapshot.node_positions(walk_nodes[end]),
+            walk_snapshot.node_positions(np.asarray(walk_ends)[ok]),
+            False,
+        ),
+    ]
+
+    total = len(origins)
+    cost = np.full(total, np.nan)
+    distance = np.full(total, np.nan)
+    trees = np.zeros(total, dtype=np.int64)
+    sizes = np.zeros(total, dtype=np.int64)
+    pieces = [[] for _ in range(total)]
+    cost[ok] = 0.0
+    distance[ok] = 0.0
+    for name, leg_rows, sources, targets, connector in legs:
+        pairs = ok[leg_rows]
+        c, d, t, s, p = _run_legs(name, sources, targets, band, pool, n)
+        if connector:
+            # Como en get_valenbisi_route, un tramo sin camino no suma nada
+            c, d = np.nan_to_num(c), np.nan_to_num(d)
+        cost[pairs] += c
+        distance[pairs] += d
+        trees[pairs] += t
+        sizes[pairs] += s
+        for k, pair in enumerate(pairs.tolist()):
+            pieces[pair].append(p[k])
+
+    nodes = np.concatenate(
+        [np.zeros(0, dtype=np.int64), *(piece for pair in pieces for piece in pair)]
+    )
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    ini_station = np.full(total, -1, dtype=np.int64)
+    end_station = np.full(total, -1, dtype=np.int64)
+    ini_station[ok], end_station[ok] = ini, end
+    return BatchResult(
+        distance, cost, trees, offsets, nodes, (ini_station, end_station)
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Calcula rutas para muchos pares origen-destino a la vez."
+    )
+    parser.add_argument(
+        "pairs", help="CSV con columnas orig_lat, orig_lon, dest_lat y dest_lon"
+    )
+    parser.add_argument("output", help="fichero .npz de salida")
+    parser.add_argument("--mode", choices=MODES, default="walk")
+    parser.add_argument("--band", default="length", help="length o peso_X_Y")
+    parser.add_argument("--walking", default="data/valencia_walking_sombra.graphml")
+    parser.add_argument("--cycling", default="data/valencia_cycling_sombra.graphml")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    pairs = pd.read_csv(args.pairs)
+    walking_graph = cycling_graph = stations = None
+    if args.mode in ("walk", "valenbisi"):
+        walking_graph = read_graph(args.walking, view=True)
+    if args.mode in ("bike", "valenbisi"):
+        cycling_graph = read_graph(args.cycling, view=True)
+    if args.mode == "valenbisi":
+        from utils import StationIndex
+        from valenbisi import fetch_valenbisi_stations
+
+        stations = StationIndex(fetch_valenbisi_stations())
+
+    result = route_batch(
+        pairs[["orig_lat", "orig_lon"]].to_numpy(),
+        pairs[["dest_lat", "dest_lon"]].to_numpy(),
+        args.mode,
+        args.band,
+        walking_graph,
+        cycling_graph,
+        stations,
+        args.workers,
+    )
+    result.save(args.output)
+    routed = int(np.isfinite(result.distance).sum())
+    print(f"{args.output}: {routed}/{len(result)} rutas")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+import json
+import os
+import sys
+from heapq import heapify, heappop, heappush
+from itertools import pairwise
+
+import numpy as np
+
+CH_VERSION = 1
+CH_SUFFIX = ".ch"
+
+# Claves de meta.json del snapshot que identifican el grafo de origen
+_STAMP_KEYS = ["version", "n_nodes", "n_edges", "source_size", "source_mtime_ns"]
+
+
+class ContractionHierarchy:
+    """
+    Contraction hierarchy of one weight band, ready for queries.
+
+    ``up`` holds, for every node, the edges towards higher-ranked nodes in the
+    forward direction, and ``down`` the reversed edges coming from
+    higher-ranked nodes, both as ``(indptr, nodes, costs)`` lists. ``mids``
+    maps every shortcut ``(u, v)`` to the contracted node it skips.
+
+    Parameters:
+        arrays (dict): Arrays saved by ``build_hierarchy``.
+        node_ids (list): OSM id of every node position.
+    """
+
+    def __init__(self, arrays, node_ids):
+        self.node_ids = node_ids
+        self.up = (
+            arrays["up_indptr"].tolist(),
+            arrays["up_nodes"].tolist(),
+            arrays["up_costs"].tolist(),
+        )
+        self.down = (
+            arrays["down_indptr"].tolist(),
+            arrays["down_nodes"].tolist(),
+            arrays["down_costs"].tolist(),
+        )
+        self.mids = {}
+        for indptr, nodes, mids, forward in [
+            (self.up[0], self.up[1], arrays["up_mids"].tolist(), True),
+            (self.down[0], self.down[1], arrays["down_mids"].tolist(), False),
+        ]:
+            for v in range(len(indptr) - 1):
+                for i in range(indptr[v], indptr[v + 1]):
+                    if mids[i] >= 0:
+                        edge = (v, nodes[i]) if forward else (nodes[i], v)
+                        self.mids[edge] = mids[i]
+        self.last_visited = 0
+
+    def query(self, source, target):
+        """
+        Get the shortest path between two node positions.
+
+        The path has the same cost as the one found by plain Dijkstra, but
+        when several paths tie it may pick a different one.
+
+        Parameters:
+            source (int): Position of the origin node.
+            target (int): Position of the destination node.
+
+        Returns:
+            list: Node positions of the route, or None if there is no path.
+        """
+        if source == target:
+            self.last_visited = 1
+            return [source]
+
+        graphs = [self.up, self.down]
+        dists = [{source: 0.0}, {target: 0.0}]
+        parents = [{source: None}, {target: None}]
+        heaps = [[(0.0, source)], [(0.0, target)]]
+        best = float("inf")
+        meet = None
+        while heaps[0] or heaps[1]:
+            for side in (0, 1):
+                heap = heaps[side]
+                if not heap:
+                    continue
+                dist, v = heappop(heap)
+                if dist > dists[side][v]:
+                    continue
+                if dist >= best:
+                    # Ninguna ruta por este lado puede mejorar la encontrada
+                    heap.clear()
+                    continue
+                other = dists[1 - side].get(v)
+                if other is not None and dist + other < best:
+                    best, meet = dist + other, v
+
+                indptr, nodes, costs = graphs[side]
+                dist_side = dists[side]
+                for i in range(indptr[v], indptr[v + 1]):
+                    w = nodes[i]
+                    nd = dist + costs[i]
+                    if nd < dist_side.get(w, best):
+                        dist_side[w] = nd
+                        parents[side][w] = v
+                        heappush(heap, (nd, w))
+
+        self.last_visited = len(dists[0]) + len(dists[1])
+        if meet is None:
+            return None
+
+        chain = []
+        v = meet
+        while v is not None:
+            chain.append(v)
+            v = parents[0][v]
+        chain.reverse()
+        v = parents[1][meet]
+        while v is not None:
+            chain.append(v)
+            v = parents[1][v]
+
+        path = [chain[0]]
+        for u, v in pairwise(chain):
+            self._unpack(u, v, path)
+        return path
+
+    def _unpack(self, u, v, path):
+        """Append the original nodes of edge ``u -> v`` (without ``u``) to path."""
+        stack = [(u, v)]
+        while stack:
+            a, b = stack.pop()
+            mid = self.mids.get((a, b))
+            if mid is None:
+                path.append(b)
+            else:
+                stack.append((mid, b))
+                stack.append((a, mid))
+
+
+def hierarchy_path(snapshot, weight: str) -> str:
+    """File where the hierarchy of ``weight`` for a snapshot is stored."""
+    base = os.path.splitext(snapshot.path)[0] + CH_SUFFIX
+    return os.path.join(base, f"{weight}.npz")
+
+
+def build_hierarchy(engine, weight: str, settle_limit: int = 500):
+    """
+    Contract every node of a graph for one weight band.
+
+    Nodes are contracted in edge-difference order with lazy updates. Witness
+    searches stop after ``settle_limit`` settled nodes, which can only add
+    unnecessary shortcuts, never lose a shortest path.
+
+    Parameters:
+        engine (RoutingEngine): Engine of the graph to contract.
+        weight (str): ``"length"`` or one of the ``peso_*`` bands.
+        settle_limit (int): Maximum nodes settled by each witness search.
+
+    Returns:
+        dict: Arrays describing the hierarchy, as saved by ``save_hierarchy``.
+    """
+    (indptr, nbrs, costs), _ = engine.adjacency(weight)
+    n = len(indptr) - 1
+
+    # Grafo restante: nodo -> {vecino: (coste, nodo intermedio o -1)}
+    out_adj = [{} for _ in range(n)]
+    in_adj = [{} for _ in range(n)]
+    for u in range(n):
+        for i in range(indptr[u], indptr[u + 1]):
+            v = nbrs[i]
+            if v != u:
+                out_adj[u][v] = (costs[i], -1)
+                in_adj[v][u] = (costs[i], -1)
+    deleted = [0] * n
+
+    def witness(source, skip, targets, max_cost):
+        dist = {source: 0.0}
+        heap = [(0.0, source)]
+        remaining = set(targets)
+        settled = 0
+        while heap and remaining and settled < settle_limit:
+            d, x = heappop(heap)
+            if d > dist[x]:
+                continue
+            if d > max_cost:
+                break
+            remaining.discard(x)
+            settled += 1
+            for y, (c, _) in out_adj[x].items():
+                if y == skip:
+                    continue
+                nd = d + c
+                if nd < dist.get(y, float("inf")):
+                    dist[y] = nd
+                    heappush(heap, (nd, y))
+        return dist
+
+    def simulate(v):
+        shortcuts = []
+        outs = out_adj[v]
+        for u, (cu, _) in in_adj[v].items():
+            targets = [w for w in outs if w != u]
+            if not targets:
+                continue
+            max_cost = cu + max(outs[w][0] for w in targets)
+            dist = witness(u, v, targets, max_cost)
+            for w in targets:
+                via = cu + outs[w][0]
+                if dist.get(w, float("inf")) > via:
+                    shortcuts.append((u, w, via))
+        priority = len(shortcuts) - len(in_adj[v]) - len(out_adj[v]) + deleted[v]
+        return priority, shortcuts
+
+    heap = [(simulate(v)[0], v) for v in range(n)]
+    heapify(heap)
+    rank = [0] * n
+    up = [[] for _ in range(n)]
+    down = [[] for _ in range(n)]
+    order = 0
+    while heap:
+        _, v = heappop(heap)
+        priority, shortcuts = simulate(v)
+        if heap and priority > heap[0][0]:
+            heappush(heap, (priority, v))
+            continue
+
+        rank[v] = order
+        order += 1
+        for w, (c, mid) in out_adj[v].items():
+            up[v].append((w, c, mid))
+            del in_adj[w][v]
+            deleted[w] += 1
+        for u, (c, mid) in in_adj[v].items():
+            down[v].append((u, c, mid))
+            del out_adj[u][v]
+            deleted[u] += 1
+        out_adj[v] = {}
+        in_adj[v] = {}
+        for u, w, c in shortcuts:
+            if w not in out_adj[u] or c < out_adj[u][w][0]:
+                out_adj[u][w] = (c, v)
+                in_adj[w][u] = (c, v)
+
+    arrays = {"rank": np.array(rank, dtype=np.int32)}
+    for name, rows in [("up", up), ("down", down)]:
+        arrays[f"{name}_indptr"] = np.cumsum(
+            [0] + [len(row) for row in rows], dtype=np.int64
+        )
+        flat = [edge for row in rows for edge in row]
+        arrays[f"{name}_nodes"] = np.array([e[0] for e in flat], dtype=np.int32)
+        arrays[f"{name}_costs"] = np.array([e[1] for e in flat], dtype=np.float64)
+        arrays[f"{name}_mids"] = np.array([e[2] for e in flat], dtype=np.int32)
+    return arrays
+
+
+def save_hierarchy(arrays, snapshot, weight: str):
+    """
+    Store a hierarchy next to the graph files.
+
+    Parameters:
+        arrays (dict): Output of ``build_hierarchy``.
+        snapshot (GraphSnapshot): Snapshot the hierarchy was built from.
+        weight (str): Weight band of the hierarchy.
+
+    Returns:
+        str: Path of the written file.
+    """
+    file_path = hierarchy_path(snapshot, weight)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    meta = {"ch_version": CH_VERSION, "weight": weight}
+    meta.update({k: snapshot.meta.get(k) for k in _STAMP_KEYS})
+    tmp_path = f"{file_path}.tmp{os.getpid()}.npz"
+    np.savez(tmp_path, meta=np.array(json.dumps(meta)), **arrays)
+    os.replace(tmp_path, file_path)
+    return file_path
+
+
+def load_hierarchy(snapshot, weight: str):
+    """
+    Load the hierarchy of a weight band.
+
+    Parameters:
+        snapshot (GraphSnapshot): Snapshot of the graph to route on.
+        weight (str): Weight band.
+
+    Returns:
+        ContractionHierarchy: The hierarchy, or None if it was not built or was
+        built from a different version of the graph.
+    """
+    if snapshot.path is None:
+        return None
+    file_path = hierarchy_path(snapshot, weight)
+    if not os.path.exists(file_path):
+        return None
+    with np.load(file_path) as data:
+        meta = json.loads(str(data["meta"]))
+        if meta.get("ch_version") != CH_VERSION:
+            return None
+        if any(meta.get(k) != snapshot.meta.get(k) for k in _STAMP_KEYS):
+            return None
+        arrays = {name: data[name] for name in data.files if name != "meta"}
+    return ContractionHierarchy(arrays, snapshot.node_ids.tolist())
+
+
+if __name__ == "__main__":
+    # Uso: python src/ch.py data/valencia_cycling_sombra.graphml [...]
+    from engine import get_engine
+    from utils import read_graph
+
+    for path in sys.argv[1:]:
+        engine = get_engine(read_graph(path, view=True))
+        if engine is None:
+            sys.exit(f"No se ha podido crear el snapshot de {path}")
+        for weight in ["length", *engine.snapshot.meta.get("bands", [])]:
+            arrays = build_hierarchy(engine, weight)
+            out = save_hierarchy(arrays, engine.snapshot, weight)
+            print(f"{path} [{weight}] -> {out}")
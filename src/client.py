@@ -0,0 +1,76 @@
+class RoutingServiceError(Exception):
+    """Error answered by the routing service."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class RoutingClient:
+    """
+    Thin client of the routing service started with ``python src/service.py``.
+
+    Parameters:
+        base_url (str): Address of the service, e.g. ``http://127.0.0.1:8765``.
+        timeout (float): Seconds to wait for every response.
+    """
+
+    def __init__(self, base_url: str, timeout: float = 60):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        import requests
+
+        # Una sola sesión mantiene abierta la conexión con el servicio
+        self.session = requests.Session()
+
+    def _get(self, path, params):
+        response = self.session.get(
+            f"{self.base_url}{path}", params=params, timeout=self.timeout
+        )
+        try:
+            payload = response.json()
+        except ValueError:
+            payload = {"error": response.text}
+        if response.status_code != 200:
+            raise RoutingServiceError(response.status_code, payload.get("error"))
+        return payload
+
+    def route(self, start, end, mode="walk", temp=None, band=None):
+        """
+        Get a trip with its fountains and, for Valenbisi, its stations.
+
+        Parameters:
+            start (tuple): (lat, lon) start point.
+            end (tuple): (lat, lon) end point.
+            mode (str): ``"walk"``, ``"bike"`` or ``"valenbisi"``.
+            temp (float): Temperature to plan for. By default the service uses
+                the current one.
+            band (str): Edge weight to minimize. By default the band of ``temp``.
+
+        Returns:
+            dict: GeoJSON FeatureCollection, as built by ``trip_to_geojson``.
+        """
+        params = {
+            "start": f"{start[0]},{start[1]}",
+            "end": f"{end[0]},{end[1]}",
+            "mode": mode,
+        }
+        if temp is not None:
+            params["temp"] = temp
+        if band is not None:
+            params["band"] = band
+        return self._get("/route", params)
+
+    def nearest_fountains(self, points):
+        """Nearest fountain of every (lat, lon) point, as GeoJSON."""
+        return self._get(
+            "/fountains", {"points": ";".join(f"{lat},{lon}" for lat, lon in points)}
+        )
+
+    def valenbisi(self):
+        """Availability of every open Valenbisi station, as GeoJSON."""
+        return self._get("/valenbisi", {})
+
+    def metrics(self):
+        """Stage timings and counters of every request served, see ``/metrics``."""
+        return self._get("/metrics", {})
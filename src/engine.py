@@ -0,0 +1,432 @@
+from heapq import heappop, heappush
+from itertools import count
+
+import numpy as np
+
+from tracing import count as trace_count
+
+EARTH_RADIUS = 6_371_000  # metros
+
+
+class RoutingEngine:
+    """
+    Shortest-path engine over the CSR arrays of a ``GraphSnapshot``.
+
+    Parallel edges are collapsed to their minimum weight, and neighbours are
+    visited in the same order as the networkx graph built by
+    ``GraphSnapshot.to_graph``, so bidirectional Dijkstra returns exactly the
+    same node sequence as ``ox.shortest_path``.
+
+    Parameters:
+        snapshot (GraphSnapshot): Compiled graph to route on.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.node_ids = snapshot.node_ids.tolist()
+        self._csr = {}
+        self._scales = {}
+        self._hierarchies = {}
+
+    def adjacency(self, weight):
+        """
+        Forward and backward collapsed CSR lists for a weight array.
+
+        Returns:
+            tuple: ``(indptr, targets, costs)`` for successors and the same
+            for predecessors, as plain lists for fast scalar access.
+        """
+        if weight in self._csr:
+            trace_count("adjacency_cache_hit")
+            return self._csr[weight]
+        trace_count("adjacency_cache_miss")
+
+        snapshot = self.snapshot
+        n = snapshot.n_nodes
+        sources = snapshot.sources.tolist()
+        targets = snapshot.indices.tolist()
+        if weight in snapshot.weights:
+            costs = snapshot.weights[weight].astype(np.float64).tolist()
+        else:
+            # networkx asume peso 1 cuando falta el atributo
+            costs = [1] * snapshot.n_edges
+
+        succ = [{} for _ in range(n)]
+        pred = [{} for _ in range(n)]
+        for u, v, c in zip(sources, targets, costs):
+            if v not in succ[u] or c < succ[u][v]:
+                succ[u][v] = c
+            if u not in pred[v] or c < pred[v][u]:
+                pred[v][u] = c
+
+        def flatten(adj):
+            indptr = [0]
+            nbrs = []
+            weights = []
+            for row in adj:
+                nbrs.extend(row.keys())
+                weights.extend(row.values())
+                indptr.append(len(nbrs))
+            return indptr, nbrs, weights
+
+        self._csr[weight] = (flatten(succ), flatten(pred))
+        return self._csr[weight]
+
+    def _heuristic_scale(self, weight):
+        """Lower bound of cost per metre, so A* stays admissible for any band."""
+        if weight not in self._scales:
+            snapshot = self.snapshot
+            length = snapshot.weights["length"].astype(np.float64)
+            costs = snapshot.weights.get(weight)
+            if costs is None:
+                self._scales[weight] = 0.0
+            else:
+                mask = length > 0
+                ratio = costs.astype(np.float64)[mask] / length[mask]
+                scale = float(ratio.min()) if len(ratio) else 0.0
+                # Margen para el redondeo a float32 de las longitudes
+                self._scales[weight] = max(scale, 0.0) * (1 - 1e-6)
+        return self._scales[weight]
+
+    def hierarchy(self, weight):
+        """
+        Get the contraction hierarchy of a weight band, if it has been built.
+
+        Returns:
+            ContractionHierarchy: The hierarchy, or None.
+        """
+        if weight not in self._hierarchies:
+            from ch import load_hierarchy
+
+            self._hierarchies[weight] = load_hierarchy(self.snapshot, weight)
+        return self._hierarchies[weight]
+
+    def shortest_path(self, source, target, weight="length", method="bidirectional"):
+        """
+        Get the shortest path between two nodes.
+
+        Parameters:
+            source (int): OSM id of the origin node.
+            target (int): OSM id of the destination node.
+            weight (str): ``"length"`` or one of the ``peso_*`` bands.
+            method (str): ``"bidirectional"`` (Dijkstra, same result as
+                networkx), ``"astar"`` or ``"ch"`` (contraction hierarchy
+                built with ``ch.py``). The hierarchy is only used when asked
+                for: its routes cost the same, but may be a different path
+                when several tie.
+
+        Returns:
+            list: OSM ids of the nodes in the route, or None if there is no path.
+        """
+        s = self.snapshot.node_position(source)
+        t = self.snapshot.node_position(target)
+        if method == "ch":
+            hierarchy = self.hierarchy(weight)
+            if hierarchy is None:
+                raise ValueError(f"No contraction hierarchy built for {weight}")
+            route = hierarchy.query(s, t)
+            trace_count("nodes_visited", hierarchy.last_visited)
+        elif method == "bidirectional":
+            route = self._bidirectional_dijkstra(s, t, weight)
+        elif method == "astar":
+            route = self._astar(s, t, weight)
+        else:
+            raise ValueError(f"Unknown routing method: {method}")
+        if route is None:
+            return None
+        return [self.node_ids[i] for i in route]
+
+    def search(
+        self,
+        source,
+        weight="length",
+        targets=None,
+        k=None,
+        reverse=False,
+        max_settled=None,
+    ):
+        """
+        Dijkstra from one node until enough targets have been reached.
+
+        Parameters:
+            source (int): OSM id of the node to search from.
+            weight (str): ``"length"`` or one of the ``peso_*`` bands.
+            targets (iterable): OSM ids of the nodes of interest.
+            k (int): Stop after settling this many targets. Defaults to all.
+            reverse (bool): Follow edges backwards, giving the cost from each
+                target to ``source``.
+            max_settled (int): Stop after settling this many nodes.
+
+        Returns:
+            dict: Cost to every target reached, by OSM id.
+        """
+        forward, backward = self.adjacency(weight)
+        indptr, nbrs, costs = backward if reverse else forward
+        node_pos = self.snapshot.node_pos
+        targets = {node_pos[int(t)] for t in targets}
+        need = len(targets) if k is None else min(k, len(targets))
+
+        found = {}
+        s = node_pos[int(source)]
+        dist = {s: 0.0}
+        heap = [(0.0, s)]
+        settled = 0
+        while heap and len(found) < need:
+            d, v = heappop(heap)
+            if d > dist[v]:
+                continue
+            settled += 1
+            if v in targets:
+                found[self.node_ids[v]] = d
+            if max_settled is not None and settled >= max_settled:
+                break
+            for i in range(indptr[v], indptr[v + 1]):
+                w = nbrs[i]
+                nd = d + costs[i]
+                if nd < dist.get(w, float("inf")):
+                    dist[w] = nd
+                    heappush(heap, (nd, w))
+        trace_count("nodes_visited", settled)
+        return found
+
+    def one_to_many(self, source, targets, weight="length"):
+        """
+        Get the shortest paths from one node to several with a single Dijkstra.
+
+        Unlike the other methods, nodes are given and returned as positions in
+        the snapshot arrays, which is what batch callers work with.
+
+        Parameters:
+            source (int): Position of the origin node.
+            targets (list): Positions of the destination nodes.
+            weight (str): ``"length"`` or one of the ``peso_*`` bands.
+
+        Returns:
+            list: ``(cost, path)`` for every target, with ``path`` a list of
+            node positions, or None where the target cannot be reached.
+        """
+        (indptr, nbrs, costs), _ = self.adjacency(weight)
+        remaining = set(targets)
+        dist = {source: 0.0}
+        parent = {source: -1}
+        heap = [(0.0, source)]
+        while heap and remaining:
+            d, v = heappop(heap)
+            if d > dist[v]:
+                continue
+            remaining.discard(v)
+            for i in range(indptr[v], indptr[v + 1]):
+                w = nbrs[i]
+                nd = d + costs[i]
+                if nd < dist.get(w, float("inf")):
+                    dist[w] = nd
+                    parent[w] = v
+                    heappush(heap, (nd, w))
+
+        results = []
+        for t in targets:
+            if t in remaining:
+                results.append(None)
+                continue
+            path = []
+            v = t
+            while v != -1:
+                path.append(v)
+                v = parent[v]
+            path.reverse()
+            results.append((dist[t], path))
+        return results
+
+    def best_pair(self, sources, targets, weight="length"):
+        """
+        Find the cheapest way from any source to any target in a single search.
+
+        Every source starts with its own cost and every target adds its own
+        cost at the end, so the search minimises
+        ``sources[s] + path(s, t) + targets[t]`` over all pairs.
+
+        Parameters:
+            sources (dict): Start cost of each origin node, by OSM id.
+            targets (dict): End cost of each destination node, by OSM id.
+            weight (str): ``"length"`` or one of the ``peso_*`` bands.
+
+        Returns:
+            tuple: ``(source, target, cost)`` of the best pair, or None if no
+            target can be reached.
+        """
+        if not sources or not targets:
+            return None
+        (indptr, nbrs, costs), _ = self.adjacency(weight)
+        node_pos = self.snapshot.node_pos
+        ends = {node_pos[int(t)]: c for t, c in targets.items()}
+        min_end = min(ends.values())
+
+        dist = {}
+        origin = {}
+        heap = []
+        for node, cost in sources.items():
+            v = node_pos[int(node)]
+            if cost < dist.get(v, float("inf")):
+                dist[v] = cost
+                origin[v] = v
+                heappush(heap, (cost, v))
+
+        best = None
+        best_cost = float("inf")
+        while heap:
+            d, v = heappop(heap)
+            if d > dist[v]:
+                continue
+            if d + min_end >= best_cost:
+                # Ningún destino pendiente puede mejorar el mejor par
+                break
+            if v in ends and d + ends[v] < best_cost:
+                best, best_cost = (origin[v], v), d + ends[v]
+            for i in range(indptr[v], indptr[v + 1]):
+                w = nbrs[i]
+                nd = d + costs[i]
+                if nd < dist.get(w, float("inf")):
+                    dist[w] = nd
+                    origin[w] = origin[v]
+                    heappush(heap, (nd, w))
+        trace_count("nodes_reached", len(dist))
+        if best is None:
+            return None
+        return self.node_ids[best[0]], self.node_ids[best[1]], best_cost
+
+    def _bidirectional_dijkstra(self, source, target, weight):
+        if source == target:
+            return [source]
+        neighbors = self.adjacency(weight)
+
+        dists = [{}, {}]
+        preds = [{source: None}, {target: None}]
+        fringe = [[], []]
+        seen = [{source: 0}, {target: 0}]
+        c = count()
+        heappush(fringe[0], (0, next(c), source))
+        heappush(fringe[1], (0, next(c), target))
+
+        finaldist = None
+        meetnode = None
+        direction = 1
+        while fringe[0] and fringe[1]:
+            direction = 1 - direction
+            dist, _, v = heappop(fringe[direction])
+            if v in dists[direction]:
+                continue
+            dists[direction][v] = dist
+            if v in dists[1 - direction]:
+                # Cada inserción en las colas es una arista relajada
+                trace_count("nodes_visited", len(dists[0]) + len(dists[1]))
+                trace_count("edges_relaxed", next(c) - 2)
+                path = []
+                curr = meetnode
+                while curr is not None:
+                    path.append(curr)
+                    curr = preds[0][curr]
+                path.reverse()
+                curr = preds[1][meetnode]
+                while curr is not None:
+                    path.append(curr)
+                    curr = preds[1][curr]
+                return path
+
+            indptr, nbrs, costs = neighbors[direction]
+            dists_dir = dists[direction]
+            seen_dir = seen[direction]
+            seen_other = seen[1 - direction]
+            for i in range(indptr[v], indptr[v + 1]):
+                w = nbrs[i]
+                vw_length = dist + costs[i]
+                if w in dists_dir:
+                    if vw_length < dists_dir[w]:
+                        raise ValueError("Contradictory paths found: negative weights?")
+                elif w not in seen_dir or vw_length < seen_dir[w]:
+                    seen_dir[w] = vw_length
+                    heappush(fringe[direction], (vw_length, next(c), w))
+                    preds[direction][w] = v
+                    if w in seen_other:
+                        finaldist_w = vw_length + seen_other[w]
+                        if finaldist is None or finaldist > finaldist_w:
+                            finaldist, meetnode = finaldist_w, w
+        trace_count("nodes_visited", len(dists[0]) + len(dists[1]))
+        trace_count("edges_relaxed", next(c) - 2)
+        return None
+
+    def _astar(self, source, target, weight):
+        (indptr, nbrs, costs), _ = self.adjacency(weight)
+        scale = self._heuristic_scale(weight)
+
+        lat = np.radians(np.asarray(self.snapshot.lat, dtype=np.float64))
+        lon = np.radians(np.asarray(self.snapshot.lon, dtype=np.float64))
+        lat_t, lon_t = lat[target], lon[target]
+        cos_t = np.cos(lat_t)
+        cos_lat = np.cos(lat)
+
+        def heuristic(v):
+            a = (
+                np.sin((lat[v] - lat_t) / 2) ** 2
+                + cos_lat[v] * cos_t * np.sin((lon[v] - lon_t) / 2) ** 2
+            )
+            return scale * 2 * EARTH_RADIUS * np.arcsin(np.sqrt(min(a, 1.0)))
+
+        c = count()
+        queue = [(0.0, next(c), source, 0.0, None)]
+        enqueued = {}
+        explored = {}
+        while queue:
+            _, __, v, dist, parent = heappop(queue)
+            if v == target:
+                trace_count("nodes_visited", len(explored))
+                trace_count("edges_relaxed", next(c) - 1)
+                path = [v]
+                node = parent
+                while node is not None:
+                    path.append(node)
+                    node = explored[node]
+                path.reverse()
+                return path
+            if v in explored:
+                if explored[v] is None:
+                    continue
+                qcost, _ = enqueued[v]
+                if qcost < dist:
+                    continue
+            explored[v] = parent
+            for i in range(indptr[v], indptr[v + 1]):
+                w = nbrs[i]
+                ncost = dist + costs[i]
+                if w in enqueued:
+                    qcost, h = enqueued[w]
+                    if qcost <= ncost:
+                        continue
+                else:
+                    h = float(heuristic(w))
+                enqueued[w] = ncost, h
+                heappush(queue, (ncost + h, next(c), w, ncost, v))
+        trace_count("nodes_visited", len(explored))
+        trace_count("edges_relaxed", next(c) - 1)
+        return None
+
+
+def get_engine(graph):
+    """
+    Get the routing engine of a graph loaded from a snapshot.
+
+    The engine is created once and kept in ``graph.graph["engine"]``.
+
+    Parameters:
+        graph: Graph returned by ``read_graph``.
+
+    Returns:
+        RoutingEngine: The engine, or None if the graph has no snapshot.
+    """
+    engine = graph.graph.get("engine")
+    if engine is None:
+        snapshot = graph.graph.get("snapshot")
+        if snapshot is None:
+            return None
+        engine = RoutingEngine(snapshot)
+        graph.graph["engine"] = engine
+    return engine
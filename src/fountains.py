@@ -1,14 +1,337 @@
+import hashlib
+import json
+import os
+import sys
+from heapq import heappop, heappush
+
 import numpy as np
-from math import radians, sin, cos, sqrt, atan2
-from scipy.spatial import cKDTree
-import folium
 
+from routes import get_cumulative_distances, point_feature, print_points
+from tracing import count, traced
+
+METRIC_CRS = "EPSG:25830"
+FOUNTAIN_TABLE_SUFFIX = ".fountains.npz"
+
+# Claves de meta.json del snapshot que identifican el grafo de origen
+_STAMP_KEYS = ["version", "n_nodes", "n_edges", "source_size", "source_mtime_ns"]
+
+
+class FountainIndex:
+    """
+    Spatial index of the public fountains in projected metres.
+
+    Build it once when the fountains are loaded and reuse it for every route.
+
+    Parameters:
+        fuentes_publicas_gpd (GeoDataFrame): Public fountains with geometry column
+            in EPSG:4326. The ``x`` and ``y`` columns of ``load_public_fountains``
+            are used when present instead of reprojecting.
+    """
+
+    def __init__(self, fuentes_publicas_gpd):
+        from pyproj import Transformer
+        from scipy.spatial import cKDTree
+
+        self.ids = fuentes_publicas_gpd.index.to_numpy()
+        if "x" in fuentes_publicas_gpd and "y" in fuentes_publicas_gpd:
+            self.xy = fuentes_publicas_gpd[["x", "y"]].to_numpy(dtype=np.float64)
+        else:
+            proj = fuentes_publicas_gpd.to_crs(METRIC_CRS)
+            self.xy = np.column_stack([proj.geometry.x, proj.geometry.y])
+        self.tree = cKDTree(self.xy)
+        self._transformer = Transformer.from_crs(
+            "EPSG:4326", METRIC_CRS, always_xy=True
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def project(self, lat, lon):
+        """
+        Project EPSG:4326 coordinates to the metric CRS of the index.
+
+        Parameters:
+            lat (array-like): Latitudes in decimal degrees.
+            lon (array-like): Longitudes in decimal degrees.
+
+        Returns:
+            ndarray: (n, 2) array of x, y coordinates in meters.
+        """
+        x, y = self._transformer.transform(
+            np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+        )
+        return np.column_stack([np.atleast_1d(x), np.atleast_1d(y)])
+
+    @traced()
+    def query(self, lat, lon):
+        """
+        Find the nearest fountain to every given point in a single query.
+
+        Parameters:
+            lat (array-like): Latitudes of the points.
+            lon (array-like): Longitudes of the points.
+
+        Returns:
+            tuple: Fountain ids and distances in meters, as arrays.
+        """
+        if len(np.atleast_1d(lat)) == 0:
+            return self.ids[:0], np.empty(0)
+        dist, idx = self.tree.query(self.project(lat, lon), k=1)
+        return self.ids[idx], dist
+
+    def fingerprint(self):
+        """Hash of the fountain ids and positions, to detect dataset changes."""
+        digest = hashlib.sha1(np.ascontiguousarray(self.xy).tobytes())
+        digest.update(np.asarray(self.ids, dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
+
+class FountainTable:
+    """
+    Nearest fountain of every node of a graph, precomputed.
+
+    Arrays are indexed by the node position in the graph snapshot.
+
+    Attributes:
+        euclidean_id, euclidean_dist (ndarray): Nearest fountain in straight
+            line and its distance in meters.
+        network_id, network_dist (ndarray): Nearest fountain walking along the
+            network and its distance in meters (``inf`` if unreachable).
+    """
+
+    def __init__(self, arrays, meta):
+        self.euclidean_id = arrays["euclidean_id"]
+        self.euclidean_dist = arrays["euclidean_dist"]
+        self.network_id = arrays["network_id"]
+        self.network_dist = arrays["network_dist"]
+        self.meta = meta
+
+    def lookup(self, positions, network=False):
+        """
+        Gather the nearest fountain of several nodes.
+
+        Parameters:
+            positions (array-like): Node positions in the graph snapshot.
+            network (bool): Use walking-network distance instead of straight line.
+
+        Returns:
+            tuple: Fountain ids and distances in meters, as arrays.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        if network:
+            return self.network_id[positions], self.network_dist[positions]
+        return self.euclidean_id[positions], self.euclidean_dist[positions]
+
+
+def _multi_source_dijkstra(adjacency, n, seeds):
+    """
+    Dijkstra from several labelled sources at once.
+
+    Parameters:
+        adjacency (tuple): ``(indptr, nodes, costs)`` lists to expand.
+        n (int): Number of nodes.
+        seeds (dict): Node position to ``(initial distance, label)``.
+
+    Returns:
+        tuple: Distance and label of the closest source for every node.
+    """
+    indptr, nbrs, costs = adjacency
+    dist = [float("inf")] * n
+    label = [-1] * n
+    heap = []
+    for v, (d, lab) in seeds.items():
+        dist[v] = d
+        label[v] = lab
+        heappush(heap, (d, v))
+    while heap:
+        d, v = heappop(heap)
+        if d > dist[v]:
+            continue
+        for i in range(indptr[v], indptr[v + 1]):
+            w = nbrs[i]
+            nd = d + costs[i]
+            if nd < dist[w]:
+                dist[w] = nd
+                label[w] = label[v]
+                heappush(heap, (nd, w))
+    return np.array(dist), np.array(label, dtype=np.int64)
+
+
+def build_fountain_table(snapshot, fountain_index, network=None):
+    """
+    Compute the nearest fountain of every node of a graph.
+
+    The network distance is measured on the ``network`` graph (the walking
+    graph): each fountain is snapped to its closest network node and a single
+    multi-source Dijkstra is run backwards from all of them. Nodes of
+    ``snapshot`` are then matched to their closest network node.
+
+    Parameters:
+        snapshot (GraphSnapshot): Graph whose nodes get a fountain.
+        fountain_index (FountainIndex): Index of the public fountains.
+        network (RoutingEngine): Engine of the walking graph. Defaults to the
+            engine of ``snapshot`` itself.
+
+    Returns:
+        FountainTable: The table.
+    """
+    from engine import RoutingEngine
+
+    if network is None:
+        network = RoutingEngine(snapshot)
+    net = network.snapshot
+
+    node_xy = fountain_index.project(snapshot.lat, snapshot.lon)
+    euclidean_dist, idx = fountain_index.tree.query(node_xy, k=1)
 
+    from scipy.spatial import cKDTree
+
+    net_xy = fountain_index.project(net.lat, net.lon)
+    net_tree = cKDTree(net_xy)
+    snap_dist, snap_node = net_tree.query(fountain_index.xy, k=1)
+    seeds = {}
+    for f, (d, v) in enumerate(zip(snap_dist.tolist(), snap_node.tolist())):
+        if v not in seeds or d < seeds[v][0]:
+            seeds[v] = (d, f)
+    # Se expande por los predecesores: distancia de cada nodo hasta la fuente
+    _, pred = network.adjacency("length")
+    net_dist, net_label = _multi_source_dijkstra(pred, net.n_nodes, seeds)
+
+    offset, nearest_net = net_tree.query(node_xy, k=1)
+    network_dist = offset + net_dist[nearest_net]
+    network_label = net_label[nearest_net]
+    reachable = network_label >= 0
+
+    network_id = np.full(snapshot.n_nodes, -1, dtype=np.int64)
+    network_id[reachable] = np.asarray(fountain_index.ids, dtype=np.int64)[
+        network_label[reachable]
+    ]
+    arrays = {
+        "euclidean_id": np.asarray(fountain_index.ids, dtype=np.int64)[idx],
+        "euclidean_dist": euclidean_dist,
+        "network_id": network_id,
+        "network_dist": np.where(reachable, network_dist, np.inf),
+    }
+    meta = {"fountains": fountain_index.fingerprint()}
+    meta.update({k: snapshot.meta.get(k) for k in _STAMP_KEYS})
+    meta.update({f"network_{k}": net.meta.get(k) for k in _STAMP_KEYS})
+    return FountainTable(arrays, meta)
+
+
+def fountain_table_path(snapshot) -> str:
+    """File where the fountain table of a snapshot is stored."""
+    return os.path.splitext(snapshot.path)[0] + FOUNTAIN_TABLE_SUFFIX
+
+
+def save_fountain_table(table, snapshot):
+    """
+    Store a fountain table next to the graph files.
+
+    Returns:
+        str: Path of the written file.
+    """
+    file_path = fountain_table_path(snapshot)
+    tmp_path = f"{file_path}.tmp{os.getpid()}.npz"
+    np.savez(
+        tmp_path,
+        meta=np.array(json.dumps(table.meta)),
+        euclidean_id=table.euclidean_id,
+        euclidean_dist=table.euclidean_dist,
+        network_id=table.network_id,
+        network_dist=table.network_dist,
+    )
+    os.replace(tmp_path, file_path)
+    return file_path
+
+
+def load_fountain_table(snapshot, fountain_index, network=None):
+    """
+    Load the stored fountain table of a snapshot.
+
+    Parameters:
+        snapshot (GraphSnapshot): Graph the table belongs to.
+        fountain_index (FountainIndex): Current fountains.
+        network (GraphSnapshot): Graph the network distances were measured on.
+
+    Returns:
+        FountainTable: The table, or None if it is missing or was built from
+        other graphs or fountains.
+    """
+    if snapshot.path is None:
+        return None
+    file_path = fountain_table_path(snapshot)
+    if not os.path.exists(file_path):
+        return None
+    network = network or snapshot
+    with np.load(file_path) as data:
+        meta = json.loads(str(data["meta"]))
+        expected = {"fountains": fountain_index.fingerprint()}
+        expected.update({k: snapshot.meta.get(k) for k in _STAMP_KEYS})
+        expected.update({f"network_{k}": network.meta.get(k) for k in _STAMP_KEYS})
+        if any(meta.get(k) != v for k, v in expected.items()):
+            return None
+        arrays = {name: data[name] for name in data.files if name != "meta"}
+    return FountainTable(arrays, meta)
+
+
+@traced()
+def get_fountain_table(graph, fountain_index, network_graph=None):
+    """
+    Get the fountain table of a graph, loading or building it on first use.
+
+    The table is kept in ``graph.graph["fountain_table"]``.
+
+    Parameters:
+        graph: Graph returned by ``read_graph``.
+        fountain_index (FountainIndex): Index of the public fountains.
+        network_graph: Walking graph used for network distances. Defaults to
+            ``graph``.
+
+    Returns:
+        FountainTable: The table, or None if the graphs have no snapshot.
+    """
+    from engine import get_engine
+
+    table = graph.graph.get("fountain_table")
+    if table is not None:
+        count("fountain_table_cache_hit")
+        return table
+    count("fountain_table_cache_miss")
+    network_graph = network_graph if network_graph is not None else graph
+    snapshot = graph.graph.get("snapshot")
+    network = get_engine(network_graph)
+    if snapshot is None or network is None:
+        return None
+
+    table = load_fountain_table(snapshot, fountain_index, network.snapshot)
+    if table is None:
+        count("fountain_table_built")
+        table = build_fountain_table(snapshot, fountain_index, network)
+        if snapshot.path is not None:
+            try:
+                save_fountain_table(table, snapshot)
+            except OSError:
+                pass
+    graph.graph["fountain_table"] = table
+    return table
+
+
+@traced()
 def get_nearest_water_fountains_on_route(
-    graph, distancia, route_nodes, type_displacement, temperatura, fuentes_publicas_gpd
+    graph,
+    distancia,
+    route_nodes,
+    type_displacement,
+    temperatura,
+    fountain_index,
+    network=False,
+    cumulative=None,
 ):
     """
-    Find the nearest public water fountains along a given route, using pre-loaded fountain GeoDataFrame.
+    Find the nearest public water fountains along a given route, using pre-loaded fountain index.
+
+    When the graph has a fountain table (see ``get_fountain_table``) the
+    fountains are gathered from it instead of querying the index.
 
     Parameters:
         graph: The cycling network graph.
@@ -16,22 +339,15 @@ def get_nearest_water_fountains_on_route(
         route_nodes (list): A list of nodes representing the route.
         type_displacement (str): "Caminando", "En Bicicleta" or "En ValenBisi".
         temperatura (float): Current temperature in °C.
-        fuentes_publicas_gpd (GeoDataFrame): GeoDataFrame of public fountains with geometry column.
+        fountain_index (FountainIndex): Index of the public fountains.
+        network (bool): Measure the distance to the fountain walking along the
+            network instead of in straight line. Requires a fountain table.
+        cumulative (ndarray): Cumulative distance at each route node, as
+            returned by ``get_route(..., return_cumulative=True)``.
 
     Returns:
         list: A list of node IDs for fountains within max_distance of each stop point.
     """
-    fountain_nodes = fuentes_publicas_gpd.index.to_list()
-    fountain_coords = np.array([(pt.y, pt.x) for pt in fuentes_publicas_gpd.geometry])
-    tree = cKDTree(fountain_coords)
-
-    def haversine(a, b):
-        R = 6_371_000  # Earth radius in meters
-        lat1, lon1 = map(radians, a)
-        lat2, lon2 = map(radians, b)
-        dlat, dlon = lat2 - lat1, lon2 - lon1
-        u = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-        return 2 * R * atan2(sqrt(u), sqrt(1 - u))
 
     # Temperature-based stop frequency
     freq_config = {
@@ -67,49 +383,79 @@ def get_nearest_water_fountains_on_route(
         return [], 0
 
     d = distancia / n_paradas
-    resultados = []
 
-    d_accum = 0.0
-    parada = 1
+    if cumulative is None:
+        cumulative = get_cumulative_distances(route_nodes, graph)
 
-    for i in range(len(route_nodes) - 1):
-        edge_info = graph.get_edge_data(route_nodes[i], route_nodes[i + 1])
-        if not edge_info or "length" not in edge_info[0]:
-            continue
+    # Primera arista cuyo final alcanza cada múltiplo de d; la parada se hace
+    # en el nodo donde empieza esa arista. Como mucho hay una parada por
+    # arista: si varias caen en la misma, las siguientes se desplazan a las
+    # aristas posteriores (max acumulado de arista - k, más k)
+    k = np.arange(n_paradas)
+    umbrales = d * (k + 1)
+    aristas = np.searchsorted(cumulative[1:], umbrales, side="left")
+    aristas = np.maximum.accumulate(aristas - k) + k
+    aristas = aristas[aristas < len(route_nodes) - 1]
+    stops = [route_nodes[i] for i in aristas]
 
-        d_accum += edge_info[0]["length"]
-        if d_accum >= parada * d:
-            _, idx = tree.query(
-                [(graph.nodes[route_nodes[i]]["y"], graph.nodes[route_nodes[i]]["x"])],
-                k=1,
-            )
-            fountain_idx = fountain_nodes[idx[0]]
-            fountain_pt = fuentes_publicas_gpd.loc[fountain_idx].geometry
-            d_m = haversine(
-                (graph.nodes[route_nodes[i]]["y"], graph.nodes[route_nodes[i]]["x"]),
-                (fountain_pt.y, fountain_pt.x),
-            )
-            parada += 1
-            if d_m <= max_distance:
-                resultados.append(fountain_idx)
+    table = graph.graph.get("fountain_table")
+    if table is not None:
+        snapshot = graph.graph["snapshot"]
+        fountain_ids, d_m = table.lookup(
+            snapshot.node_positions(stops), network=network
+        )
+    else:
+        # Todas las paradas se consultan en el índice de una sola vez
+        lat = [graph.nodes[n]["y"] for n in stops]
+        lon = [graph.nodes[n]["x"] for n in stops]
+        fountain_ids, d_m = fountain_index.query(lat, lon)
+    resultados = fountain_ids[d_m <= max_distance].tolist()
 
     return resultados, n_paradas
 
 
+def fountain_features(fountains, public_fountains_gpd):
+    """
+    GeoJSON features of some public fountains.
+
+    Parameters:
+        fountains (list): List of fountain IDs.
+        public_fountains_gpd (GeoDataFrame): GeoDataFrame of public fountains with geometry column.
+
+    Returns:
+        list: Point features with ``kind`` ``"fountain"``, ``id`` and ``calle``.
+    """
+    rows = public_fountains_gpd.loc[list(fountains)]
+    return [
+        point_feature(pt.y, pt.x, {"kind": "fountain", "id": idx, "calle": str(calle)})
+        for idx, pt, calle in zip(fountains, rows.geometry, rows["calle"])
+    ]
+
+
+@traced()
 def print_fountains(fountains, public_fountains_gpd, map):
     """
-    Print the fountains on the map.
+    Print the fountains on the map, as a single GeoJSON layer.
 
     Parameters:
         fountains (list): List of fountain node IDs.
         public_fountains_gpd (GeoDataFrame): GeoDataFrame of public fountains with geometry column.
         map: The folium map to draw the fountains on.
     """
-    for idx in fountains:
-        calle = public_fountains_gpd.loc[idx, "calle"]
-        pt = public_fountains_gpd.loc[idx].geometry
-        folium.Marker(
-            location=(pt.y, pt.x),  # latitud, longitud
-            popup=f"Fuente calle {calle}",
-            icon=folium.Icon(color="blue", icon="tint", prefix="fa"),
-        ).add_to(map)
+    print_points(fountain_features(fountains, public_fountains_gpd), map)
+
+
+if __name__ == "__main__":
+    # Uso: python src/fountains.py data/valencia_walking_sombra.graphml [otros grafos]
+    # El primer grafo es la red peatonal con la que se miden las distancias.
+    from engine import get_engine
+    from utils import load_public_fountains, read_graph
+
+    fountain_index = FountainIndex(load_public_fountains("data/fonts_publiques.csv"))
+    graphs = [read_graph(path, view=True) for path in sys.argv[1:]]
+    for path, graph in zip(sys.argv[1:], graphs):
+        table = build_fountain_table(
+            graph.graph["snapshot"], fountain_index, get_engine(graphs[0])
+        )
+        out = save_fountain_table(table, graph.graph["snapshot"])
+        print(f"{path} -> {out}")
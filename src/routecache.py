@@ -0,0 +1,501 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from tracing import count as trace_count
+
+# Memoria máxima de la caché de rutas, en MB
+CACHE_ENV = "VALENFRESC_ROUTE_CACHE_MB"
+DEFAULT_MAX_MB = 32
+# Fichero SQLite donde las rutas sobreviven a los reinicios ("" lo desactiva)
+STORE_ENV = "VALENFRESC_ROUTE_STORE"
+# En data/ del repositorio, sea cual sea el directorio de trabajo
+DEFAULT_STORE = str(Path(__file__).resolve().parent.parent / "data" / "routes.sqlite")
+STORE_SIZE_ENV = "VALENFRESC_ROUTE_STORE_MB"
+DEFAULT_STORE_MB = 256
+# Bytes de cada fila además de los nodos, aproximadamente
+ROW_OVERHEAD = 96
+# Cada cuántas escrituras se vuelve a sumar el tamaño, por si escriben otros procesos
+RECOUNT_EVERY = 500
+# Aciertos que se acumulan en memoria antes de escribirlos en el fichero
+HITS_FLUSH_EVERY = 200
+# Clave, array y nodo del OrderedDict de cada entrada, aproximadamente
+ENTRY_OVERHEAD = 256
+
+MISSING = object()
+
+logger = logging.getLogger(__name__)
+
+
+def graph_id(graph):
+    """
+    Identify the version of a graph, to key cached routes with it.
+
+    Graphs loaded from a snapshot are identified by the GraphML they were
+    compiled from, so the id changes when the graph is rebuilt and is the same
+    in every process. Other graphs fall back to the object id.
+
+    The id is kept in ``graph.graph["graph_id"]``.
+
+    Returns:
+        str: The id.
+    """
+    key = graph.graph.get("graph_id")
+    if key is None:
+        snapshot = graph.graph.get("snapshot")
+        if snapshot is None:
+            key = f"object:{id(graph)}"
+        else:
+            stamp = {
+                k: snapshot.meta.get(k)
+                for k in [
+                    "version",
+                    "source",
+                    "source_size",
+                    "source_mtime_ns",
+                    "n_nodes",
+                    "n_edges",
+                ]
+            }
+            digest = hashlib.sha1(json.dumps(stamp, sort_keys=True).encode("utf-8"))
+            key = digest.hexdigest()[:16]
+        graph.graph["graph_id"] = key
+    return key
+
+
+class RouteCache:
+    """
+    Least recently used cache of routes, shared by every session of a process.
+
+    Routes are keyed by graph and snapped nodes, not by the clicked
+    coordinates, so two clicks that snap to the same nodes share an entry.
+    Node lists are stored as int64 arrays and the least recently used
+    entries are dropped once the stored routes take more than ``max_bytes``.
+
+    Parameters:
+        max_bytes (int): Memory budget of the cache. Defaults to
+            ``VALENFRESC_ROUTE_CACHE_MB`` megabytes, or 32.
+    """
+
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get(CACHE_ENV, DEFAULT_MAX_MB)) * 2**20)
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=MISSING):
+        """
+        Get a cached route and mark it as recently used.
+
+        Returns:
+            list: A new list with the node ids, None if the cached result is
+            that there is no route, or ``default`` if the key is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if entry is None:
+            trace_count("route_cache_miss")
+            return default
+        trace_count("route_cache_hit")
+        route = entry[0]
+        return None if route is None else route.tolist()
+
+    def put(self, key, route):
+        """
+        Store a route, evicting the least recently used ones if needed.
+
+        Parameters:
+            key (tuple): Cache key.
+            route (list): Node ids, or None when there is no route.
+        """
+        if route is not None:
+            route = np.asarray(route, dtype=np.int64)
+            route.setflags(write=False)
+        size = ENTRY_OVERHEAD + (0 if route is None else route.nbytes)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (route, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Entries, memory, hits, misses, evictions and hit rate."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+route_cache = RouteCache()
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS graphs (
+    id TEXT PRIMARY KEY,
+    source TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS routes (
+    graph TEXT NOT NULL,
+    band TEXT NOT NULL,
+    source INTEGER NOT NULL,
+    target INTEGER NOT NULL,
+    nodes BLOB,
+    distance REAL,
+    cost REAL,
+    size INTEGER NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    used REAL NOT NULL,
+    PRIMARY KEY (graph, band, source, target)
+);
+CREATE INDEX IF NOT EXISTS routes_used ON routes (used);
+"""
+
+
+def route_totals(graph, route, weight):
+    """
+    Distance and cost of a route, from the snapshot arrays of the graph.
+
+    Returns:
+        tuple: Metres and total ``weight`` of the route's edges.
+    """
+    snapshot = graph.graph["snapshot"]
+    if len(route) < 2:
+        return 0.0, 0.0
+    pos = snapshot.node_positions(route)
+    edges = snapshot.edge_index(pos[:-1], pos[1:])
+    edges = edges[edges >= 0]
+    distance = float(
+        np.asarray(snapshot.weights["length"], dtype=np.float64)[edges].sum()
+    )
+    costs = snapshot.weights.get(weight)
+    if costs is None:
+        # networkx cuenta 1 por arista cuando falta el peso
+        return distance, float(len(edges))
+    return distance, float(np.asarray(costs, dtype=np.float64)[edges].sum())
+
+
+class RouteStore:
+    """
+    Routes kept in a SQLite file, so a restart starts with a warm cache.
+
+    Every row holds the node ids of a route as an int64 blob together with
+    its distance and cost, keyed by the graph id (see ``graph_id``), weight
+    band and end nodes. When a graph is rebuilt its id changes, and the rows
+    of the previous version of the same GraphML are deleted the first time
+    the new one is used. Once the rows take more than ``max_bytes``, the
+    least recently used ones are deleted. Hits are counted in memory and
+    written in batches, so reads never wait for a commit.
+
+    Nothing is read from the environment or opened until the first use.
+
+    Errors of the database (read-only disk, locked file...) are logged and
+    disable the store, as the routes can always be computed again.
+
+    Parameters:
+        file_path (str): SQLite file. Defaults to ``VALENFRESC_ROUTE_STORE``,
+            or ``data/routes.sqlite`` in the repository; an empty value
+            disables the store.
+        max_bytes (int): Size budget of the rows. Defaults to
+            ``VALENFRESC_ROUTE_STORE_MB`` megabytes, or 256.
+    """
+
+    def __init__(self, file_path=None, max_bytes=None):
+        self.file_path = file_path
+        self.max_bytes = max_bytes
+        self.enabled = True
+        self._configured = False
+        self._conn = None
+        self._lock = threading.Lock()
+        self._graphs = {}
+        self._writes = 0
+        self._bytes = 0
+        self._pending_hits = {}
+        self._pending_count = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _ready(self):
+        """Read the configuration on first use. Returns whether it is enabled."""
+        if not self._configured:
+            if self.file_path is None:
+                self.file_path = os.environ.get(STORE_ENV, DEFAULT_STORE)
+            if self.max_bytes is None:
+                self.max_bytes = int(
+                    float(os.environ.get(STORE_SIZE_ENV, DEFAULT_STORE_MB)) * 2**20
+                )
+            self.enabled = self.enabled and bool(self.file_path)
+            self._configured = True
+        return self.enabled
+
+    def _connect(self):
+        if self._conn is None:
+            import sqlite3
+
+            os.makedirs(os.path.dirname(self.file_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.file_path, timeout=10, check_same_thread=False)
+            # Varios procesos pueden leer mientras otro escribe
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._bytes = self._total(conn)
+            self._conn = conn
+            # Los aciertos pendientes se guardan al salir
+            atexit.register(self._run, self._flush_at_exit)
+        return self._conn
+
+    def _run(self, func):
+        """Run ``func(conn)`` under the lock, disabling the store on errors."""
+        if not self._ready():
+            return None
+        import sqlite3
+
+        with self._lock:
+            try:
+                return func(self._connect())
+            except (sqlite3.Error, OSError) as e:
+                logger.warning("Route store %s disabled: %s", self.file_path, e)
+                self.enabled = False
+                return None
+
+    def _graph(self, graph):
+        """Id of a graph, registering it and dropping its stale routes."""
+        key = graph_id(graph)
+        if key in self._graphs:
+            return self._graphs[key]
+        snapshot = graph.graph.get("snapshot")
+        source = None if snapshot is None else snapshot.meta.get("source")
+        if source is None:
+            # Sin snapshot el id no es estable entre procesos
+            self._graphs[key] = None
+            return None
+
+        def register(conn):
+            with conn:
+                stale = [
+                    row[0]
+                    for row in conn.execute(
+                        "SELECT id FROM graphs WHERE source = ? AND id != ?",
+                        (source, key),
+                    )
+                ]
+                for old in stale:
+                    conn.execute("DELETE FROM routes WHERE graph = ?", (old,))
+                    conn.execute("DELETE FROM graphs WHERE id = ?", (old,))
+                conn.execute(
+                    "INSERT OR IGNORE INTO graphs (id, source) VALUES (?, ?)",
+                    (key, source),
+                )
+            if stale:
+                logger.info(
+                    "Dropped routes of %d old versions of %s", len(stale), source
+                )
+            return key
+
+        self._graphs[key] = self._run(register)
+        return self._graphs[key]
+
+    def get(self, graph, from_node, to_node, weight):
+        """
+        Get a stored route.
+
+        Returns:
+            list: Node ids, None if the stored result is that there is no
+            route, or ``MISSING``.
+        """
+        key = self._graph(graph) if self._ready() else None
+        if key is None:
+            return MISSING
+        args = (key, weight, int(from_node), int(to_node))
+
+        def select(conn):
+            row = conn.execute(
+                "SELECT nodes FROM routes"
+                " WHERE graph = ? AND band = ? AND source = ? AND target = ?",
+                args,
+            ).fetchone()
+            if row is not None:
+                hits, _ = self._pending_hits.get(args, (0, None))
+                self._pending_hits[args] = (hits + 1, time.time())
+                self._pending_count += 1
+                if self._pending_count >= HITS_FLUSH_EVERY:
+                    with conn:
+                        self._flush_hits(conn)
+            return row
+
+        row = self._run(select)
+        if row is None:
+            self.misses += 1
+            trace_count("route_store_miss")
+            return MISSING
+        self.hits += 1
+        trace_count("route_store_hit")
+        if row[0] is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.int64).tolist()
+
+    def put(self, graph, from_node, to_node, weight, route):
+        """Store a route, or None when there is no route between the nodes."""
+        key = self._graph(graph) if self._ready() else None
+        if key is None:
+            return
+        if route is None:
+            blob, distance, cost = None, None, None
+        else:
+            blob = np.asarray(route, dtype=np.int64).tobytes()
+            distance, cost = route_totals(graph, route, weight)
+        size = ROW_OVERHEAD + (0 if blob is None else len(blob))
+        row = (key, weight, int(from_node), int(to_node), blob, distance, cost)
+
+        def insert(conn):
+            with conn:
+                self._flush_hits(conn)
+                conn.execute(
+                    "INSERT OR REPLACE INTO routes"
+                    " (graph, band, source, target, nodes, distance, cost, size, used)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (*row, size, time.time()),
+                )
+            self._writes += 1
+            self._bytes += size
+            if self._writes % RECOUNT_EVERY == 0:
+                self._bytes = self._total(conn)
+            if self._bytes > self.max_bytes:
+                self._trim(conn)
+
+        self._run(insert)
+
+    def _flush_at_exit(self, conn):
+        with conn:
+            self._flush_hits(conn)
+
+    def _flush_hits(self, conn):
+        """Write the hits counted since the last flush, inside a transaction."""
+        if self._pending_hits:
+            conn.executemany(
+                "UPDATE routes SET hits = hits + ?, used = MAX(used, ?)"
+                " WHERE graph = ? AND band = ? AND source = ? AND target = ?",
+                [
+                    (hits, used, *args)
+                    for args, (hits, used) in self._pending_hits.items()
+                ],
+            )
+            self._pending_hits = {}
+            self._pending_count = 0
+
+    @staticmethod
+    def _total(conn):
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM routes").fetchone()[0]
+
+    def _trim(self, conn):
+        """Delete the least recently used rows until under ``max_bytes``."""
+        total = self._total(conn)
+        if total <= self.max_bytes:
+            self._bytes = total
+            return
+        # Se deja margen para no recortar en cada escritura
+        excess = total - int(0.9 * self.max_bytes)
+        freed = 0
+        rowids = []
+        for rowid, size in conn.execute("SELECT rowid, size FROM routes ORDER BY used"):
+            rowids.append((rowid,))
+            freed += size
+            if freed >= excess:
+                break
+        with conn:
+            conn.executemany("DELETE FROM routes WHERE rowid = ?", rowids)
+        self._bytes = total - freed
+        logger.info("Route store trimmed: %d routes, %d bytes", len(rowids), freed)
+
+    def warm(self, cache, graphs, limit=2000):
+        """
+        Load the most used routes of some graphs into a memory cache.
+
+        Parameters:
+            cache (RouteCache): Cache to fill.
+            graphs (list): Graphs whose routes are loaded.
+            limit (int): Maximum routes loaded.
+
+        Returns:
+            int: Routes loaded.
+        """
+        if not self._ready():
+            return 0
+        ids = [key for key in map(self._graph, graphs) if key is not None]
+        if not ids:
+            return 0
+
+        def select(conn):
+            return conn.execute(
+                "SELECT graph, band, source, target, nodes FROM routes"
+                f" WHERE graph IN ({', '.join('?' * len(ids))})"
+                " ORDER BY hits DESC, used DESC LIMIT ?",
+                (*ids, limit),
+            ).fetchall()
+
+        rows = self._run(select) or []
+        # Los menos usados primero, para que el LRU los descarte antes
+        for graph, band, source, target, nodes in reversed(rows):
+            route = None if nodes is None else np.frombuffer(nodes, dtype=np.int64)
+            cache.put(("route", graph, source, target, band), route)
+        return len(rows)
+
+    def stats(self):
+        """Stored routes and bytes, hits and misses of this process."""
+
+        def count_rows(conn):
+            return conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM routes"
+            ).fetchone()
+
+        routes, size = self._run(count_rows) or (0, 0)
+        return {
+            "enabled": self.enabled,
+            "routes": routes,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+route_store = RouteStore()
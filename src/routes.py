@@ -1,13 +1,197 @@
-import osmnx as ox
-import folium
-
 import sys
+from itertools import pairwise
+
+import numpy as np
 
 sys.path.append("./src/")
-from utils import get_nearest_station, get_distance
+from utils import StationIndex, get_distance, snap_points
+from engine import get_engine
+from routecache import MISSING, graph_id, route_cache, route_store
+from tracing import traced
+
+# Distancia (en grados) entre una estación y su nodo de la red ciclista a partir
+# de la cual se añade el tramo a pie entre ambos
+STATION_WALK_THRESHOLD = 0.0001
+# Metros por píxel en el ecuador con zoom 0 en Web Mercator
+WEB_MERCATOR_M_PER_PX = 156543.03392
+METERS_PER_DEGREE = 111_320
+
+
+def _euclidean(y1, x1, y2, x2):
+    # Igual que ox.distance.euclidean, sin importar osmnx
+    return ((x1 - x2) ** 2 + (y1 - y2) ** 2) ** 0.5
+
+
+@traced()
+def shortest_path(
+    graph,
+    from_node,
+    to_node,
+    weight="length",
+    use_engine=True,
+    use_cache=True,
+    method=None,
+):
+    """
+    Get the shortest path between two graph nodes.
+
+    Parameters:
+        graph: The network graph.
+        from_node (int): Origin node id.
+        to_node (int): Destination node id.
+        weight (str): Edge attribute to minimize.
+        use_engine (bool): Use the array-backed engine when the graph was
+            loaded from a snapshot, instead of ``ox.shortest_path``.
+        use_cache (bool): Look the route up in the shared ``route_cache``
+            and then in the ``route_store`` on disk, and store it in both
+            when computed by the engine.
+        method (str): Method of the engine, such as ``"ch"`` (see
+            ``RoutingEngine.shortest_path``). By default bidirectional
+            Dijkstra, which returns the same route as ``ox.shortest_path``.
+            Routes of other methods skip the caches, so cached routes are
+            always the Dijkstra ones.
+
+    Returns:
+        list: A list of nodes representing the route, or None if there is no path.
+    """
+    engine = get_engine(graph) if use_engine else None
+    if engine is not None:
+        if method is not None:
+            return engine.shortest_path(from_node, to_node, weight, method)
+        if not use_cache:
+            return engine.shortest_path(from_node, to_node, weight=weight)
+        key = ("route", graph_id(graph), int(from_node), int(to_node), weight)
+        route = route_cache.get(key)
+        if route is MISSING:
+            route = route_store.get(graph, from_node, to_node, weight)
+            if route is MISSING:
+                route = engine.shortest_path(from_node, to_node, weight=weight)
+                route_store.put(graph, from_node, to_node, weight, route)
+            route_cache.put(key, route)
+        return route
+    import osmnx as ox
+
+    if hasattr(graph, "to_networkx"):
+        # osmnx necesita el grafo de networkx completo
+        graph = graph.to_networkx()
+    return ox.shortest_path(graph, from_node, to_node, weight=weight)
+
+
+@traced()
+def get_cumulative_distances(route, graph):
+    """
+    Get the distance travelled at every node of a route.
+
+    Edge lengths are gathered from the graph snapshot in a single lookup when
+    available. Consecutive nodes without an edge length count the great-circle
+    distance between them.
+
+    Parameters:
+        route (list): List of nodes in the route.
+        graph: The graph containing the nodes.
+
+    Returns:
+        ndarray: Cumulative distance in meters at each node, starting at 0.
+    """
+    if len(route) < 2:
+        return np.zeros(len(route))
+
+    snapshot = graph.graph.get("snapshot")
+    if snapshot is not None:
+        pos = snapshot.node_positions(route)
+        edges = snapshot.edge_index(pos[:-1], pos[1:])
+        lengths = np.where(
+            edges >= 0,
+            np.asarray(snapshot.weights["length"], dtype=np.float64)[edges],
+            np.nan,
+        )
+        missing = np.isnan(lengths)
+        if missing.any():
+            lat = np.radians(np.asarray(snapshot.lat)[pos])
+            lon = np.radians(np.asarray(snapshot.lon)[pos])
+            a = (
+                np.sin(np.diff(lat) / 2) ** 2
+                + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+            )
+            haversine = 2 * 6371000 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+            lengths[missing] = haversine[missing]
+    else:
+        lengths = np.empty(len(route) - 1)
+        for i in range(len(route) - 1):
+            edge_data = graph.get_edge_data(route[i], route[i + 1])
+            if edge_data and "length" in edge_data[0]:
+                lengths[i] = edge_data[0]["length"]
+            else:
+                lengths[i] = get_distance(
+                    (graph.nodes[route[i]]["y"], graph.nodes[route[i]]["x"]),
+                    (graph.nodes[route[i + 1]]["y"], graph.nodes[route[i + 1]]["x"]),
+                )
+    return np.concatenate(([0.0], np.cumsum(lengths)))
+
+
+@traced()
+def route_coords(route, graph):
+    """
+    Get the coordinates of a route, following the geometry of its edges.
 
+    Parameters:
+        route (list): List of nodes in the route.
+        graph: The graph containing the nodes.
 
-def get_route(start, end, graph, range_temp="length"):
+    Returns:
+        ndarray: (lat, lon) of every point of the route line, in order.
+    """
+    if not route:
+        return np.zeros((0, 2))
+    if len(route) == 1:
+        node = graph.nodes[route[0]]
+        return np.array([[node["y"], node["x"]]])
+
+    snapshot = graph.graph.get("snapshot")
+    parts = []
+    if snapshot is not None:
+        pos = snapshot.node_positions(route)
+        edges = snapshot.edge_index(pos[:-1], pos[1:])
+        for u, v, edge in zip(pos[:-1], pos[1:], edges.tolist()):
+            if edge >= 0:
+                coords = snapshot.edge_coords(edge)
+            else:
+                coords = np.array(
+                    [
+                        [snapshot.lon[u], snapshot.lat[u]],
+                        [snapshot.lon[v], snapshot.lat[v]],
+                    ]
+                )
+            # El primer punto de cada arista repite el último de la anterior
+            parts.append(coords if not parts else coords[1:])
+    else:
+        for u, v in pairwise(route):
+            edge_data = graph.get_edge_data(u, v)
+            if edge_data and "geometry" in edge_data[0]:
+                coords = np.asarray(edge_data[0]["geometry"].coords)
+            else:
+                coords = np.array(
+                    [
+                        [graph.nodes[u]["x"], graph.nodes[u]["y"]],
+                        [graph.nodes[v]["x"], graph.nodes[v]["y"]],
+                    ]
+                )
+            parts.append(coords if not parts else coords[1:])
+    return np.concatenate(parts)[:, ::-1]
+
+
+@traced()
+def get_route(
+    start,
+    end,
+    graph,
+    range_temp="length",
+    use_engine=True,
+    return_cumulative=False,
+    from_node=None,
+    to_node=None,
+    method=None,
+):
     """
     Get the route between two nodes in the graph.
 
@@ -16,72 +200,350 @@ def get_route(start, end, graph, range_temp="length"):
         end: Tuple of coordinates for the end point.
         graph: The cycling network graph.
         range: Temperature range for obtaining edge weight.
+        use_engine (bool): Use the array-backed routing engine.
+        return_cumulative (bool): Also return the cumulative distance at each
+            node, to reuse it when placing the fountain stops.
+        from_node (int): Already snapped start node. When given, ``start`` is
+            not used.
+        to_node (int): Already snapped end node. When given, ``end`` is not used.
+        method (str): Routing method of the engine, passed to ``shortest_path``.
 
     Returns:
         list: A list of nodes representing the route.
     """
-    from_node = ox.distance.nearest_nodes(graph, start[1], start[0])
-    to_node = ox.distance.nearest_nodes(graph, end[1], end[0])
-    distancia = get_distance(start, end)
-    route = ox.shortest_path(graph, from_node, to_node, weight=range_temp)
+    if from_node is None and to_node is None:
+        from_node, to_node = snap_points(graph, [start, end])
+    elif from_node is None:
+        (from_node,) = snap_points(graph, [start])
+    elif to_node is None:
+        (to_node,) = snap_points(graph, [end])
+    route = shortest_path(
+        graph, from_node, to_node, range_temp, use_engine, method=method
+    )
     if not route:
-        return [], 0
-
-    distancia = 0
-    for i in range(len(route) - 1):
-        edge_data = graph.get_edge_data(route[i], route[i + 1])
-        if edge_data and "length" in edge_data[0]:
-            distancia += edge_data[0]["length"]
-        else:
-            distancia += get_distance(
-                (graph.nodes[route[i]]["y"], graph.nodes[route[i]]["x"]),
-                (graph.nodes[route[i + 1]]["y"], graph.nodes[route[i + 1]]["x"]),
-            )
+        return ([], 0, np.zeros(0)) if return_cumulative else ([], 0)
+
+    cumulative = get_cumulative_distances(route, graph)
+    distancia = float(cumulative[-1])
+    if return_cumulative:
+        return route, distancia, cumulative
     return route, distancia
 
 
-def print_route(route, graph, map, color="blue"):
+def zoom_tolerance(zoom, lat, pixels=1.0):
     """
-    Print the route on the map.
+    Get the ground size of a number of screen pixels at a web map zoom level.
+
+    Parameters:
+        zoom (int): Leaflet zoom level.
+        lat (float): Latitude where the size is measured.
+        pixels (float): Number of pixels.
+
+    Returns:
+        float: Size in meters.
+    """
+    return pixels * WEB_MERCATOR_M_PER_PX * np.cos(np.radians(lat)) / 2**zoom
+
+
+def simplify_coords(coords, tolerance):
+    """
+    Simplify a line with Douglas-Peucker, keeping its first and last points.
+
+    Parameters:
+        coords (ndarray): (lat, lon) of every point of the line.
+        tolerance (float): Maximum distance in meters between the simplified
+            line and the original one.
+
+    Returns:
+        ndarray: (lat, lon) of the points kept.
+    """
+    if len(coords) < 3 or not tolerance:
+        return coords
+    from shapely.geometry import LineString
+
+    # Coordenadas aproximadamente en metros alrededor de la línea
+    scale = np.array(
+        [METERS_PER_DEGREE, METERS_PER_DEGREE * np.cos(np.radians(coords[0, 0]))]
+    )
+    line = LineString(coords * scale).simplify(tolerance, preserve_topology=False)
+    return np.asarray(line.coords) / scale
+
+
+@traced()
+def print_route(route, graph, map, color="blue", zoom=None, pixels=1.0):
+    """
+    Print the route on the map as a single line.
+
+    The geometry of every edge is joined into one coordinate array, so the
+    map gets one layer per route instead of one per edge.
 
     Parameters:
         route (list): List of nodes in the route.
         graph: The graph containing the nodes.
         map: The folium map to draw the route on.
         color (str): Color of the route line on the map.
+        zoom (int): Zoom level the map is shown at. When given, points closer
+            than ``pixels`` screen pixels to the line are dropped.
+        pixels (float): Simplification tolerance, in pixels at ``zoom``.
     """
     if not route:
         print("No route found.")
         return
 
-    for i in range(len(route) - 1):
-        edge_data = graph.get_edge_data(route[i], route[i + 1])
-        if edge_data and "geometry" in edge_data[0]:
-            geom = edge_data[0]["geometry"]
-            folium.PolyLine(
-                locations=[(point[1], point[0]) for point in geom.coords],
-                color=color,
-                weight=5,
-            ).add_to(map)
-        else:
-            folium.PolyLine(
-                locations=[
-                    (
-                        graph.nodes[route[i]]["y"],
-                        graph.nodes[route[i]]["x"],
-                    ),
-                    (
-                        graph.nodes[route[i + 1]]["y"],
-                        graph.nodes[route[i + 1]]["x"],
-                    ),
-                ],
-                color=color,
-                weight=5,
-            ).add_to(map)
+    import folium
+
+    coords = route_coords(route, graph)
+    if zoom is not None:
+        coords = simplify_coords(
+            coords, zoom_tolerance(zoom, float(coords[0, 0]), pixels)
+        )
+    folium.PolyLine(locations=coords.tolist(), color=color, weight=5).add_to(map)
+
+
+def point_feature(lat, lon, properties):
+    """GeoJSON Point feature."""
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [float(lon), float(lat)]},
+        "properties": properties,
+    }
+
+
+def station_features(ini, end):
+    """
+    GeoJSON features of the pick-up and drop-off stations of a trip.
+
+    Parameters:
+        ini (Series): Row of the pick-up station.
+        end (Series): Row of the drop-off station.
+
+    Returns:
+        list: Two Point features with ``kind`` ``"station"`` and ``role``
+        ``"start"`` and ``"end"``.
+    """
+    features = []
+    for role, station in zip(["start", "end"], [ini, end]):
+        loc = station["geo_point_2d"]
+        properties = {
+            "kind": "station",
+            "role": role,
+            "available": int(station["available"]),
+            "free": int(station["free"]),
+        }
+        for key in ["number", "address"]:
+            if key in station:
+                properties[key] = str(station[key])
+        features.append(point_feature(loc["lat"], loc["lon"], properties))
+    return features
+
+
+# Icono de cada tipo de punto, con las opciones de folium.Icon
+MARKER_STYLES = {
+    "fountain": {"markerColor": "blue", "icon": "tint", "prefix": "fa"},
+    "start": {"markerColor": "green", "icon": "bicycle", "prefix": "fa"},
+    "end": {"markerColor": "red", "icon": "home", "prefix": "glyphicon"},
+}
+
+
+def _marker_popup(properties):
+    if properties["kind"] == "fountain":
+        return f"Fuente calle {properties['calle']}"
+    if properties["role"] == "start":
+        return (
+            f"Estación de Salida.<br>Bicicletas Disponibles: {properties['available']}"
+        )
+    return f"Estación de Llegada<br>Plazas Disponibles: {properties['free']}"
+
+
+@traced()
+def print_points(features, map, name="Paradas"):
+    """
+    Print fountains and Valenbisi stations on the map as a single GeoJSON layer.
+
+    Parameters:
+        features (list): Point features from ``station_features`` and
+            ``fountain_features``, or the points of ``trip_to_geojson``.
+        map: The folium map to draw the points on.
+        name (str): Name of the layer.
+    """
+    if not features:
+        return
+    import folium
+
+    features = [
+        {
+            **feature,
+            "properties": {
+                **feature["properties"],
+                "popup": _marker_popup(feature["properties"]),
+            },
+        }
+        for feature in features
+    ]
+
+    def style(feature):
+        properties = feature["properties"]
+        if properties["kind"] == "fountain":
+            return MARKER_STYLES["fountain"]
+        return MARKER_STYLES[properties["role"]]
+
+    folium.GeoJson(
+        {"type": "FeatureCollection", "features": features},
+        name=name,
+        marker=folium.Marker(icon=folium.Icon()),
+        style_function=style,
+        popup=folium.GeoJsonPopup(fields=["popup"], labels=False),
+    ).add_to(map)
 
 
+@traced()
+def choose_stations(
+    walk_start,
+    walk_end,
+    cycling_graph,
+    walking_graph,
+    stations,
+    range_temp="length",
+    k=3,
+    max_settled=20000,
+    use_cache=True,
+):
+    """
+    Choose the pick-up and drop-off stations of a Valenbisi trip by network cost.
+
+    One Dijkstra on the walking graph from the start finds the ``k`` cheapest
+    stations with bikes, and one backwards from the end the ``k`` cheapest
+    stations with free docks. A single search on the cycling graph from all
+    the pick-up candidates at once, seeded with their walking cost, then finds
+    the pair with the lowest walking + cycling + walking cost.
+
+    Parameters:
+        walk_start (int): Walking graph node of the start point.
+        walk_end (int): Walking graph node of the end point.
+        cycling_graph: The cycling network graph.
+        walking_graph: The walking network graph.
+        stations (StationIndex): Index of the Valenbisi stations.
+        range_temp (str): Edge weight to minimize.
+        k (int): Candidate stations considered at each end.
+        max_settled (int): Maximum nodes settled by each walking search.
+        use_cache (bool): Reuse the choice kept in the shared ``route_cache``
+            for the same nodes and availability.
+
+    Returns:
+        tuple: Positions of the pick-up and drop-off stations in
+        ``stations.stations``, or None if the graphs have no routing engine or
+        no pair of stations is reachable.
+    """
+    walk_engine = get_engine(walking_graph)
+    bike_engine = get_engine(cycling_graph)
+    if walk_engine is None or bike_engine is None:
+        return None
+    # La elección depende de la disponibilidad, así que cada versión tiene su clave
+    key = (
+        "stations",
+        graph_id(walking_graph),
+        graph_id(cycling_graph),
+        stations.availability_id,
+        int(walk_start),
+        int(walk_end),
+        range_temp,
+        k,
+        max_settled,
+    )
+    chosen = route_cache.get(key) if use_cache else MISSING
+    if chosen is MISSING:
+        chosen = pick_station_pair(
+            walk_engine,
+            bike_engine,
+            stations.graph_nodes(walking_graph),
+            stations.graph_nodes(cycling_graph),
+            stations.masks,
+            walk_start,
+            walk_end,
+            range_temp,
+            k,
+            max_settled,
+        )
+        if use_cache:
+            route_cache.put(key, chosen)
+    return None if chosen is None else tuple(chosen)
+
+
+def pick_station_pair(
+    walk_engine,
+    bike_engine,
+    walk_nodes,
+    bike_nodes,
+    masks,
+    walk_start,
+    walk_end,
+    range_temp="length",
+    k=3,
+    max_settled=20000,
+):
+    """
+    Engine-level part of ``choose_stations``, usable without the graphs.
+
+    Parameters:
+        walk_engine (RoutingEngine): Engine of the walking graph.
+        bike_engine (RoutingEngine): Engine of the cycling graph.
+        walk_nodes (ndarray): Walking graph node of every station.
+        bike_nodes (ndarray): Cycling graph node of every station.
+        masks (dict): ``"available"`` and ``"free"`` boolean station masks.
+        walk_start, walk_end, range_temp, k, max_settled: As in
+            ``choose_stations``.
+
+    Returns:
+        tuple: Positions of the pick-up and drop-off stations, or None.
+    """
+    pick = np.flatnonzero(masks["available"])
+    drop = np.flatnonzero(masks["free"])
+    if len(pick) == 0 or len(drop) == 0:
+        return None
+
+    # Varias estaciones pueden compartir el nodo más cercano
+    found = walk_engine.search(
+        walk_start, range_temp, walk_nodes[pick], k=k, max_settled=max_settled
+    )
+    pick_cost = {i: found[walk_nodes[i]] for i in pick if walk_nodes[i] in found}
+    found = walk_engine.search(
+        walk_end,
+        range_temp,
+        walk_nodes[drop],
+        k=k,
+        reverse=True,
+        max_settled=max_settled,
+    )
+    drop_cost = {j: found[walk_nodes[j]] for j in drop if walk_nodes[j] in found}
+
+    # Si varias estaciones caen en el mismo nodo se queda la más barata
+    pick_by_node = {}
+    for i, cost in sorted(pick_cost.items(), key=lambda item: -item[1]):
+        pick_by_node[int(bike_nodes[i])] = (i, cost)
+    drop_by_node = {}
+    for j, cost in sorted(drop_cost.items(), key=lambda item: -item[1]):
+        drop_by_node[int(bike_nodes[j])] = (j, cost)
+
+    pair = bike_engine.best_pair(
+        {node: cost for node, (_, cost) in pick_by_node.items()},
+        {node: cost for node, (_, cost) in drop_by_node.items()},
+        range_temp,
+    )
+    if pair is None:
+        return None
+    return int(pick_by_node[pair[0]][0]), int(drop_by_node[pair[1]][0])
+
+
+@traced()
 def get_valenbisi_route(
-    start, end, cycling_graph, walking_graph, valenbisi_stations, range_temp="length"
+    start,
+    end,
+    cycling_graph,
+    walking_graph,
+    valenbisi_stations,
+    range_temp="length",
+    use_engine=True,
+    network_stations=True,
 ):
     """
     Get the Valenbisi route from start to end using the cycling network graph.
@@ -91,9 +553,13 @@ def get_valenbisi_route(
         end(tuple): Tuple of coordinates for the end point.
         cycling_graph: The cycling network graph.
         walking_graph: The walking network graph.
-        valenbisi_stations(geoDataFrame): A GeoDataFrame containing Valenbisi stations.
+        valenbisi_stations(StationIndex): Index of the Valenbisi stations. A
+            GeoDataFrame of stations is also accepted and indexed on the fly.
         range: Temperature range for obtaining edge weight.
-
+        use_engine (bool): Use the array-backed routing engine.
+        network_stations (bool): Choose the stations by the cost of the whole
+            trip over the networks (see ``choose_stations``) instead of by
+            straight-line distance to the start and end points.
 
     Returns:
         tuple: A tuple containing three lists:
@@ -104,86 +570,139 @@ def get_valenbisi_route(
             - The nearest Valenbisi station to the end point.
     """
 
-    threshold = 0.0001
-
-    cycling_ini_node = ox.distance.nearest_nodes(cycling_graph, X=start[1], Y=start[0])
-
-    cycling_end_node = ox.distance.nearest_nodes(cycling_graph, X=end[1], Y=end[0])
+    if not isinstance(valenbisi_stations, StationIndex):
+        valenbisi_stations = StationIndex(valenbisi_stations)
 
-    ini_valenbisi_station = valenbisi_stations[
-        valenbisi_stations["available"] > 0
-    ].copy()
-    end_valenbisi_station = valenbisi_stations[valenbisi_stations["free"] > 0].copy()
+    walk_start, walk_end = snap_points(walking_graph, [start, end])
+    chosen = None
+    if network_stations:
+        chosen = choose_stations(
+            walk_start,
+            walk_end,
+            cycling_graph,
+            walking_graph,
+            valenbisi_stations,
+            range_temp,
+        )
 
-    ini_station = get_nearest_station(
-        (
-            cycling_graph.nodes[cycling_ini_node]["y"],
-            cycling_graph.nodes[cycling_ini_node]["x"],
-        ),
-        ini_valenbisi_station,
-    )
-    end_station = get_nearest_station(
-        (
-            cycling_graph.nodes[cycling_end_node]["y"],
-            cycling_graph.nodes[cycling_end_node]["x"],
-        ),
-        end_valenbisi_station,
-    )
+    if chosen is not None:
+        ini_pos, end_pos = chosen
+        ini_station = valenbisi_stations.station(ini_pos, start)
+        end_station = valenbisi_stations.station(end_pos, end)
+        walk_nodes = valenbisi_stations.graph_nodes(walking_graph)
+        bike_nodes = valenbisi_stations.graph_nodes(cycling_graph)
+        walk_ini_station = int(walk_nodes[ini_pos])
+        walk_end_station = int(walk_nodes[end_pos])
+        bike_ini_station = int(bike_nodes[ini_pos])
+        bike_end_station = int(bike_nodes[end_pos])
+    else:
+        cycling_ini_node, cycling_end_node = snap_points(cycling_graph, [start, end])
+        ini_station = valenbisi_stations.nearest_station(
+            (
+                cycling_graph.nodes[cycling_ini_node]["y"],
+                cycling_graph.nodes[cycling_ini_node]["x"],
+            ),
+            "available",
+        )
+        end_station = valenbisi_stations.nearest_station(
+            (
+                cycling_graph.nodes[cycling_end_node]["y"],
+                cycling_graph.nodes[cycling_end_node]["x"],
+            ),
+            "free",
+        )
 
     ini_station_loc = ini_station["geo_point_2d"]
     end_station_loc = end_station["geo_point_2d"]
+    ini_station_point = (ini_station_loc["lat"], ini_station_loc["lon"])
+    end_station_point = (end_station_loc["lat"], end_station_loc["lon"])
+
+    if chosen is None:
+        # Cada grafo se consulta una sola vez para todos los puntos del viaje
+        walk_ini_station, walk_end_station = snap_points(
+            walking_graph, [ini_station_point, end_station_point]
+        )
+        bike_ini_station, bike_end_station = snap_points(
+            cycling_graph, [ini_station_point, end_station_point]
+        )
 
     ini_walking_route, dist1 = get_route(
-        start,
-        (ini_station_loc["lat"], ini_station_loc["lon"]),
+        None,
+        None,
         walking_graph,
         range_temp,
+        use_engine,
+        from_node=walk_start,
+        to_node=walk_ini_station,
     )
     end_walking_route, dist2 = get_route(
-        (end_station_loc["lat"], end_station_loc["lon"]), end, walking_graph, range_temp
+        None,
+        None,
+        walking_graph,
+        range_temp,
+        use_engine,
+        from_node=walk_end_station,
+        to_node=walk_end,
     )
     cycling_route, dist3 = get_route(
-        (ini_station_loc["lat"], ini_station_loc["lon"]),
-        (end_station_loc["lat"], end_station_loc["lon"]),
+        None,
+        None,
         cycling_graph,
         range_temp,
+        use_engine,
+        from_node=bike_ini_station,
+        to_node=bike_end_station,
     )
 
-    dist_ini_station = ox.distance.euclidean(
+    dist_ini_station = _euclidean(
         ini_station_loc["lat"],
         ini_station_loc["lon"],
         cycling_graph.nodes[cycling_route[0]]["y"],
         cycling_graph.nodes[cycling_route[0]]["x"],
     )
 
-    dist_end_station = ox.distance.euclidean(
+    dist_end_station = _euclidean(
         end_station_loc["lat"],
         end_station_loc["lon"],
         cycling_graph.nodes[cycling_route[-1]]["y"],
         cycling_graph.nodes[cycling_route[-1]]["x"],
     )
 
-    if dist_ini_station > threshold:
-        inter_ini, d_aux = get_route(
-            (ini_station_loc["lat"], ini_station_loc["lon"]),
+    walk_ini_bike, walk_end_bike = snap_points(
+        walking_graph,
+        [
             (
                 cycling_graph.nodes[cycling_route[0]]["y"],
                 cycling_graph.nodes[cycling_route[0]]["x"],
             ),
+            (
+                cycling_graph.nodes[cycling_route[-1]]["y"],
+                cycling_graph.nodes[cycling_route[-1]]["x"],
+            ),
+        ],
+    )
+
+    if dist_ini_station > STATION_WALK_THRESHOLD:
+        inter_ini, d_aux = get_route(
+            None,
+            None,
             walking_graph,
             range_temp,
+            use_engine,
+            from_node=walk_ini_station,
+            to_node=walk_ini_bike,
         )
         ini_walking_route.extend(inter_ini)
         dist1 += d_aux
-    if dist_end_station > threshold:
+    if dist_end_station > STATION_WALK_THRESHOLD:
         inter_end, d_aux = get_route(
-            (
-                cycling_graph.nodes[cycling_route[-1]]["y"],
-                cycling_graph.nodes[cycling_route[-1]]["x"],
-            ),
-            (end_station_loc["lat"], end_station_loc["lon"]),
+            None,
+            None,
             walking_graph,
             range_temp,
+            use_engine,
+            from_node=walk_end_bike,
+            to_node=walk_end_station,
         )
         end_walking_route = inter_end + end_walking_route
         dist2 += d_aux
@@ -199,7 +718,10 @@ def get_valenbisi_route(
     )
 
 
-def get_cycling_route(start, end, cycling_graph, walking_graph, range_temp="length"):
+@traced()
+def get_cycling_route(
+    start, end, cycling_graph, walking_graph, range_temp="length", use_engine=True
+):
     """
     Get the mixed route from start to end using walking and cycling network graphs.
 
@@ -208,6 +730,7 @@ def get_cycling_route(start, end, cycling_graph, walking_graph, range_temp="leng
         end (tuple): (lat, lon) end point.
         cycling_graph: OSMnx cycling graph.
         walking_graph: OSMnx walking graph.
+        use_engine (bool): Use the array-backed routing engine.
 
     Returns:
         tuple:
@@ -219,40 +742,51 @@ def get_cycling_route(start, end, cycling_graph, walking_graph, range_temp="leng
             - distance of that walking route
     """
 
-    nodo_ini_bike = ox.distance.nearest_nodes(cycling_graph, X=start[1], Y=start[0])
-    nodo_end_bike = ox.distance.nearest_nodes(cycling_graph, X=end[1], Y=end[0])
+    nodo_ini_bike, nodo_end_bike = snap_points(cycling_graph, [start, end])
+    walk_start, walk_ini_bike, walk_end_bike, walk_end = snap_points(
+        walking_graph,
+        [
+            start,
+            (
+                cycling_graph.nodes[nodo_ini_bike]["y"],
+                cycling_graph.nodes[nodo_ini_bike]["x"],
+            ),
+            (
+                cycling_graph.nodes[nodo_end_bike]["y"],
+                cycling_graph.nodes[nodo_end_bike]["x"],
+            ),
+            end,
+        ],
+    )
 
     ini_walking_route, dist1 = get_route(
-        start,
-        (
-            cycling_graph.nodes[nodo_ini_bike]["y"],
-            cycling_graph.nodes[nodo_ini_bike]["x"],
-        ),
+        None,
+        None,
         walking_graph,
         range_temp,
+        use_engine,
+        from_node=walk_start,
+        to_node=walk_ini_bike,
     )
 
     cycling_route, dist2 = get_route(
-        (
-            cycling_graph.nodes[nodo_ini_bike]["y"],
-            cycling_graph.nodes[nodo_ini_bike]["x"],
-        ),
-        (
-            cycling_graph.nodes[nodo_end_bike]["y"],
-            cycling_graph.nodes[nodo_end_bike]["x"],
-        ),
+        None,
+        None,
         cycling_graph,
         range_temp,
+        use_engine,
+        from_node=nodo_ini_bike,
+        to_node=nodo_end_bike,
     )
 
     end_walking_route, dist3 = get_route(
-        (
-            cycling_graph.nodes[nodo_end_bike]["y"],
-            cycling_graph.nodes[nodo_end_bike]["x"],
-        ),
-        end,
+        None,
+        None,
         walking_graph,
         range_temp,
+        use_engine,
+        from_node=walk_end_bike,
+        to_node=walk_end,
     )
 
     return (
@@ -265,17 +799,6 @@ def get_cycling_route(start, end, cycling_graph, walking_graph, range_temp="leng
     )
 
 
+@traced()
 def print_stations(ini, end, map):
-    ini_station_loc = ini["geo_point_2d"]
-    end_station_loc = end["geo_point_2d"]
-    folium.Marker(
-        location=(ini_station_loc["lat"], ini_station_loc["lon"]),
-        popup=f"Estación de Salida.<br>Bicicletas Disponibles: {ini['available']}",
-        icon=folium.Icon(color="green", icon="bicycle", prefix="fa"),
-    ).add_to(map)
-
-    folium.Marker(
-        location=(end_station_loc["lat"], end_station_loc["lon"]),
-        popup=f"Estación de Llegada<br>Plazas Disponibles: {end['free']}",
-        icon=folium.Icon(color="red", icon="home"),
-    ).add_to(map)
+    print_points(station_features(ini, end), map)
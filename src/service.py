@@ -0,0 +1,396 @@
+import argparse
+import asyncio
+import json
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC
+from datetime import datetime as dt
+from urllib.parse import parse_qsl, urlsplit
+
+sys.path.append("./src/")
+import tracing
+from fountains import FountainIndex, get_fountain_table
+from routecache import route_cache, route_store
+from temperature import get_temperature_data
+from trips import get_band, plan_trip, trip_to_geojson
+from utils import load_public_fountains, read_graph
+from valenbisi import AvailabilityPoller
+
+DEFAULT_PORT = 8765
+MAX_REQUEST_LINE = 64 * 1024
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    422: "Unprocessable Entity",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceError(Exception):
+    """Error answered to the client with an HTTP status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _parse_point(value, name):
+    try:
+        lat, lon = (float(v) for v in value.split(","))
+    except (AttributeError, ValueError):
+        raise ServiceError(400, f"{name} must be 'lat,lon'")
+    return lat, lon
+
+
+class RoutingService:
+    """
+    Routing resources loaded once and shared by every request.
+
+    Parameters:
+        walking_path (str): GraphML of the walking network with shade weights.
+        cycling_path (str): GraphML of the cycling network with shade weights.
+        fountains_path (str): CSV of the public fountains.
+        poll_stations (bool): Keep the Valenbisi availability up to date.
+        trace_exports (list): Where the stage timings of every request go
+            (see ``tracing.finish``). Defaults to ``VALENFRESC_TRACE``, or
+            only the ``/metrics`` totals when it is not set.
+    """
+
+    def __init__(
+        self,
+        walking_path="data/valencia_walking_sombra.graphml",
+        cycling_path="data/valencia_cycling_sombra.graphml",
+        fountains_path="data/fonts_publiques.csv",
+        poll_stations=True,
+        trace_exports=None,
+    ):
+        if trace_exports is None:
+            trace_exports = tracing.default_exports() or ["metrics"]
+        self.trace_exports = trace_exports
+        self.walking_graph = read_graph(walking_path, view=True)
+        self.cycling_graph = read_graph(cycling_path, view=True)
+        self.fountains = load_public_fountains(fountains_path)
+        self.fountain_index = FountainIndex(self.fountains)
+        get_fountain_table(self.walking_graph, self.fountain_index)
+        get_fountain_table(self.cycling_graph, self.fountain_index, self.walking_graph)
+        route_store.warm(route_cache, [self.walking_graph, self.cycling_graph])
+        self.poller = AvailabilityPoller().start() if poll_stations else None
+
+    def _stations(self, timeout=30):
+        if self.poller is None:
+            raise ServiceError(503, "Valenbisi availability is disabled")
+        stations, version = self.poller.get(timeout=timeout)
+        if stations is None:
+            raise ServiceError(503, "Valenbisi availability is not available yet")
+        return stations, version
+
+    def route(self, query):
+        """
+        ``GET /route?start=lat,lon&end=lat,lon&mode=walk|bike|valenbisi``
+
+        Optional ``temp`` (°C), ``band`` (``peso_*`` or ``length``) and
+        ``format`` (``geojson``, the default, or ``json``).
+        """
+        start = _parse_point(query.get("start"), "start")
+        end = _parse_point(query.get("end"), "end")
+        mode = query.get("mode", "walk")
+        if "temp" in query:
+            try:
+                temp = float(query["temp"])
+            except ValueError:
+                raise ServiceError(400, "temp must be a number")
+        else:
+            temp = get_temperature_data(dt.now(tz=UTC))
+        band = query.get("band") or get_band(temp)
+
+        stations = None
+        if mode == "valenbisi":
+            stations, _ = self._stations()
+        try:
+            trip = plan_trip(
+                start,
+                end,
+                mode,
+                self.walking_graph,
+                self.cycling_graph,
+                self.fountain_index,
+                temp,
+                band,
+                stations,
+            )
+        except ValueError as e:
+            raise ServiceError(422, str(e))
+
+        if query.get("format", "geojson") == "json":
+            if trip["stations"] is not None:
+                trip["stations"] = [
+                    {
+                        "number": int(s["number"]) if "number" in s else None,
+                        "lat": s["geo_point_2d"]["lat"],
+                        "lon": s["geo_point_2d"]["lon"],
+                        "available": int(s["available"]),
+                        "free": int(s["free"]),
+                    }
+                    for s in trip["stations"]
+                ]
+            return "application/json", trip
+        return "application/geo+json", trip_to_geojson(
+            trip, self.walking_graph, self.cycling_graph, self.fountains
+        )
+
+    def nearest_fountains(self, query):
+        """
+        ``GET /fountains?points=lat,lon;lat,lon``
+
+        Nearest public fountain of every point, as GeoJSON.
+        """
+        points = [
+            _parse_point(p, "points") for p in query.get("points", "").split(";") if p
+        ]
+        if not points:
+            raise ServiceError(400, "points is required")
+        ids, dists = self.fountain_index.query(
+            [p[0] for p in points], [p[1] for p in points]
+        )
+        features = []
+        for idx, dist in zip(ids.tolist(), dists.tolist()):
+            pt = self.fountains.loc[idx].geometry
+            features.append(
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Point", "coordinates": [pt.x, pt.y]},
+                    "properties": {
+                        "id": idx,
+                        "calle": str(self.fountains.loc[idx, "calle"]),
+                        "distance": dist,
+                    },
+                }
+            )
+        return "application/geo+json", {
+            "type": "FeatureCollection",
+            "features": features,
+        }
+
+    def valenbisi(self, query):
+        """
+        ``GET /valenbisi``
+
+        Current availability of every open station, as GeoJSON.
+        """
+        stations, version = self._stations(timeout=float(query.get("wait", 30)))
+        features = []
+        for i, row in enumerate(stations.stations.itertuples(index=False)):
+            loc = row.geo_point_2d
+            features.append(
+                {
+                    "type": "Feature",
+                    "geometry": {
+                        "type": "Point",
+                        "coordinates": [loc["lon"], loc["lat"]],
+                    },
+                    "properties": {
+                        "number": int(getattr(row, "number", i)),
+                        "available": int(stations.available[i]),
+                        "free": int(stations.free[i]),
+                    },
+                }
+            )
+        return "application/geo+json", {
+            "type": "FeatureCollection",
+            "features": features,
+            "properties": {"version": version, "updated": self.poller.updated},
+        }
+
+    def health(self, query):
+        """``GET /health``"""
+        return "application/json", {"status": "ok"}
+
+    def metrics(self, query):
+        """
+        ``GET /metrics``
+
+        Calls, total, mean and maximum milliseconds of every traced stage and
+        the sum of every counter, over all the requests served, and the state
+        of the shared route cache and of the route store on disk.
+        """
+        return "application/json", {
+            **tracing.metrics.to_dict(),
+            "route_cache": route_cache.stats(),
+            "route_store": route_store.stats(),
+        }
+
+    def call(self, path, handler, query):
+        """Run a handler under a trace named after its path."""
+        if not self.trace_exports or path in ("/health", "/metrics"):
+            return handler(query)
+        with tracing.trace(path, self.trace_exports):
+            return handler(query)
+
+    def handlers(self):
+        return {
+            "/route": self.route,
+            "/fountains": self.nearest_fountains,
+            "/valenbisi": self.valenbisi,
+            "/health": self.health,
+            "/metrics": self.metrics,
+        }
+
+
+async def _read_request(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    if len(line) > MAX_REQUEST_LINE:
+        raise ServiceError(400, "Request line too long")
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise ServiceError(400, "Malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0) or 0)
+    body = await reader.readexactly(length) if length else b""
+    return method, target, version, headers, body
+
+
+def _response(status, content_type, payload, keep_alive):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    head = (
+        f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+        f"Content-Type: {content_type}; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        "\r\n"
+    )
+    return head.encode("latin-1") + body
+
+
+def make_handler(service, executor):
+    """
+    Build the asyncio connection handler of the service.
+
+    Requests are parsed on the event loop and computed in ``executor``, so a
+    slow route never stops the server from accepting other requests.
+    """
+    handlers = service.handlers()
+    loop = asyncio.get_running_loop()
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                keep_alive = False
+                try:
+                    request = await _read_request(reader)
+                    if request is None:
+                        break
+                    method, target, version, headers, body = request
+                    keep_alive = (
+                        version == "HTTP/1.1"
+                        and headers.get("connection", "").lower() != "close"
+                    )
+                    if method not in ("GET", "POST"):
+                        raise ServiceError(405, f"Method {method} not allowed")
+                    url = urlsplit(target)
+                    handler = handlers.get(url.path)
+                    if handler is None:
+                        raise ServiceError(404, f"Unknown path {url.path}")
+                    query = dict(parse_qsl(url.query))
+                    if body:
+                        data = json.loads(body)
+                        if not isinstance(data, dict):
+                            raise ServiceError(400, "The body must be a JSON object")
+                        query.update(data)
+                    content_type, payload = await loop.run_in_executor(
+                        executor, service.call, url.path, handler, query
+                    )
+                    status = 200
+                except ServiceError as e:
+                    status, content_type = e.status, "application/json"
+                    payload = {"error": str(e)}
+                except (ValueError, asyncio.IncompleteReadError) as e:
+                    status, content_type = 400, "application/json"
+                    payload = {"error": str(e)}
+                    keep_alive = False
+                except Exception as e:
+                    logger.exception("Error handling request")
+                    status, content_type = 500, "application/json"
+                    payload = {"error": str(e)}
+                writer.write(_response(status, content_type, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(service, host="127.0.0.1", port=DEFAULT_PORT, workers=4):
+    """
+    Run the HTTP service until it is cancelled.
+
+    Parameters:
+        service (RoutingService): Loaded resources.
+        host (str): Address to listen on.
+        port (int): Port to listen on.
+        workers (int): Requests computed at the same time.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        server = await asyncio.start_server(make_handler(service, executor), host, port)
+        logger.info("Listening on http://%s:%s", host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Servicio HTTP de rutas con sombra, fuentes y ValenBisi."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--walking", default="data/valencia_walking_sombra.graphml")
+    parser.add_argument("--cycling", default="data/valencia_cycling_sombra.graphml")
+    parser.add_argument("--fountains", default="data/fonts_publiques.csv")
+    parser.add_argument(
+        "--no-valenbisi",
+        action="store_true",
+        help="no consultar la disponibilidad de ValenBisi",
+    )
+    parser.add_argument(
+        "--trace",
+        help="destino de los tiempos por etapa de cada petición: log, metrics o "
+        "log,metrics (por defecto VALENFRESC_TRACE o metrics)",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    service = RoutingService(
+        args.walking,
+        args.cycling,
+        args.fountains,
+        not args.no_valenbisi,
+        args.trace.split(",") if args.trace is not None else None,
+    )
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.workers))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
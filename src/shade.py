@@ -0,0 +1,158 @@
+import argparse
+import ast
+import json
+
+import numpy as np
+import shapely
+
+from snapshot import TRAMOS
+
+RADIO = 15  # metros
+
+# Peso de la longitud y de la sombra para cada tramo de temperatura
+PESOS = {
+    (0, 5): (0.95, 0.05),
+    (5, 10): (0.90, 0.1),
+    (10, 15): (0.85, 0.15),
+    (15, 20): (0.70, 0.30),
+    (20, 25): (0.5, 0.5),
+    (25, 30): (0.35, 0.65),
+    (30, 35): (0.3, 0.7),
+    (35, 40): (0.25, 0.75),
+}
+
+
+def _parse_shape(value):
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return ast.literal_eval(value)
+
+
+def load_trees(file_path: str, sep: str = ";"):
+    """
+    Load the tree dataset of the Valencia open data portal.
+
+    Parameters:
+        file_path (str): Path to ``arbratge-arbolado.csv``.
+        sep (str): Column separator of the CSV.
+
+    Returns:
+        GeoDataFrame: Trees as points in EPSG:25830.
+    """
+    import geopandas as gpd
+    import pandas as pd
+
+    df = pd.read_csv(file_path, sep=sep)
+    shapes = df["geo_shape"].map(_parse_shape)
+    # Algunas exportaciones envuelven la geometría en un Feature
+    coords = np.array(
+        [s.get("geometry", s)["coordinates"] for s in shapes], dtype=np.float64
+    )
+    geometry = gpd.points_from_xy(coords[:, 0], coords[:, 1], crs="EPSG:4326")
+    gdf = gpd.GeoDataFrame(df, geometry=geometry)
+    return gdf.to_crs(epsg=25830)
+
+
+def count_trees(edges, trees, radio: float = RADIO):
+    """
+    Count the trees closer than ``radio`` metres to every edge.
+
+    All edges are queried against the tree STRtree in a single call. Trees at
+    exactly ``radio`` metres are not counted, as in the notebook.
+
+    Parameters:
+        edges (GeoSeries): Edge geometries in a metric CRS.
+        trees (GeoSeries): Tree points in the same CRS.
+        radio (float): Search radius in metres.
+
+    Returns:
+        ndarray: Number of nearby trees for each edge.
+    """
+    tree_index = shapely.STRtree(trees.values)
+    edge_idx, tree_idx = tree_index.query(
+        edges.values, predicate="dwithin", distance=radio
+    )
+    # dwithin incluye la distancia igual al radio; el cuaderno usa < radio
+    dist = shapely.distance(edges.values[edge_idx], trees.values[tree_idx])
+    return np.bincount(edge_idx[dist < radio], minlength=len(edges))
+
+
+def shade_weights(length, num_arboles):
+    """
+    Compute the ``peso_*`` attribute of every temperature band.
+
+    Parameters:
+        length (ndarray): Edge lengths in metres.
+        num_arboles (ndarray): Trees near each edge.
+
+    Returns:
+        dict: Band name to array of weights.
+    """
+    pesos = {}
+    for tramo in TRAMOS:
+        w_len, w_sombra = PESOS[tramo]
+        t_str = f"peso_{tramo[0]}_{tramo[1]}"
+        pesos[t_str] = w_len * length - w_sombra * num_arboles + 1000
+    return pesos
+
+
+def add_shade_weights(graph, trees, radio: float = RADIO):
+    """
+    Add ``num_arboles`` and the ``peso_*`` attributes to every edge of a graph.
+
+    Edges without a geometry are counted along the straight segment between
+    their projected nodes.
+
+    Parameters:
+        graph: Network graph as downloaded from OSMnx.
+        trees (GeoDataFrame): Trees, as returned by ``load_trees``.
+        radio (float): Search radius in metres.
+
+    Returns:
+        graph: The graph projected to EPSG:25830 with the new attributes.
+    """
+    import osmnx as ox
+
+    graph_proj = ox.project_graph(graph, to_crs="EPSG:25830")
+    edges = ox.graph_to_gdfs(graph_proj, nodes=False, fill_edge_geometry=True)
+
+    num_arboles = count_trees(edges.geometry, trees.to_crs(edges.crs).geometry, radio)
+    length = edges["length"].fillna(1).to_numpy(dtype=np.float64)
+    columns = {"num_arboles": num_arboles, **shade_weights(length, num_arboles)}
+
+    keys = edges.index.to_list()
+    values = {name: col.tolist() for name, col in columns.items()}
+    for i, (u, v, k) in enumerate(keys):
+        data = graph_proj.edges[u, v, k]
+        for name, col in values.items():
+            data[name] = col[i]
+    return graph_proj
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Calcula los pesos de sombra de un grafo a partir del arbolado."
+    )
+    parser.add_argument(
+        "graph", help="GraphML de la red (p. ej. valencia_walking_network.graphml)"
+    )
+    parser.add_argument("trees", help="CSV del arbolado (arbratge-arbolado.csv)")
+    parser.add_argument("output", help="GraphML de salida con los pesos de sombra")
+    parser.add_argument("--radio", type=float, default=RADIO, help="radio en metros")
+    parser.add_argument("--sep", default=";", help="separador del CSV del arbolado")
+    args = parser.parse_args(argv)
+
+    import osmnx as ox
+
+    graph = ox.load_graphml(args.graph)
+    trees = load_trees(args.trees, sep=args.sep)
+    graph_proj = add_shade_weights(graph, trees, radio=args.radio)
+    ox.save_graphml(graph_proj, args.output)
+    print(
+        f"{args.output}: {graph_proj.number_of_edges()} aristas, {len(trees)} árboles"
+    )
+
+
+if __name__ == "__main__":
+    main()
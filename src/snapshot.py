@@ -0,0 +1,499 @@
+import json
+import os
+import sys
+from contextlib import ExitStack, contextmanager
+
+import numpy as np
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_SUFFIX = ".snapshot"
+
+TRAMOS = [
+    (0, 5),
+    (5, 10),
+    (10, 15),
+    (15, 20),
+    (20, 25),
+    (25, 30),
+    (30, 35),
+    (35, 40),
+]
+WEIGHT_BANDS = [f"peso_{a}_{b}" for a, b in TRAMOS]
+
+
+class GraphSnapshot:
+    """
+    Array view of a shade graph, loaded from a compiled snapshot directory.
+
+    Nodes are addressed by their position in ``node_ids``. Edges are stored in
+    CSR order: the edges leaving node ``i`` are ``indptr[i]:indptr[i + 1]``,
+    with ``indices`` holding the target node positions.
+
+    Attributes:
+        node_ids (ndarray): OSM id of each node (int64).
+        lat, lon (ndarray): Node coordinates in EPSG:4326 (float64).
+        indptr (ndarray): CSR row pointer (int64, n_nodes + 1).
+        indices (ndarray): Target node position of each edge (int32).
+        keys (ndarray): MultiDiGraph key of each edge (int32).
+        weights (dict): ``"length"`` and every ``peso_*`` band as float32 arrays.
+        num_arboles (ndarray): Trees near each edge (int32).
+        geom_offsets (ndarray): Edge ``e`` geometry is
+            ``geom_coords[geom_offsets[e]:geom_offsets[e + 1]]`` (int64).
+        geom_coords (ndarray): (lon, lat) pairs of all edge geometries (float64).
+        meta (dict): Contents of ``meta.json``.
+        path (str): Snapshot directory the arrays were loaded from.
+    """
+
+    def __init__(self, arrays, meta, path=None):
+        self.node_ids = arrays["node_ids"]
+        self.lat = arrays["lat"]
+        self.lon = arrays["lon"]
+        self.indptr = arrays["indptr"]
+        self.indices = arrays["indices"]
+        self.keys = arrays["keys"]
+        self.num_arboles = arrays["num_arboles"]
+        self.geom_offsets = arrays["geom_offsets"]
+        self.geom_coords = arrays["geom_coords"]
+        self.weights = {"length": arrays["length"]}
+        for band in WEIGHT_BANDS:
+            if band in arrays:
+                self.weights[band] = arrays[band]
+        self.meta = meta
+        self.path = path
+        self._node_pos = None
+        self._sources = None
+        self._edge_codes = {}
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.indices)
+
+    @property
+    def sources(self):
+        """Source node position of each edge (int32), expanded from ``indptr``."""
+        if self._sources is None:
+            self._sources = np.repeat(
+                np.arange(self.n_nodes, dtype=np.int32), np.diff(self.indptr)
+            )
+        return self._sources
+
+    @property
+    def node_pos(self):
+        """Dict from OSM node id to array position."""
+        if self._node_pos is None:
+            self._node_pos = {n: i for i, n in enumerate(self.node_ids.tolist())}
+        return self._node_pos
+
+    def node_position(self, node_id):
+        """
+        Get the array position of an OSM node id.
+
+        Parameters:
+            node_id (int): OSM id of the node.
+
+        Returns:
+            int: Position of the node in the snapshot arrays.
+        """
+        return self.node_pos[int(node_id)]
+
+    def node_positions(self, node_ids):
+        """Array positions of several OSM node ids."""
+        node_pos = self.node_pos
+        return np.fromiter(
+            (node_pos[int(n)] for n in node_ids), dtype=np.int64, count=len(node_ids)
+        )
+
+    def edge_index(self, u, v, weight=None):
+        """
+        Find the edges joining pairs of nodes, all at once.
+
+        When several parallel edges join a pair, the one with the lowest key
+        is returned, like ``graph.get_edge_data(u, v)[0]``. With ``weight``,
+        the one with the lowest weight is returned instead, the first in CSR
+        order on ties: the edge ``RoutingEngine`` routes on.
+
+        Parameters:
+            u (array-like): Positions of the source nodes.
+            v (array-like): Positions of the target nodes.
+            weight (str): Weight band to choose parallel edges by.
+
+        Returns:
+            ndarray: Edge index for each pair, or -1 where there is no edge.
+        """
+        if weight not in self._edge_codes:
+            codes = self.sources.astype(np.int64) * self.n_nodes + self.indices
+            if weight is None:
+                order = np.lexsort((self.keys, codes))
+            else:
+                # Sin el atributo todas pesan lo mismo, como en RoutingEngine
+                costs = self.weights.get(weight, np.zeros(self.n_edges))
+                order = np.lexsort((np.arange(self.n_edges), costs, codes))
+            self._edge_codes[weight] = (codes[order], order)
+        codes, order = self._edge_codes[weight]
+        query = np.asarray(u, dtype=np.int64) * self.n_nodes + np.asarray(v)
+        pos = np.searchsorted(codes, query)
+        found = pos < len(codes)
+        found[found] = codes[pos[found]] == query[found]
+        return np.where(found, order[np.minimum(pos, len(codes) - 1)], -1)
+
+    def edge_coords(self, edge):
+        """
+        Get the (lon, lat) coordinates of an edge geometry.
+
+        Edges without geometry in the source graph fall back to the straight
+        segment between their end nodes.
+        """
+        start, end = self.geom_offsets[edge], self.geom_offsets[edge + 1]
+        if end > start:
+            return self.geom_coords[start:end]
+        u = self.sources[edge]
+        v = self.indices[edge]
+        return np.array([[self.lon[u], self.lat[u]], [self.lon[v], self.lat[v]]])
+
+    def to_graph(self):
+        """
+        Build the networkx graph the rest of the app works with.
+
+        Only the attributes used for routing and drawing are restored: node
+        ``x``/``y`` and edge ``length``, ``num_arboles``, ``peso_*`` and
+        ``geometry``. Every node and edge is copied into Python objects, so
+        this is the slow path: routing and the pages work on the arrays
+        directly (see ``SnapshotGraph``), and only callers that need
+        networkx or osmnx pay for it.
+
+        Returns:
+            MultiDiGraph: The graph in EPSG:4326, with this snapshot attached
+            as ``graph.graph["snapshot"]``.
+        """
+        import networkx as nx
+        import shapely
+
+        graph = nx.MultiDiGraph(crs="EPSG:4326", simplified=True, snapshot=self)
+        node_ids = self.node_ids.tolist()
+        graph.add_nodes_from(
+            (n, {"x": x, "y": y})
+            for n, x, y in zip(node_ids, self.lon.tolist(), self.lat.tolist())
+        )
+
+        counts = np.diff(self.geom_offsets)
+        has_geom = counts >= 2
+        geoms = np.full(self.n_edges, None, dtype=object)
+        if has_geom.any():
+            # Todas las geometrías se crean en una sola llamada a shapely
+            edge_of_row = np.repeat(np.arange(self.n_edges), counts)
+            keep = has_geom[edge_of_row]
+            part = np.cumsum(has_geom)[edge_of_row[keep]] - 1
+            geoms[has_geom] = shapely.linestrings(self.geom_coords[keep], indices=part)
+
+        sources = self.node_ids[self.sources].tolist()
+        targets = self.node_ids[self.indices].tolist()
+        columns = {name: values.tolist() for name, values in self.weights.items()}
+        columns["num_arboles"] = self.num_arboles.tolist()
+        names = list(columns)
+        rows = [dict(zip(names, values)) for values in zip(*columns.values())]
+        for e in np.flatnonzero(has_geom).tolist():
+            rows[e]["geometry"] = geoms[e]
+        # Una sola llamada a networkx para todas las aristas
+        graph.add_edges_from(zip(sources, targets, self.keys.tolist(), rows))
+        return graph
+
+
+class _NodeView:
+    """Read-only ``graph.nodes`` of a ``SnapshotGraph``."""
+
+    __slots__ = ("_snapshot",)
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    def __len__(self):
+        return self._snapshot.n_nodes
+
+    def __iter__(self):
+        return iter(self._snapshot.node_ids.tolist())
+
+    def __contains__(self, node):
+        try:
+            return int(node) in self._snapshot.node_pos
+        except (TypeError, ValueError):
+            return False
+
+    def __getitem__(self, node):
+        i = self._snapshot.node_position(node)
+        return {"x": float(self._snapshot.lon[i]), "y": float(self._snapshot.lat[i])}
+
+    def __call__(self, data=False):
+        node_ids = self._snapshot.node_ids.tolist()
+        if not data:
+            return iter(node_ids)
+        coords = zip(self._snapshot.lon.tolist(), self._snapshot.lat.tolist())
+        return zip(node_ids, ({"x": x, "y": y} for x, y in coords))
+
+
+class SnapshotGraph:
+    """
+    Read-only graph over the memory-mapped arrays of a ``GraphSnapshot``.
+
+    It offers the part of the networkx ``MultiDiGraph`` API the app uses
+    (``graph.graph``, ``graph.nodes[n]["x"]``, ``len``, iteration and
+    ``get_edge_data``) and reads node and edge data from the arrays when
+    asked. Nothing is copied into Python objects, so every process that
+    loads the same snapshot shares its pages through the page cache, and an
+    extra worker costs little more than its own caches.
+
+    Parameters:
+        snapshot (GraphSnapshot): Snapshot to expose.
+    """
+
+    def __init__(self, snapshot):
+        self.graph = {"crs": "EPSG:4326", "simplified": True, "snapshot": snapshot}
+        self.nodes = _NodeView(snapshot)
+        self._networkx = None
+
+    @property
+    def snapshot(self):
+        return self.graph["snapshot"]
+
+    def __len__(self):
+        return self.snapshot.n_nodes
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    def number_of_nodes(self):
+        return self.snapshot.n_nodes
+
+    def number_of_edges(self):
+        return self.snapshot.n_edges
+
+    def _edges_between(self, u, v):
+        snapshot = self.snapshot
+        try:
+            s = snapshot.node_position(u)
+            t = snapshot.node_position(v)
+        except (KeyError, TypeError, ValueError):
+            return np.empty(0, dtype=np.int64)
+        start, end = snapshot.indptr[s], snapshot.indptr[s + 1]
+        return start + np.flatnonzero(snapshot.indices[start:end] == t)
+
+    def has_edge(self, u, v):
+        return len(self._edges_between(u, v)) > 0
+
+    def edge_data(self, edge):
+        """Attributes of an edge, as ``to_graph`` stores them."""
+        import shapely
+
+        snapshot = self.snapshot
+        data = {name: float(values[edge]) for name, values in snapshot.weights.items()}
+        data["num_arboles"] = int(snapshot.num_arboles[edge])
+        start, end = snapshot.geom_offsets[edge], snapshot.geom_offsets[edge + 1]
+        if end - start >= 2:
+            data["geometry"] = shapely.LineString(snapshot.geom_coords[start:end])
+        return data
+
+    def get_edge_data(self, u, v, key=None, default=None):
+        """
+        Get the attributes of the edges from ``u`` to ``v``.
+
+        Returns:
+            dict: Attributes by edge key (or of ``key`` only, if given), or
+            ``default`` when there is no such edge.
+        """
+        edges = self._edges_between(u, v)
+        if len(edges) == 0:
+            return default
+        keys = self.snapshot.keys[edges]
+        data = {int(keys[i]): self.edge_data(edges[i]) for i in np.argsort(keys)}
+        if key is not None:
+            return data.get(key, default)
+        return data
+
+    def to_networkx(self):
+        """
+        Full networkx graph of the snapshot, built once, for osmnx functions.
+
+        It holds a private copy of every node and edge, so only use it when
+        the array-backed functions are not enough.
+        """
+        if self._networkx is None:
+            self._networkx = self.snapshot.to_graph()
+        return self._networkx
+
+
+def snapshot_path(file_path: str) -> str:
+    """Directory where the snapshot of ``file_path`` is stored."""
+    return os.path.splitext(file_path)[0] + SNAPSHOT_SUFFIX
+
+
+def _source_stamp(file_path):
+    stat = os.stat(file_path)
+    return {"source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns}
+
+
+def build_snapshot(graph, file_path: str, source_path: str | None = None):
+    """
+    Compile a loaded graph into a snapshot directory.
+
+    Parameters:
+        graph: Graph in EPSG:4326 as returned by ``read_graph``.
+        file_path (str): Snapshot directory to write.
+        source_path (str): GraphML file the graph was read from, used to detect
+            stale snapshots.
+
+    Returns:
+        str: The snapshot directory.
+    """
+    node_ids = np.fromiter(graph.nodes, dtype=np.int64, count=len(graph))
+    node_pos = {n: i for i, n in enumerate(node_ids.tolist())}
+    lat = np.array([graph.nodes[n]["y"] for n in node_ids.tolist()], dtype=np.float64)
+    lon = np.array([graph.nodes[n]["x"] for n in node_ids.tolist()], dtype=np.float64)
+
+    edges = list(graph.edges(keys=True, data=True))
+    src = np.array([node_pos[u] for u, _, _, _ in edges], dtype=np.int64)
+    order = np.argsort(src, kind="stable")
+    edges = [edges[i] for i in order]
+    src = src[order]
+
+    arrays = {
+        "node_ids": node_ids,
+        "lat": lat,
+        "lon": lon,
+        "indptr": np.concatenate(
+            ([0], np.cumsum(np.bincount(src, minlength=len(node_ids))))
+        ).astype(np.int64),
+        "indices": np.array([node_pos[v] for _, v, _, _ in edges], dtype=np.int32),
+        "keys": np.array([k for _, _, k, _ in edges], dtype=np.int32),
+        "length": np.array([d.get("length", 0.0) for *_, d in edges], dtype=np.float32),
+        "num_arboles": np.array(
+            [int(d.get("num_arboles", 0)) for *_, d in edges], dtype=np.int32
+        ),
+    }
+    bands = [b for b in WEIGHT_BANDS if all(b in d for *_, d in edges)]
+    for band in bands:
+        arrays[band] = np.array([float(d[band]) for *_, d in edges], dtype=np.float32)
+
+    coords = []
+    offsets = [0]
+    for *_, d in edges:
+        geom = d.get("geometry")
+        if geom is not None:
+            coords.extend(geom.coords)
+        offsets.append(len(coords))
+    arrays["geom_offsets"] = np.array(offsets, dtype=np.int64)
+    arrays["geom_coords"] = np.array(coords, dtype=np.float64).reshape(-1, 2)
+
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "crs": "EPSG:4326",
+        "n_nodes": len(node_ids),
+        "n_edges": len(edges),
+        "bands": bands,
+    }
+    if source_path is not None:
+        meta["source"] = os.path.basename(source_path)
+        meta.update(_source_stamp(source_path))
+
+    # Se escribe en un directorio temporal y se renombra para que un proceso
+    # concurrente nunca vea un snapshot a medias
+    tmp_path = f"{file_path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), values)
+    with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+
+    if os.path.isdir(file_path):
+        import shutil
+
+        shutil.rmtree(file_path)
+    os.replace(tmp_path, file_path)
+    return file_path
+
+
+@contextmanager
+def build_lock(file_path: str):
+    """
+    Hold an exclusive lock on a snapshot while it is being built.
+
+    When several processes start at once and the snapshot is missing, only
+    the first one parses the GraphML; the others wait here and then load the
+    snapshot it wrote. Without ``fcntl`` (Windows) or write access no lock is
+    taken.
+
+    Parameters:
+        file_path (str): Snapshot directory.
+    """
+    with ExitStack() as stack:
+        try:
+            import fcntl
+
+            lock = stack.enter_context(open(f"{file_path}.lock", "w"))
+        except (ImportError, OSError):
+            lock = None
+        if lock is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def load_snapshot(file_path: str, source_path: str | None = None):
+    """
+    Memory-map a snapshot directory.
+
+    Parameters:
+        file_path (str): Snapshot directory.
+        source_path (str): GraphML file the snapshot was built from. When it
+            exists and its size or modification time differ from the ones
+            recorded at build time, the snapshot is considered stale.
+
+    Returns:
+        GraphSnapshot: The snapshot, or None if it is missing or stale.
+    """
+    meta_path = os.path.join(file_path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("version") != SNAPSHOT_VERSION:
+        return None
+    if source_path is not None and os.path.exists(source_path):
+        stamp = _source_stamp(source_path)
+        if any(meta.get(k) != v for k, v in stamp.items()):
+            return None
+
+    names = [
+        "node_ids",
+        "lat",
+        "lon",
+        "indptr",
+        "indices",
+        "keys",
+        "length",
+        "num_arboles",
+        "geom_offsets",
+        "geom_coords",
+        *meta.get("bands", []),
+    ]
+    arrays = {
+        name: np.load(os.path.join(file_path, f"{name}.npy"), mmap_mode="r")
+        for name in names
+    }
+    return GraphSnapshot(arrays, meta, path=file_path)
+
+
+if __name__ == "__main__":
+    # Uso: python src/snapshot.py data/valencia_cycling_sombra.graphml [...]
+    from utils import read_graph
+
+    for path in sys.argv[1:]:
+        graph = read_graph(path, use_snapshot=False)
+        out = build_snapshot(graph, snapshot_path(path), source_path=path)
+        print(
+            f"{path} -> {out} ({len(graph)} nodos, {graph.number_of_edges()} aristas)"
+        )
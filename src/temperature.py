@@ -1,62 +1,159 @@
-import openmeteo_requests
-
-import pandas as pd
-import requests_cache
-from retry_requests import retry
-
+import logging
+import threading
+import time
+from datetime import UTC
 from datetime import datetime as dt
 
+import numpy as np
 
-def get_temperature_data(now: dt) -> int:
-    """
-    Fetches temperature data for a specific day using the Open-Meteo API.
-
-    Parameters:
-        day (datetime): The date for which to fetch temperature data in 'YYYY-MM-DD' format.
-
-    Returns:
-        int: The temperature in degrees Celsius for the specified day at the current hour.
-    """
+from tracing import count, traced
 
-    # Setup the Open-Meteo API client with cache and retry on error
-    cache_session = requests_cache.CachedSession(".cache", expire_after=3600)
-    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+VALENCIA = (39.4739, -0.3797)
+REFRESH_INTERVAL = 3600  # segundos
 
-    # Make sure all required weather variables are listed here
-    # The order of variables in hourly or daily is important to assign them correctly below
-    url = "https://api.open-meteo.com/v1/forecast"
-    params = {
-        "latitude": 39.4739,
-        "longitude": -0.3797,
-        "hourly": "temperature_2m",
-        "start_date": now.strftime("%Y-%m-%d"),
-        "end_date": now.strftime("%Y-%m-%d"),
-    }
-    responses = openmeteo.weather_api(url, params=params)
+logger = logging.getLogger(__name__)
 
-    # Process first location. Add a for-loop for multiple locations or weather models
-    response = responses[0]
 
-    # Process hourly data. The order of variables needs to be the same as requested.
-    hourly = response.Hourly()
-    hourly_temperature_2m = hourly.Variables(0).ValuesAsNumpy()
+class TemperatureProvider:
+    """
+    Hourly temperature forecast kept in memory.
 
-    hourly_data = {
-        "date": pd.date_range(
-            start=pd.to_datetime(hourly.Time(), unit="s", utc=True),
-            end=pd.to_datetime(hourly.TimeEnd(), unit="s", utc=True),
-            freq=pd.Timedelta(seconds=hourly.Interval()),
-            inclusive="left",
-        )
-    }
+    One request fetches several days of hourly temperatures, stored as an
+    array indexed by hour, so every lookup is a subtraction and a division.
+    Once the forecast is older than ``max_age`` the next lookup starts a
+    refresh in the background and keeps answering from the current one. If
+    the API cannot be reached the last known forecast stays in use.
 
-    hourly_data["temperature_2m"] = hourly_temperature_2m
+    Parameters:
+        latitude (float): Latitude of the forecast point.
+        longitude (float): Longitude of the forecast point.
+        past_days (int): Days before today included in the forecast.
+        forecast_days (int): Days from today included in the forecast.
+        max_age (float): Seconds after which the forecast is refreshed.
+    """
 
-    hourly_dataframe = pd.DataFrame(data=hourly_data)
+    def __init__(
+        self,
+        latitude: float = VALENCIA[0],
+        longitude: float = VALENCIA[1],
+        past_days: int = 1,
+        forecast_days: int = 3,
+        max_age: float = REFRESH_INTERVAL,
+    ):
+        self.params = {
+            "latitude": latitude,
+            "longitude": longitude,
+            "hourly": "temperature_2m",
+            "past_days": past_days,
+            "forecast_days": forecast_days,
+        }
+        self.max_age = max_age
+        # (inicio en segundos UTC, intervalo en segundos, temperaturas)
+        self._forecast = None
+        self.fetched = None
+        self._client = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _get_client(self):
+        if self._client is None:
+            # Se importan al primer uso para no retrasar la carga de las páginas
+            import openmeteo_requests
+            import requests
+            from retry_requests import retry
+
+            session = retry(requests.Session(), retries=5, backoff_factor=0.2)
+            self._client = openmeteo_requests.Client(session=session)
+        return self._client
+
+    @traced()
+    def refresh(self):
+        """
+        Download the forecast and replace the one in memory.
+
+        Returns:
+            ndarray: Hourly temperatures of the new forecast.
+        """
+        response = self._get_client().weather_api(FORECAST_URL, params=self.params)[0]
+        hourly = response.Hourly()
+        values = np.asarray(hourly.Variables(0).ValuesAsNumpy(), dtype=np.float64)
+        self._forecast = (int(hourly.Time()), int(hourly.Interval()), values)
+        self.fetched = time.time()
+        return values
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.warning("Temperature refresh failed: %s", e, exc_info=True)
+        finally:
+            self._refreshing = False
+
+    def _ensure_fresh(self):
+        if self._forecast is None:
+            # Sin previsión no hay nada que devolver: se descarga ahora
+            count("temperature_cache_miss")
+            with self._lock:
+                if self._forecast is None:
+                    self.refresh()
+            return
+        if time.time() - self.fetched < self.max_age:
+            count("temperature_cache_hit")
+            return
+        count("temperature_cache_stale")
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(
+            target=self._refresh_in_background, name="temperature", daemon=True
+        ).start()
+
+    def get(self, now: dt) -> float:
+        """
+        Get the forecast temperature for the hour containing ``now``.
+
+        Parameters:
+            now (datetime): Moment to look up. Naive datetimes are taken as UTC.
+
+        Returns:
+            float: The temperature in degrees Celsius.
+        """
+        self._ensure_fresh()
+        if now.tzinfo is None:
+            now = now.replace(tzinfo=UTC)
+        start, interval, values = self._forecast
+        i = (int(now.timestamp()) - start) // interval
+        if not 0 <= i < len(values):
+            # La previsión en memoria no cubre la hora pedida
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning("Temperature refresh failed: %s", e, exc_info=True)
+            start, interval, values = self._forecast
+            i = (int(now.timestamp()) - start) // interval
+            if not 0 <= i < len(values):
+                # Se usa la hora más cercana de la última previsión conocida
+                i = min(max(i, 0), len(values) - 1)
+        return float(values[i])
+
+
+_provider = TemperatureProvider()
+
+
+@traced()
+def get_temperature_data(now: dt) -> float:
+    """
+    Get the temperature in Valencia at a given hour, using the Open-Meteo API.
 
-    now = pd.Timestamp(dt(now.year, now.month, now.day, now.hour, 0, 0), tz="UTC")
+    The forecast is shared by the whole process (see ``TemperatureProvider``),
+    so most calls do not make any request.
 
-    temp = hourly_dataframe[hourly_dataframe["date"] == now]["temperature_2m"].values[0]
+    Parameters:
+        now (datetime): The moment for which to get the temperature.
 
-    return temp
+    Returns:
+        float: The temperature in degrees Celsius at the hour of ``now``.
+    """
+    return _provider.get(now)
@@ -0,0 +1,310 @@
+import functools
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+# Destinos de las trazas por defecto, p. ej. VALENFRESC_TRACE=log,metrics
+TRACE_ENV = "VALENFRESC_TRACE"
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar("trace", default=None)
+
+
+class Span:
+    """Timed section of a trace, with its nested spans and counters."""
+
+    __slots__ = ("children", "counters", "duration", "name", "start")
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration = None
+        self.children = []
+        self.counters = {}
+
+    def to_dict(self):
+        data = {"name": self.name, "ms": round(1000 * (self.duration or 0.0), 3)}
+        if self.counters:
+            data["counters"] = dict(self.counters)
+        if self.children:
+            data["children"] = [child.to_dict() for child in self.children]
+        return data
+
+
+class _SpanContext:
+    __slots__ = ("name", "trace")
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        span = Span(self.name)
+        stack = self.trace._stack
+        stack[-1].children.append(span)
+        stack.append(span)
+        return span
+
+    def __exit__(self, *exc):
+        span = self.trace._stack.pop()
+        span.duration = time.perf_counter() - span.start
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Trace:
+    """
+    Stage timings and counters of one request.
+
+    Spans opened while the trace is active nest under the innermost open
+    span, and counters are added to it. Use ``begin`` and ``finish``, or the
+    ``trace`` context manager, to make a trace the active one.
+
+    Parameters:
+        name (str): Name of the root span, e.g. the endpoint or page.
+    """
+
+    def __init__(self, name):
+        self.root = Span(name)
+        self._stack = [self.root]
+        self._token = None
+
+    def span(self, name):
+        return _SpanContext(self, name)
+
+    def count(self, name, n=1):
+        counters = self._stack[-1].counters
+        counters[name] = counters.get(name, 0) + n
+
+    @property
+    def duration(self):
+        return self.root.duration
+
+    def spans(self):
+        """
+        Flatten the spans of the trace.
+
+        Returns:
+            list: ``(depth, span)`` in the order the spans were opened.
+        """
+        result = []
+        pending = [(0, self.root)]
+        while pending:
+            depth, span = pending.pop()
+            result.append((depth, span))
+            pending.extend((depth + 1, child) for child in reversed(span.children))
+        return result
+
+    def totals(self):
+        """
+        Add up the time and counters of the spans with the same name.
+
+        Returns:
+            tuple: Seconds by span name and counter totals by name.
+        """
+        times = {}
+        counters = {}
+        for _, span in self.spans():
+            times[span.name] = times.get(span.name, 0.0) + (span.duration or 0.0)
+            for key, value in span.counters.items():
+                counters[key] = counters.get(key, 0) + value
+        return times, counters
+
+    def to_dict(self):
+        return self.root.to_dict()
+
+    def log_line(self):
+        """One-line summary: total time, time per stage and counters."""
+        times, counters = self.totals()
+        parts = [f"{self.root.name} {1000 * (self.duration or 0.0):.1f}ms"]
+        parts += [
+            f"{name}={1000 * seconds:.1f}ms"
+            for name, seconds in times.items()
+            if name != self.root.name
+        ]
+        parts += [f"{name}={value}" for name, value in counters.items()]
+        return " ".join(parts)
+
+
+class Metrics:
+    """
+    Totals of every finished trace of the process, for a metrics endpoint.
+
+    For every span name it keeps the number of calls and the total and
+    maximum seconds, and the sum of every counter.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.spans = {}
+        self.counters = {}
+        self.traces = 0
+
+    def record(self, trace):
+        times = {}
+        for _, span in trace.spans():
+            times.setdefault(span.name, []).append(span.duration or 0.0)
+        _, counters = trace.totals()
+        with self._lock:
+            self.traces += 1
+            for name, durations in times.items():
+                stats = self.spans.setdefault(
+                    name, {"count": 0, "total": 0.0, "max": 0.0}
+                )
+                stats["count"] += len(durations)
+                stats["total"] += sum(durations)
+                stats["max"] = max(stats["max"], *durations)
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "traces": self.traces,
+                "spans": {
+                    name: {
+                        "count": s["count"],
+                        "total_ms": round(1000 * s["total"], 3),
+                        "mean_ms": round(1000 * s["total"] / s["count"], 3),
+                        "max_ms": round(1000 * s["max"], 3),
+                    }
+                    for name, s in self.spans.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+
+metrics = Metrics()
+
+
+def default_exports():
+    """Exports set in the ``VALENFRESC_TRACE`` environment variable."""
+    value = os.environ.get(TRACE_ENV, "")
+    return [e.strip() for e in value.split(",") if e.strip()]
+
+
+def enabled():
+    """Whether traces should be started when nobody asked for one."""
+    return bool(default_exports())
+
+
+def begin(name):
+    """
+    Start a trace and make it the active one in this context.
+
+    Returns:
+        Trace: The new trace. Pass it to ``finish`` when the request ends.
+    """
+    trace = Trace(name)
+    trace._token = _current.set(trace)
+    return trace
+
+
+def finish(trace, exports=None):
+    """
+    Close a trace started with ``begin`` and export it.
+
+    Parameters:
+        trace (Trace): The trace.
+        exports (list): ``"log"`` writes ``log_line`` to the logger and
+            ``"metrics"`` adds the trace to ``metrics``. Defaults to the
+            ``VALENFRESC_TRACE`` environment variable.
+
+    Returns:
+        Trace: The same trace, closed.
+    """
+    trace.root.duration = time.perf_counter() - trace.root.start
+    if trace._token is not None:
+        _current.reset(trace._token)
+        trace._token = None
+    for export in default_exports() if exports is None else exports:
+        if export == "log":
+            logger.info(trace.log_line())
+        elif export == "metrics":
+            metrics.record(trace)
+    return trace
+
+
+class trace:
+    """
+    Context manager that runs a block under a new trace.
+
+    Example:
+        with trace("route") as t:
+            get_route(start, end, graph)
+        print(t.log_line())
+    """
+
+    def __init__(self, name, exports=None):
+        self.name = name
+        self.exports = exports
+        self.trace = None
+
+    def __enter__(self):
+        self.trace = begin(self.name)
+        return self.trace
+
+    def __exit__(self, *exc):
+        finish(self.trace, self.exports)
+        return False
+
+
+def current():
+    """The active trace, or None."""
+    return _current.get()
+
+
+def span(name):
+    """Context manager timing a block in the active trace, if there is one."""
+    trace = _current.get()
+    if trace is None:
+        return _NO_SPAN
+    return trace.span(name)
+
+
+def count(name, n=1):
+    """Add ``n`` to a counter of the innermost open span, if tracing."""
+    trace = _current.get()
+    if trace is not None:
+        trace.count(name, n)
+
+
+def traced(name=None):
+    """
+    Decorator timing every call of a function as a span.
+
+    When no trace is active the only cost is one context variable lookup.
+
+    Parameters:
+        name (str): Span name. Defaults to the qualified function name.
+    """
+
+    def decorator(func):
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = _current.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            with trace.span(label):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,244 @@
+import numpy as np
+
+from fountains import fountain_features, get_nearest_water_fountains_on_route
+from routes import (
+    get_cycling_route,
+    get_route,
+    get_valenbisi_route,
+    print_points,
+    route_coords,
+    simplify_coords,
+    station_features,
+    zoom_tolerance,
+)
+from snapshot import TRAMOS
+from tracing import traced
+
+MODES = ["walk", "bike", "valenbisi"]
+
+# Nombre de cada modo en la interfaz y en el cálculo de paradas
+MODE_LABELS = {"walk": "Caminando", "bike": "Bicicleta", "valenbisi": "Valenbisi"}
+LEG_LABELS = {"walk": "Caminando", "bike": "En Bicicleta"}
+LEG_COLORS = {"walk": "green", "bike": "blue"}
+
+
+def get_band(temp: float) -> str:
+    """
+    Get the weight band of a temperature.
+
+    Parameters:
+        temp (float): Temperature in degrees Celsius.
+
+    Returns:
+        str: Name of the ``peso_*`` edge attribute. Temperatures above the
+        last band use the last one, as the graphs have no other weights.
+    """
+    for low, high in TRAMOS:
+        if temp < high:
+            return f"peso_{low}_{high}"
+    low, high = TRAMOS[-1]
+    return f"peso_{low}_{high}"
+
+
+@traced()
+def plan_trip(
+    start,
+    end,
+    mode,
+    walking_graph,
+    cycling_graph,
+    fountain_index,
+    temp,
+    band=None,
+    stations=None,
+):
+    """
+    Compute a whole trip: its legs and the fountains along them.
+
+    This is what the planner page shows for each kind of route, in one call.
+
+    Parameters:
+        start (tuple): (lat, lon) start point.
+        end (tuple): (lat, lon) end point.
+        mode (str): ``"walk"``, ``"bike"`` or ``"valenbisi"``.
+        walking_graph: The walking network graph.
+        cycling_graph: The cycling network graph.
+        fountain_index (FountainIndex): Index of the public fountains.
+        temp (float): Current temperature in degrees Celsius.
+        band (str): Edge weight to minimize. Defaults to the band of ``temp``.
+        stations (StationIndex): Valenbisi stations, for ``"valenbisi"``.
+
+    Returns:
+        dict: ``legs`` (each with ``mode``, ``nodes``, ``distance``,
+        ``fountains`` and ``paradas``), ``stations`` for Valenbisi, and the
+        totals ``distance``, ``paradas`` and ``fuentes``.
+
+    Raises:
+        ValueError: If the mode is unknown or there is no route.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode: {mode}")
+    band = band or get_band(temp)
+    trip_stations = None
+
+    if mode == "walk":
+        route, dist, cumulative = get_route(
+            start, end, walking_graph, band, return_cumulative=True
+        )
+        legs = [("walk", route, dist, cumulative)]
+    elif mode == "bike":
+        ini_walk, dist_ini, cycle, dist_cycle, end_walk, dist_end = get_cycling_route(
+            start, end, cycling_graph, walking_graph, band
+        )
+        legs = [
+            ("walk", ini_walk, dist_ini, None),
+            ("bike", cycle, dist_cycle, None),
+            ("walk", end_walk, dist_end, None),
+        ]
+    else:
+        if stations is None:
+            raise ValueError("Valenbisi routes need the stations")
+        try:
+            (
+                ini_walk,
+                dist_ini,
+                cycle,
+                dist_cycle,
+                end_walk,
+                dist_end,
+                ini_station,
+                end_station,
+            ) = get_valenbisi_route(
+                start, end, cycling_graph, walking_graph, stations, band
+            )
+        except IndexError:
+            raise ValueError("No Valenbisi route between the points")
+        legs = [
+            ("walk", ini_walk, dist_ini, None),
+            ("bike", cycle, dist_cycle, None),
+            ("walk", end_walk, dist_end, None),
+        ]
+        trip_stations = (ini_station, end_station)
+
+    if not all(route for _, route, _, _ in legs):
+        raise ValueError("No route between the points")
+
+    trip = {
+        "mode": mode,
+        "band": band,
+        "temperature": float(temp),
+        "legs": [],
+        "stations": trip_stations,
+    }
+    for leg_mode, route, dist, cumulative in legs:
+        graph = walking_graph if leg_mode == "walk" else cycling_graph
+        fountains, paradas = get_nearest_water_fountains_on_route(
+            graph,
+            dist,
+            route,
+            LEG_LABELS[leg_mode],
+            temp,
+            fountain_index,
+            network=True,
+            cumulative=cumulative,
+        )
+        trip["legs"].append(
+            {
+                "mode": leg_mode,
+                "nodes": [int(n) for n in route],
+                "distance": float(dist),
+                "fountains": [int(f) for f in fountains],
+                "paradas": int(paradas),
+            }
+        )
+    trip["distance"] = sum(leg["distance"] for leg in trip["legs"])
+    trip["paradas"] = sum(leg["paradas"] for leg in trip["legs"])
+    trip["fuentes"] = sum(len(leg["fountains"]) for leg in trip["legs"])
+    return trip
+
+
+@traced()
+def trip_to_geojson(trip, walking_graph, cycling_graph, fountains_gdf):
+    """
+    Convert a trip from ``plan_trip`` to a GeoJSON FeatureCollection.
+
+    Every leg is a LineString, and fountains and Valenbisi stations are
+    Points. Their ``kind`` property tells them apart. The trip totals are in
+    the ``properties`` member of the collection.
+
+    Returns:
+        dict: The FeatureCollection.
+    """
+    features = []
+    for i, leg in enumerate(trip["legs"]):
+        graph = walking_graph if leg["mode"] == "walk" else cycling_graph
+        coords = route_coords(leg["nodes"], graph)
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": {
+                    "type": "LineString",
+                    "coordinates": coords[:, ::-1].tolist(),
+                },
+                "properties": {
+                    "kind": "leg",
+                    "leg": i,
+                    "mode": leg["mode"],
+                    "distance": leg["distance"],
+                    "paradas": leg["paradas"],
+                    "nodes": leg["nodes"],
+                },
+            }
+        )
+        features += fountain_features(leg["fountains"], fountains_gdf)
+
+    if trip["stations"] is not None:
+        features += station_features(*trip["stations"])
+
+    return {
+        "type": "FeatureCollection",
+        "features": features,
+        "properties": {
+            key: trip[key]
+            for key in ["mode", "band", "temperature", "distance", "paradas", "fuentes"]
+        },
+    }
+
+
+@traced()
+def print_trip(collection, map, zoom=None, pixels=1.0):
+    """
+    Draw a trip received as GeoJSON on the map, like the planner page does.
+
+    Every leg is drawn as one line, and the fountains and stations together as
+    a single GeoJSON layer.
+
+    Parameters:
+        collection (dict): Output of ``trip_to_geojson``.
+        map: The folium map to draw the trip on.
+        zoom (int): Zoom level the map is shown at, to simplify the legs as
+            in ``print_route``.
+        pixels (float): Simplification tolerance, in pixels at ``zoom``.
+    """
+    import folium
+
+    points = []
+    for feature in collection["features"]:
+        properties = feature["properties"]
+        if properties["kind"] != "leg":
+            points.append(feature)
+            continue
+        coords = np.asarray(feature["geometry"]["coordinates"], dtype=float)
+        if len(coords) == 0:
+            continue
+        coords = coords[:, ::-1]
+        if zoom is not None:
+            coords = simplify_coords(
+                coords, zoom_tolerance(zoom, float(coords[0, 0]), pixels)
+            )
+        folium.PolyLine(
+            locations=coords.tolist(),
+            color=LEG_COLORS[properties["mode"]],
+            weight=5,
+        ).add_to(map)
+    print_points(points, map)
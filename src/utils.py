@@ -1,10 +1,29 @@
-import osmnx as ox
-import pandas as pd
-import requests
-import geopandas as gpd
-from shapely.geometry import Point
+import copy
+import itertools
+import json
 import math
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# osmnx, pandas, geopandas, scipy y requests se importan dentro de las funciones
+# que los usan: las páginas que no calculan rutas no pagan varios segundos
+
+from snapshot import (
+    WEIGHT_BANDS,
+    SnapshotGraph,
+    build_lock,
+    build_snapshot,
+    load_snapshot,
+    snapshot_path,
+)
+from tracing import count, traced
+
+OPEN_DATA_WORKERS = 4  # páginas descargadas a la vez
+FOUNTAIN_CACHE_SUFFIX = ".cache.npz"
+FOUNTAIN_CACHE_VERSION = 1
 
 
 def get_walking_network(place_name: str):
@@ -17,6 +36,8 @@ def get_walking_network(place_name: str):
     Returns:
         graph: A directed graph representing the walking network.
     """
+    import osmnx as ox
+
     graph = ox.graph_from_place(place_name, network_type="walk")
 
     return graph
@@ -32,6 +53,8 @@ def get_cycling_network(place_name: str):
     Returns:
         graph: A directed graph representing the cycling network.
     """
+    import osmnx as ox
+
     graph = ox.graph_from_place(
         place_name,
         network_type="bike",
@@ -41,36 +64,120 @@ def get_cycling_network(place_name: str):
     return graph
 
 
-def get_valencian_open_data(url: str, params: dict = None):
+_session = None
+
+
+def get_session():
     """
-    Fetch open data from the Valencia City Council's open data portal.
+    Get the HTTP session shared by all open data downloads.
+
+    Reusing one session keeps the connections to the portal open between
+    pages and between refreshes.
 
     Returns:
-        dict: A dictionary containing the fetched data.
+        Session: The pooled ``requests`` session.
     """
-    df = pd.DataFrame()
-    response = requests.get(url, params=params)
+    import requests
 
-    if response.status_code == 200:
-        total_records = response.json().get("total_count")
-
-        for start in range(0, total_records, params.get("rows", 10)):
-            params["start"] = start
-            response = requests.get(url, params=params)
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=OPEN_DATA_WORKERS
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _session = session
+    return _session
+
+
+def _fetch_page(session, url, params, retries):
+    """Get the JSON of one page, retrying failed requests with backoff."""
+    import requests
+
+    for attempt in range(retries + 1):
+        try:
+            response = session.get(url, params=params, timeout=30)
+        except requests.RequestException as e:
+            if attempt == retries:
+                raise Exception(f"Failed to fetch data: {e}") from e
+        else:
             if response.status_code == 200:
-                data = response.json()
-                records = data.get("results", [])
-                df = pd.concat([df, pd.DataFrame(records)], ignore_index=True)
-            else:
+                return response.json()
+            # Los errores del cliente no mejoran al reintentar
+            if attempt == retries or response.status_code < 500:
                 raise Exception(
                     f"Failed to fetch data: {response.status_code}\n{response.text}"
                 )
+        time.sleep(0.5 * 2**attempt)
 
-        return df
-    else:
-        raise Exception(
-            f"Failed to fetch data: {response.status_code}\n{response.text}"
-        )
+
+@traced()
+def get_valencian_open_records(
+    url: str,
+    params: dict | None = None,
+    max_workers: int | None = None,
+    retries: int = 2,
+):
+    """
+    Fetch the raw records of a dataset of the Valencia open data portal.
+
+    The first page gives the total number of records, and the remaining pages
+    are fetched concurrently over a pooled session. Failed pages are retried
+    on their own.
+
+    Parameters:
+        url (str): Records endpoint of the dataset.
+        params (dict): Query parameters. ``rows`` sets the page size. The dict
+            is not modified.
+        max_workers (int): Pages fetched at the same time.
+        retries (int): Extra attempts for every page.
+
+    Returns:
+        list: All the records of the dataset, as dicts.
+    """
+    params = dict(params or {})
+    rows = params.get("rows", 10)
+    session = get_session()
+
+    first = _fetch_page(session, url, {**params, "start": 0}, retries)
+    records = list(first.get("results", []))
+    total_records = first.get("total_count") or 0
+
+    starts = range(rows, total_records, rows)
+    if starts:
+        workers = min(max_workers or OPEN_DATA_WORKERS, len(starts))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pages = executor.map(
+                lambda start: _fetch_page(
+                    session, url, {**params, "start": start}, retries
+                ),
+                starts,
+            )
+            for page in pages:
+                records.extend(page.get("results", []))
+
+    return records
+
+
+def get_valencian_open_data(
+    url: str,
+    params: dict | None = None,
+    max_workers: int | None = None,
+    retries: int = 2,
+):
+    """
+    Fetch open data from the Valencia City Council's open data portal.
+
+    Parameters:
+        As in ``get_valencian_open_records``.
+
+    Returns:
+        DataFrame: All the records of the dataset.
+    """
+    import pandas as pd
+
+    return pd.DataFrame(get_valencian_open_records(url, params, max_workers, retries))
 
 
 def get_gdf(df):
@@ -84,6 +191,8 @@ def get_gdf(df):
         GeoDataFrame: A GeoDataFrame of the given DataFrame.
     """
 
+    import geopandas as gpd
+
     # Convert the DataFrame to a GeoDataFrame
     gdf = gpd.GeoDataFrame(df, geometry=df["geometry"])
     gdf.set_crs(epsg=4326, inplace=True)
@@ -91,6 +200,150 @@ def get_gdf(df):
     return gdf
 
 
+def _extract_number(values, key):
+    pattern = rf"""['"]{key}['"]\s*:\s*([-+0-9.eE]+)"""
+    # astype usa el mismo redondeo que float(), to_numeric puede diferir en 1 ulp
+    return values.str.extract(pattern)[0].astype(np.float64)
+
+
+def parse_open_data_points(df):
+    """
+    Get the coordinates of Open Data Valencia point records without ``eval``.
+
+    The ``geo_point_2d`` column (``{'lon': ..., 'lat': ...}``) is parsed with
+    vectorized regular expressions. Rows where it is missing fall back to the
+    coordinates of the ``geo_shape`` column.
+
+    Parameters:
+        df (DataFrame): Records as read from the CSV export.
+
+    Returns:
+        tuple: Arrays of latitudes and longitudes.
+    """
+    import pandas as pd
+
+    nan = pd.Series(np.nan, index=df.index)
+    if "geo_point_2d" in df:
+        points = df["geo_point_2d"].astype(str)
+        lat = _extract_number(points, "lat")
+        lon = _extract_number(points, "lon")
+    else:
+        lat, lon = nan.copy(), nan.copy()
+    missing = lat.isna() | lon.isna()
+    if missing.any() and "geo_shape" in df:
+        coords = (
+            df.loc[missing, "geo_shape"]
+            .astype(str)
+            .str.extract(
+                r"""['"]coordinates['"]\s*:\s*\[\s*([-+0-9.eE]+)\s*,\s*([-+0-9.eE]+)"""
+            )
+        )
+        lon[missing] = coords[0].astype(np.float64)
+        lat[missing] = coords[1].astype(np.float64)
+    if lat.isna().any() or lon.isna().any():
+        raise ValueError("Some records have no point coordinates")
+    return lat.to_numpy(dtype=np.float64), lon.to_numpy(dtype=np.float64)
+
+
+def fountains_cache_path(file_path: str) -> str:
+    """File where the parsed fountains of ``file_path`` are cached."""
+    return os.path.splitext(file_path)[0] + FOUNTAIN_CACHE_SUFFIX
+
+
+def _csv_stamp(file_path):
+    stat = os.stat(file_path)
+    return {
+        "version": FOUNTAIN_CACHE_VERSION,
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def _save_fountains_cache(df, file_path, stamp):
+    import pandas as pd
+
+    # Sin pickle: el texto se guarda como cadenas y los huecos en una máscara
+    arrays = {}
+    columns = []
+    for i, name in enumerate(df.columns):
+        values = df[name]
+        if pd.api.types.is_numeric_dtype(values):
+            arrays[f"col{i}"] = values.to_numpy()
+        else:
+            arrays[f"col{i}"] = values.fillna("").astype(str).to_numpy(dtype=str)
+            arrays[f"na{i}"] = values.isna().to_numpy()
+        columns.append(name)
+    meta = dict(stamp, columns=columns)
+    tmp_path = f"{file_path}.tmp{os.getpid()}.npz"
+    np.savez(tmp_path, meta=np.array(json.dumps(meta)), **arrays)
+    os.replace(tmp_path, file_path)
+
+
+def _load_fountains_cache(file_path, stamp):
+    import pandas as pd
+
+    if not os.path.exists(file_path):
+        return None
+    try:
+        with np.load(file_path) as data:
+            meta = json.loads(str(data["meta"]))
+            if any(meta.get(k) != v for k, v in stamp.items()):
+                return None
+            columns = {}
+            for i, name in enumerate(meta["columns"]):
+                values = data[f"col{i}"]
+                if f"na{i}" in data.files:
+                    values = pd.Series(values, dtype=object).mask(data[f"na{i}"])
+                columns[name] = values
+    except (OSError, ValueError, KeyError):
+        return None
+    return pd.DataFrame(columns)
+
+
+@traced()
+def load_public_fountains(file_path: str, use_cache: bool = True):
+    """
+    Load the public fountains dataset.
+
+    The coordinates are parsed once (see ``parse_open_data_points``) and kept
+    with the other columns in a ``.cache.npz`` file next to the CSV, which is
+    rebuilt whenever the CSV changes.
+
+    Parameters:
+        file_path (str): Path to ``fonts_publiques.csv``.
+        use_cache (bool): Whether to read and write the cache file.
+
+    Returns:
+        GeoDataFrame: Public fountains with geometry column in EPSG:4326 and
+        their projected ``x`` and ``y`` in EPSG:25830.
+    """
+    import geopandas as gpd
+    import pandas as pd
+
+    stamp = _csv_stamp(file_path)
+    cache_path = fountains_cache_path(file_path)
+    df = _load_fountains_cache(cache_path, stamp) if use_cache else None
+    if df is not None:
+        count("fountains_cache_hit")
+    else:
+        count("fountains_cache_miss")
+        df = pd.read_csv(file_path)
+        df["lat"], df["lon"] = parse_open_data_points(df)
+        from pyproj import Transformer
+
+        transformer = Transformer.from_crs("EPSG:4326", "EPSG:25830", always_xy=True)
+        df["x"], df["y"] = transformer.transform(df["lon"].values, df["lat"].values)
+        if use_cache:
+            try:
+                _save_fountains_cache(df, cache_path, stamp)
+            except OSError:
+                # Sin permisos de escritura se sigue funcionando con el CSV
+                pass
+    return gpd.GeoDataFrame(
+        df, geometry=gpd.points_from_xy(df["lon"], df["lat"]), crs=4326
+    )
+
+
 def get_nearest_station(point, gdf):
     """
     Find the nearest station to a given point using Euclidean distance
@@ -103,6 +356,8 @@ def get_nearest_station(point, gdf):
     Returns:
         GeoSeries: Row corresponding to the nearest station, including the distance in meters.
     """
+    import geopandas as gpd
+    from shapely.geometry import Point
 
     gdf_proj = gdf.to_crs(epsg=25830)
     point_geom = (
@@ -115,6 +370,179 @@ def get_nearest_station(point, gdf):
     return nearest_row
 
 
+# Identificador de cada juego de disponibilidades publicado, único en el proceso
+_availability_ids = itertools.count()
+
+
+class StationIndex:
+    """
+    Spatial index of the Valenbisi stations in projected metres.
+
+    Station positions are projected once. Availability is kept in read-only
+    arrays, together with the masks of stations where a bike can be picked up
+    or dropped off. ``with_availability`` returns a new index with fresh
+    counts that shares everything else with this one, geometry included;
+    ``availability_id`` tells the counts of every index apart, for caches.
+
+    Parameters:
+        stations (GeoDataFrame): Stations with geometry column in EPSG:4326 and
+            the ``available`` and ``free`` columns.
+        key (str): Column identifying each station across refreshes.
+    """
+
+    def __init__(self, stations, key="number"):
+        from scipy.spatial import cKDTree
+
+        self.stations = stations.reset_index(drop=True)
+        self.key = key if key in self.stations.columns else None
+        if self.key is not None:
+            self.keys = self.stations[self.key].to_numpy()
+        proj = self.stations.geometry.to_crs(epsg=25830)
+        self.xy = np.column_stack([proj.x, proj.y])
+        self.tree = cKDTree(self.xy)
+        self._transformer = None
+        self._graph_nodes = {}
+        self._set_availability(self.stations["available"], self.stations["free"])
+
+    def __len__(self):
+        return len(self.stations)
+
+    def _set_availability(self, available, free):
+        self.availability_id = next(_availability_ids)
+        self.available = np.array(available, dtype=np.int64)
+        self.free = np.array(free, dtype=np.int64)
+        self.masks = {
+            "available": self.available > 0,
+            "free": self.free > 0,
+        }
+        # Un índice publicado puede estar en uso por varias sesiones a la vez
+        for values in [self.available, self.free, *self.masks.values()]:
+            values.setflags(write=False)
+
+    @traced()
+    def with_availability(self, keys, available, free):
+        """
+        Get an index with new bike and dock counts.
+
+        The new index shares the stations, the KD-tree and the snapped graph
+        nodes with this one, so only the count arrays are allocated. This
+        index is left untouched.
+
+        Parameters:
+            keys (array-like): Key of every station in the new data.
+            available (array-like): Bikes of every station, in the same order.
+            free (array-like): Free docks of every station, in the same order.
+
+        Returns:
+            StationIndex: The updated index, or None if the set of stations
+            changed and the index has to be rebuilt.
+        """
+        keys = np.asarray(keys)
+        if self.key is None or len(keys) != len(self.keys):
+            return None
+        # Posición de cada estación de este índice en los datos nuevos
+        order = np.argsort(keys, kind="stable")
+        pos = np.searchsorted(keys[order], self.keys)
+        pos = np.minimum(pos, len(keys) - 1)
+        if len(keys) == 0 or not (keys[order][pos] == self.keys).all():
+            return None
+        rows = order[pos]
+        index = copy.copy(self)
+        index._set_availability(np.asarray(available)[rows], np.asarray(free)[rows])
+        return index
+
+    def project(self, point):
+        """Project a (lat, lon) point to EPSG:25830."""
+        if self._transformer is None:
+            from pyproj import Transformer
+
+            self._transformer = Transformer.from_crs(
+                "EPSG:4326", "EPSG:25830", always_xy=True
+            )
+        return self._transformer.transform(point[1], point[0])
+
+    @traced()
+    def nearest(self, point, kind="available", k=1):
+        """
+        Find the k nearest stations with a bike or a free dock.
+
+        Parameters:
+            point (tuple): Tuple of coordinates (lat, lon) for the query point.
+            kind (str): ``"available"`` for stations with bikes, ``"free"``
+                for stations with free docks.
+            k (int): Number of stations to return.
+
+        Returns:
+            tuple: Positions of the stations in ``self.stations`` and their
+            distances in meters, nearest first.
+        """
+        mask = self.masks[kind]
+        n = len(self.stations)
+        xy = self.project(point)
+        query_k = min(n, max(4 * k, 8))
+        while True:
+            dist, idx = self.tree.query(xy, k=query_k)
+            dist, idx = np.atleast_1d(dist), np.atleast_1d(idx)
+            valid = idx < n
+            dist, idx = dist[valid], idx[valid]
+            eligible = mask[idx]
+            if eligible.sum() >= k or query_k >= n:
+                return idx[eligible][:k], dist[eligible][:k]
+            query_k = min(n, query_k * 4)
+
+    @traced()
+    def graph_nodes(self, graph):
+        """
+        Get the graph node closest to every station, snapped once per graph.
+
+        Returns:
+            ndarray: Node id of each station.
+        """
+        nodes = self._graph_nodes.get(id(graph))
+        if nodes is None:
+            count("station_nodes_cache_miss")
+            points = self.stations["geo_point_2d"]
+            nodes = np.array(snap_points(graph, [(p["lat"], p["lon"]) for p in points]))
+            self._graph_nodes[id(graph)] = nodes
+        return nodes
+
+    def _row(self, pos):
+        # Las filas compartidas no se actualizan, los contadores vienen de los arrays
+        row = self.stations.iloc[pos].copy()
+        row["available"] = self.available[pos]
+        row["free"] = self.free[pos]
+        return row
+
+    @traced()
+    def station(self, pos, point):
+        """
+        Get the row of a station.
+
+        Parameters:
+            pos (int): Position of the station in ``self.stations``.
+            point (tuple): (lat, lon) point the distance is measured from.
+
+        Returns:
+            Series: Row of the station, including the distance in meters.
+        """
+        row = self._row(pos)
+        x, y = self.project(point)
+        row["distance"] = float(np.hypot(*(self.xy[pos] - (x, y))))
+        return row
+
+    def nearest_station(self, point, kind="available"):
+        """
+        Get the nearest station with a bike or a free dock.
+
+        Returns:
+            Series: Row of the station, including the distance in meters.
+        """
+        idx, dist = self.nearest(point, kind, k=1)
+        row = self._row(idx[0])
+        row["distance"] = dist[0]
+        return row
+
+
 def get_distance(start, end):
     """
     Calculate the distance between two geographic points.
@@ -144,35 +572,164 @@ def get_distance(start, end):
     return gc_dist_m
 
 
-def read_graph(file_path: str):
+def _unit_vectors(lat, lon):
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)])
+
+
+class NodeIndex:
     """
-    Read a graph from a file.
+    Spatial index of the nodes of a graph, for snapping points to nodes.
+
+    Nodes are stored as unit vectors, so the nearest node by chord distance
+    is also the nearest by great-circle distance, as with
+    ``ox.distance.nearest_nodes`` on an unprojected graph.
 
     Parameters:
-        file_path (str): Path to the graph file.
+        node_ids (array-like): OSM id of each node.
+        lat (array-like): Node latitudes.
+        lon (array-like): Node longitudes.
+    """
+
+    def __init__(self, node_ids, lat, lon):
+        from scipy.spatial import cKDTree
+
+        self.node_ids = np.asarray(node_ids)
+        self.tree = cKDTree(_unit_vectors(lat, lon))
+
+    @classmethod
+    def from_graph(cls, graph):
+        """Build the index of a graph, from its snapshot arrays if it has one."""
+        snapshot = graph.graph.get("snapshot")
+        if snapshot is not None:
+            return cls(snapshot.node_ids, snapshot.lat, snapshot.lon)
+        nodes = list(graph.nodes)
+        return cls(
+            nodes,
+            [graph.nodes[n]["y"] for n in nodes],
+            [graph.nodes[n]["x"] for n in nodes],
+        )
+
+    def nearest(self, lat, lon, return_dist=False):
+        """
+        Find the nearest node to every given point.
+
+        Parameters:
+            lat (array-like): Latitudes of the points.
+            lon (array-like): Longitudes of the points.
+            return_dist (bool): Also return the distances in meters.
+
+        Returns:
+            ndarray: Node ids (and distances if requested).
+        """
+        chord, idx = self.tree.query(_unit_vectors(lat, lon), k=1)
+        node_ids = self.node_ids[idx]
+        if return_dist:
+            return node_ids, 2 * 6371000 * np.arcsin(np.minimum(chord / 2, 1.0))
+        return node_ids
+
+
+def get_node_index(graph):
+    """
+    Get the node index of a graph, building it on first use.
+
+    The index is kept in ``graph.graph["node_index"]``.
+    """
+    index = graph.graph.get("node_index")
+    if index is None:
+        count("node_index_cache_miss")
+        index = NodeIndex.from_graph(graph)
+        graph.graph["node_index"] = index
+    return index
+
+
+@traced()
+def snap_points(graph, points):
+    """
+    Snap several points to their nearest graph nodes in one query.
+
+    Parameters:
+        graph: The network graph.
+        points (list): Tuples of coordinates (lat, lon).
 
     Returns:
-        graph: The loaded graph.
+        list: The nearest node id of each point.
     """
+    if not points:
+        return []
+    lat, lon = zip(*points)
+    return get_node_index(graph).nearest(lat, lon).tolist()
+
+
+def _parse_graphml(file_path):
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"Graph file not found: {file_path}")
 
+    import osmnx as ox
+
     graph = ox.load_graphml(file_path)
     # Cambiar el tipo de valor de algunos atributos de aristas
-    tramos = [
-        (0, 5),
-        (5, 10),
-        (10, 15),
-        (15, 20),
-        (20, 25),
-        (25, 30),
-        (30, 35),
-        (35, 40),
-    ]
     for u, v, data in graph.edges(data=True):
-        for tramo in tramos:
-            t_str = f"peso_{tramo[0]}_{tramo[1]}"
+        for t_str in WEIGHT_BANDS:
             if t_str in data:
                 data[t_str] = float(data[t_str])
-    graph = ox.project_graph(graph, to_crs="EPSG:4326")
+    return ox.project_graph(graph, to_crs="EPSG:4326")
+
+
+@traced()
+def read_graph(file_path: str, use_snapshot: bool = True, view: bool = False):
+    """
+    Read a graph from a file.
+
+    When a compiled snapshot (see ``snapshot.py``) sits next to the GraphML
+    file and is up to date, the graph is read from its memory-mapped arrays
+    instead of parsing the XML. Otherwise the GraphML is parsed and a new
+    snapshot is written for the next start; if several processes start at
+    once, only one of them builds it. The node snapping index is built once
+    here (see ``snap_points``).
+
+    The app, the routing service and the batch router pass ``view=True``, so
+    they work on the snapshot arrays without building a networkx graph.
+
+    Parameters:
+        file_path (str): Path to the graph file.
+        use_snapshot (bool): Whether to read and write the compiled snapshot.
+        view (bool): Return a read-only ``SnapshotGraph`` over the snapshot
+            arrays, which shares them with every other process instead of
+            copying them, rather than a networkx graph. Only the
+            array-backed functions of ``src`` accept it; osmnx and networkx
+            need the default.
+
+    Returns:
+        graph: The loaded graph, a networkx ``MultiDiGraph`` unless ``view``
+        is set and there is a snapshot.
+    """
+    if not use_snapshot:
+        graph = _parse_graphml(file_path)
+        get_node_index(graph)
+        return graph
+
+    snap_path = snapshot_path(file_path)
+    snapshot = load_snapshot(snap_path, source_path=file_path)
+    if snapshot is not None:
+        count("snapshot_hit")
+    else:
+        count("snapshot_miss")
+        with build_lock(snap_path):
+            # Otro proceso puede haberlo compilado mientras se esperaba
+            snapshot = load_snapshot(snap_path, source_path=file_path)
+            if snapshot is None:
+                graph = _parse_graphml(file_path)
+                try:
+                    build_snapshot(graph, snap_path, source_path=file_path)
+                except OSError:
+                    # Sin permisos de escritura se sigue funcionando con el GraphML
+                    get_node_index(graph)
+                    return graph
+                snapshot = load_snapshot(snap_path, source_path=file_path)
+
+    graph = SnapshotGraph(snapshot) if view else snapshot.to_graph()
+    get_node_index(graph)
     return graph
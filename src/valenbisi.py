@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+from utils import StationIndex, get_gdf, get_valencian_open_records
+
+VALENBISI_URL = (
+    "https://valencia.opendatasoft.com/api/explore/v2.1/catalog/"
+    "datasets/valenbisi-disponibilitat-valenbisi-dsiponibilidad/records"
+)
+VALENBISI_PARAMS = {"rows": 100}
+POLL_INTERVAL = 600  # segundos
+
+logger = logging.getLogger(__name__)
+
+
+def fetch_valenbisi_records(url: str = VALENBISI_URL, params: dict | None = None):
+    """
+    Download the records of the open Valenbisi stations.
+
+    Parameters:
+        url (str): Records endpoint of the availability dataset.
+        params (dict): Query parameters of the request.
+
+    Returns:
+        list: Record of every open station, as a dict.
+    """
+    records = get_valencian_open_records(url, params or VALENBISI_PARAMS)
+    return [r for r in records if r.get("open") == "T"]
+
+
+def stations_from_records(records):
+    """
+    Build the stations GeoDataFrame from their records.
+
+    Returns:
+        GeoDataFrame: Stations in EPSG:4326.
+    """
+    import pandas as pd
+    from shapely.geometry import shape
+
+    df = pd.DataFrame(records)
+    df["geometry"] = df["geo_shape"].apply(shape)
+    return get_gdf(df)
+
+
+def availability_from_records(records, key="number"):
+    """
+    Get only the availability of the stations, without any geometry.
+
+    Returns:
+        tuple: Arrays with the key, bikes and free docks of every station.
+    """
+    keys = np.array([r[key] for r in records])
+    available = np.array([r["available"] for r in records], dtype=np.int64)
+    free = np.array([r["free"] for r in records], dtype=np.int64)
+    return keys, available, free
+
+
+def fetch_valenbisi_stations(url: str = VALENBISI_URL, params: dict | None = None):
+    """
+    Download the open Valenbisi stations with their availability.
+
+    Parameters:
+        url (str): Records endpoint of the availability dataset.
+        params (dict): Query parameters of the request.
+
+    Returns:
+        GeoDataFrame: Open stations in EPSG:4326.
+    """
+    return stations_from_records(fetch_valenbisi_records(url, params))
+
+
+class AvailabilityPoller:
+    """
+    Background service that keeps the Valenbisi availability up to date.
+
+    A daemon thread downloads the stations every ``interval`` seconds and
+    publishes a new ``StationIndex``. When the set of stations has not
+    changed, only the bike and dock counts are read from the records and the
+    new index shares the geometry with the previous one; the GeoDataFrame is
+    only built again when stations appear or disappear. Published indexes are never
+    modified, so any number of readers can use them without locks.
+
+    Parameters:
+        url (str): Records endpoint of the availability dataset.
+        params (dict): Query parameters of the request.
+        interval (float): Seconds between downloads.
+    """
+
+    def __init__(
+        self,
+        url: str = VALENBISI_URL,
+        params: dict | None = None,
+        interval: float = POLL_INTERVAL,
+    ):
+        self.url = url
+        self.params = dict(params or VALENBISI_PARAMS)
+        self.interval = interval
+        self.updated = None
+        self.last_error = None
+        self._published = (None, 0)
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        """
+        Download the stations once and publish the new index.
+
+        Returns:
+            StationIndex: The published index.
+        """
+        records = fetch_valenbisi_records(self.url, self.params)
+        current, version = self._published
+        index = None
+        if current is not None:
+            index = current.with_availability(*availability_from_records(records))
+        if index is None:
+            index = StationIndex(stations_from_records(records))
+        # Asignar un atributo es atómico: los lectores ven el índice anterior
+        # o el nuevo, nunca uno a medias
+        self._published = (index, version + 1)
+        self.updated = time.time()
+        self._ready.set()
+        return index
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+                self.last_error = None
+            except Exception as e:
+                # Se mantiene el último índice publicado
+                self.last_error = e
+                logger.warning("Valenbisi refresh failed: %s", e, exc_info=True)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """Start the polling thread, if it is not running yet."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="valenbisi-poller", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the polling thread after the current download."""
+        self._stop.set()
+
+    def get(self, timeout: float | None = None):
+        """
+        Get the current stations without blocking on a refresh.
+
+        Only the very first call may wait, until the first download finishes
+        or ``timeout`` seconds pass.
+
+        Returns:
+            tuple: The latest published ``StationIndex``, or None if there is
+            none yet, and its version number, which changes on every refresh.
+        """
+        if self._published[0] is None:
+            self._ready.wait(timeout)
+        return self._published
@@ -0,0 +1,85 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import assets
+
+WALKING_GRAPH = "data/valencia_walking_sombra.graphml"
+CYCLING_GRAPH = "data/valencia_cycling_sombra.graphml"
+FOUNTAINS_CSV = "data/fonts_publiques.csv"
+
+_lock = threading.Lock()
+_executor = None
+_futures = {}
+
+
+def preload(name, func, *args):
+    """
+    Start loading a resource in the background, once per process.
+
+    Calling it again with the same ``name`` returns the load already started,
+    unless it failed, in which case it is started again.
+
+    Parameters:
+        name (str): Key of the resource.
+        func (callable): Function that loads it.
+        *args: Arguments of ``func``.
+
+    Returns:
+        Future: The load of the resource.
+    """
+    global _executor
+    with _lock:
+        future = _futures.get(name)
+        if future is None or (future.done() and future.exception() is not None):
+            if _executor is None:
+                # Un solo hilo: las cargas compiten por el GIL con la página
+                _executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="warmup"
+                )
+            future = _executor.submit(func, *args)
+            _futures[name] = future
+        return future
+
+
+def get(name, func, *args, timeout=None):
+    """
+    Get a resource, waiting for its background load or starting it.
+
+    Parameters:
+        name, func, *args: As in ``preload``.
+        timeout (float): Seconds to wait. Defaults to no limit.
+
+    Returns:
+        The value returned by ``func``.
+    """
+    return preload(name, func, *args).result(timeout)
+
+
+def load_planner_resources(
+    walking_path=WALKING_GRAPH, cycling_path=CYCLING_GRAPH, fountains_path=FOUNTAINS_CSV
+):
+    """
+    Load everything the route planner needs before it can draw a route.
+
+    Data files that are missing are downloaded first (see ``assets``), and
+    the most used routes of the route store are loaded into memory.
+
+    Returns:
+        tuple: Cycling graph, walking graph, public fountains and their
+        ``FountainIndex``, with the fountain tables of both graphs ready.
+    """
+    from fountains import FountainIndex, get_fountain_table
+    from routecache import route_cache, route_store
+    from utils import load_public_fountains, read_graph
+
+    assets.ensure([walking_path, cycling_path, fountains_path])
+    cycling_graph = read_graph(cycling_path, view=True)
+    walking_graph = read_graph(walking_path, view=True)
+    fountains = load_public_fountains(fountains_path)
+    fountain_index = FountainIndex(fountains)
+    # Fuente más cercana de cada nodo, medida por la red peatonal
+    get_fountain_table(walking_graph, fountain_index)
+    get_fountain_table(cycling_graph, fountain_index, walking_graph)
+    # Las rutas más pedidas antes del reinicio vuelven a estar en memoria
+    route_store.warm(route_cache, [walking_graph, cycling_graph])
+    return cycling_graph, walking_graph, fountains, fountain_index
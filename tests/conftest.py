@@ -0,0 +1,70 @@
+import random
+
+import networkx as nx
+import numpy as np
+import osmnx as ox
+import pytest
+
+from shade import shade_weights
+
+# Esquina de la cuadrícula de prueba, en el centro de Valencia
+LAT0, LON0 = 39.47, -0.38
+STEP = 0.001  # grados entre nodos vecinos
+
+
+def make_graph(size=7, seed=0):
+    """
+    Small street grid with the attributes of the shade graphs.
+
+    Some streets are one-way, some have two parallel edges and one node is
+    isolated, so there are pairs without route.
+    """
+    rng = random.Random(seed)
+    graph = nx.MultiDiGraph(crs="epsg:4326")
+    for i in range(size):
+        for j in range(size):
+            graph.add_node(
+                1000 + i * size + j,
+                x=LON0 + j * STEP + rng.uniform(-1e-4, 1e-4),
+                y=LAT0 + i * STEP + rng.uniform(-1e-4, 1e-4),
+                street_count=4,
+            )
+    graph.add_node(9999, x=LON0 - STEP, y=LAT0 - STEP, street_count=0)
+
+    edges = []
+    for i in range(size):
+        for j in range(size):
+            u = 1000 + i * size + j
+            for v in [u + 1 if j + 1 < size else None, u + size]:
+                if v is None or v >= 1000 + size * size:
+                    continue
+                edges.append((u, v))
+                if rng.random() > 0.2:
+                    edges.append((v, u))
+    edges += [(u, v) for u, v in edges if rng.random() < 0.1]
+
+    # Como en OSM, ninguna calle es más corta que la línea recta entre sus nodos
+    nodes = graph.nodes
+    straight = ox.distance.great_circle(
+        np.array([nodes[u]["y"] for u, _ in edges]),
+        np.array([nodes[u]["x"] for u, _ in edges]),
+        np.array([nodes[v]["y"] for _, v in edges]),
+        np.array([nodes[v]["x"] for _, v in edges]),
+    )
+    length = straight * np.array([rng.uniform(1.05, 1.5) for _ in edges])
+    num_arboles = np.array([rng.randint(0, 20) for _ in edges])
+    pesos = shade_weights(length, num_arboles)
+    for i, (u, v) in enumerate(edges):
+        data = {"osmid": i, "length": float(length[i])}
+        data["num_arboles"] = int(num_arboles[i])
+        data.update({name: float(col[i]) for name, col in pesos.items()})
+        graph.add_edge(u, v, **data)
+    return graph
+
+
+@pytest.fixture
+def graph_file(tmp_path):
+    """GraphML of ``make_graph``, in its own directory so snapshots are fresh."""
+    file_path = tmp_path / "grid_sombra.graphml"
+    ox.save_graphml(make_graph(), file_path)
+    return str(file_path)
@@ -0,0 +1,70 @@
+import gzip
+import hashlib
+
+import pytest
+
+import assets
+from assets import AssetError, fetch
+
+CONTENT = b"<graphml>" + bytes(range(256)) * 64 + b"</graphml>"
+
+
+@pytest.fixture
+def mirror(tmp_path, monkeypatch):
+    """Mirror directory with a gzip copy of ``CONTENT``."""
+    monkeypatch.setattr(assets, "DOWNLOAD_DIR", str(tmp_path / "downloads"))
+    mirror_dir = tmp_path / "mirror"
+    mirror_dir.mkdir()
+    (mirror_dir / "grid.graphml.gz").write_bytes(gzip.compress(CONTENT))
+    return str(mirror_dir)
+
+
+def entry(**fields):
+    return {
+        "url": "https://example.invalid/grid",
+        "archive": "grid.graphml.gz",
+        **fields,
+    }
+
+
+def test_fetch_installs_verified_file(tmp_path, mirror):
+    path = str(tmp_path / "data" / "grid.graphml")
+    sha = hashlib.sha256(CONTENT).hexdigest()
+    fetch(path, entry(sha256=sha, size=len(CONTENT)), mirror)
+    with open(path, "rb") as f:
+        assert f.read() == CONTENT
+    assert assets.verify(path, {"sha256": sha})
+
+
+def test_fetch_rejects_wrong_checksum(tmp_path, mirror):
+    path = tmp_path / "data" / "grid.graphml"
+    with pytest.raises(AssetError, match="Checksum"):
+        fetch(str(path), entry(sha256="0" * 64), mirror)
+    # Ni el fichero ni restos de la descarga quedan en disco
+    assert not path.exists()
+    assert list(path.parent.iterdir()) == []
+    assert list((tmp_path / "downloads").iterdir()) == []
+
+
+def test_fetch_rejects_wrong_size(tmp_path, mirror):
+    path = tmp_path / "data" / "grid.graphml"
+    sha = hashlib.sha256(CONTENT).hexdigest()
+    with pytest.raises(AssetError, match="bytes"):
+        fetch(str(path), entry(sha256=sha, size=len(CONTENT) + 1), mirror)
+    assert not path.exists()
+
+
+def test_fetch_refuses_entry_without_checksum(tmp_path, mirror):
+    path = tmp_path / "data" / "grid.graphml"
+    with pytest.raises(AssetError, match="no sha256"):
+        fetch(str(path), entry(sha256=None), mirror)
+    assert not (tmp_path / "downloads").exists()
+
+
+def test_fetch_unverified_entry(tmp_path, mirror, caplog):
+    path = str(tmp_path / "data" / "grid.graphml")
+    fetch(path, entry(sha256=None, unverified=True), mirror)
+    with open(path, "rb") as f:
+        assert f.read() == CONTENT
+    assert hashlib.sha256(CONTENT).hexdigest() in caplog.text
+    assert not assets.verify(path, {"sha256": None})
@@ -0,0 +1,77 @@
+import itertools
+
+import networkx as nx
+import pytest
+
+from ch import build_hierarchy, save_hierarchy
+from engine import get_engine
+from utils import read_graph
+
+WEIGHTS = ["length", "peso_0_5", "peso_35_40"]
+
+
+def nx_route(graph, source, target, weight):
+    try:
+        return nx.shortest_path(graph, source, target, weight=weight)
+    except nx.NetworkXNoPath:
+        return None
+
+
+@pytest.mark.parametrize("weight", WEIGHTS)
+def test_bidirectional_matches_networkx(graph_file, weight):
+    graph = read_graph(graph_file)
+    engine = get_engine(graph)
+    for source, target in itertools.permutations(graph.nodes, 2):
+        expected = nx_route(graph, source, target, weight)
+        assert engine.shortest_path(source, target, weight) == expected
+
+
+@pytest.mark.parametrize("weight", WEIGHTS)
+def test_astar_cost_matches_networkx(graph_file, weight):
+    graph = read_graph(graph_file)
+    engine = get_engine(graph)
+    for source, target in itertools.permutations(graph.nodes, 2):
+        expected = nx_route(graph, source, target, weight)
+        route = engine.shortest_path(source, target, weight, method="astar")
+        if expected is None:
+            assert route is None
+        else:
+            assert nx.path_weight(graph, route, weight) == pytest.approx(
+                nx.path_weight(graph, expected, weight)
+            )
+
+
+@pytest.mark.parametrize("weight", WEIGHTS)
+def test_ch_cost_matches_dijkstra(graph_file, weight):
+    graph = read_graph(graph_file, view=True)
+    engine = get_engine(graph)
+    save_hierarchy(build_hierarchy(engine, weight), engine.snapshot, weight)
+    # Otro engine sobre el mismo snapshot lee la jerarquía del disco
+    engine = get_engine(read_graph(graph_file))
+    assert engine.hierarchy(weight) is not None
+    (indptr, nbrs, costs), _ = engine.adjacency(weight)
+    node_ids = engine.node_ids
+
+    def cost(route):
+        total = 0.0
+        for u, v in itertools.pairwise(route):
+            i = node_ids.index(u)
+            row = nbrs[indptr[i] : indptr[i + 1]]
+            total += costs[indptr[i] + row.index(node_ids.index(v))]
+        return total
+
+    for source, target in itertools.permutations(node_ids, 2):
+        expected = engine.shortest_path(source, target, weight)
+        route = engine.shortest_path(source, target, weight, method="ch")
+        if expected is None:
+            assert route is None
+        else:
+            assert route[0] == source and route[-1] == target
+            assert cost(route) == pytest.approx(cost(expected))
+
+
+def test_ch_is_opt_in(graph_file):
+    graph = read_graph(graph_file)
+    engine = get_engine(graph)
+    with pytest.raises(ValueError):
+        engine.shortest_path(1000, 1010, "length", method="ch")
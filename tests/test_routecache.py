@@ -0,0 +1,55 @@
+import itertools
+
+from engine import get_engine
+from routecache import MISSING, ROW_OVERHEAD, RouteStore
+from utils import read_graph
+
+
+def test_store_round_trip(graph_file, tmp_path):
+    graph = read_graph(graph_file, view=True)
+    engine = get_engine(graph)
+    store = RouteStore(str(tmp_path / "routes.sqlite"))
+    route = engine.shortest_path(1000, 1048, "peso_25_30")
+
+    assert store.get(graph, 1000, 1048, "peso_25_30") is MISSING
+    store.put(graph, 1000, 1048, "peso_25_30", route)
+    store.put(graph, 1000, 9999, "peso_25_30", None)
+    assert store.get(graph, 1000, 1048, "peso_25_30") == route
+    assert store.get(graph, 1000, 9999, "peso_25_30") is None
+    assert store.get(graph, 1000, 1048, "length") is MISSING
+
+    # Otro proceso con el mismo fichero ve las mismas rutas
+    store = RouteStore(str(tmp_path / "routes.sqlite"))
+    graph = read_graph(graph_file, view=True)
+    assert store.get(graph, 1000, 1048, "peso_25_30") == route
+    assert store.stats()["routes"] == 2
+
+
+def test_store_trims_least_recently_used(graph_file, tmp_path):
+    graph = read_graph(graph_file, view=True)
+    engine = get_engine(graph)
+    pairs = list(itertools.permutations(range(1000, 1007), 2))
+    routes = [engine.shortest_path(s, t) for s, t in pairs]
+    max_bytes = 10 * (ROW_OVERHEAD + 8 * max(len(r) for r in routes))
+    store = RouteStore(str(tmp_path / "routes.sqlite"), max_bytes=max_bytes)
+
+    first = pairs[0]
+    store.put(graph, *first, "length", routes[0])
+    for (s, t), route in zip(pairs[1:], routes[1:]):
+        # Un acierto del primero lo mantiene entre los usados recientemente
+        assert store.get(graph, *first, "length") == routes[0]
+        store.put(graph, s, t, "length", route)
+
+    stats = store.stats()
+    assert stats["bytes"] <= max_bytes
+    assert stats["routes"] < len(pairs)
+    assert store.get(graph, *first, "length") == routes[0]
+    assert store.get(graph, *pairs[1], "length") is MISSING
+
+
+def test_store_disabled_by_empty_path(graph_file):
+    graph = read_graph(graph_file, view=True)
+    store = RouteStore("")
+    store.put(graph, 1000, 1001, "length", [1000, 1001])
+    assert store.get(graph, 1000, 1001, "length") is MISSING
+    assert not store.stats()["enabled"]